@@ -1,16 +1,23 @@
 import os
 import re
-import time
 import logging
-import threading
-import requests
+import functools
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from google.auth.exceptions import RefreshError
 
+from drive_lookup import fetch_first_images
+from drive_clients import build_service, get_drive_client, get_drive_client_pool
+from http_transport import setup_http_transport, format_transport_stats
+from drive_download import download_drive_file
+from download_engine import DownloadEngine, DEFAULT_DOWNLOAD_WORKERS, FAILED, format_download_counts
+from download_manifest import open_download_manifest
+from rate_limiter import (
+    drive_rate_limiter, sheets_read_rate_limiter, execute_with_backoff, setup_rate_limits, MAX_BATCH_SIZE,
+)
+
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
@@ -20,45 +27,22 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive.readonly'
 ]
 
-# スレッドローカルに Drive サービス保持
-_thread_local = threading.local()
-
-# トークンバケット方式で Drive API レート制御
-RATE_LIMIT_MAX_DRIVE = 2000
-token_bucket = RATE_LIMIT_MAX_DRIVE
-last_refill = time.time()
-rate_limit_lock = threading.Lock()
-
+# スライディングウィンドウ方式で Drive API レート制御（全エントリーポイントで共有）
 def check_drive_api_rate_limit():
-    global token_bucket, last_refill
-    with rate_limit_lock:
-        now = time.time()
-        if now - last_refill >= 60:
-            logging.info("1分経過のため、10秒待機してトークンをリセットします。")
-            time.sleep(10)
-            token_bucket = RATE_LIMIT_MAX_DRIVE
-            last_refill = time.time()
-            now = last_refill
-
-        elapsed = now - last_refill
-        token_bucket = min(RATE_LIMIT_MAX_DRIVE, token_bucket + elapsed * (RATE_LIMIT_MAX_DRIVE/60))
-        last_refill = now
-
-        while token_bucket < 1:
-            wait_time = (1 - token_bucket) * (60 / RATE_LIMIT_MAX_DRIVE)
-            logging.info(f"トークン不足のため {wait_time:.2f}秒待機します。")
-            time.sleep(wait_time)
-            now = time.time()
-            elapsed = now - last_refill
-            token_bucket = min(RATE_LIMIT_MAX_DRIVE, token_bucket + elapsed * (RATE_LIMIT_MAX_DRIVE/60))
-            last_refill = now
-
-        token_bucket -= 1
+    wait_time = drive_rate_limiter.acquire()
+    if wait_time > 0:
+        logging.info(f"レート上限に達したため {wait_time:.2f}秒待機しました。")
+
+def execute_drive_request(request):
+    """
+    Drive API リクエストをレート制御付きで実行する。
+    スロットリング（403/429）の場合はリミッターの上限を下げて再試行します。
+    """
+    return execute_with_backoff(request, drive_rate_limiter, acquire=check_drive_api_rate_limit)
 
 def get_drive_service(creds):
-    if not hasattr(_thread_local, 'drive'):
-        _thread_local.drive = build('drive', 'v3', credentials=creds)
-    return _thread_local.drive
+    # 共有のクライアントプールから、スレッドごとに専用のクライアントを取得する
+    return get_drive_client(creds)
 
 def authenticate():
     """
@@ -83,7 +67,7 @@ def authenticate():
         with open(token_path, 'w') as f:
             f.write(creds.to_json())
 
-    sheets_service = build('sheets', 'v4', credentials=creds)
+    sheets_service = build_service('sheets', 'v4', creds)
     return sheets_service, creds
 
 def extract_folder_id(url: str) -> str | None:
@@ -93,39 +77,26 @@ def extract_folder_id(url: str) -> str | None:
             return m.group(1)
     return None
 
-def fetch_first_image_url(drive_service, folder_id: str) -> str | None:
-    check_drive_api_rate_limit()
-    resp = drive_service.files().list(
-        q=f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false",
-        fields="files(id,name)"
-    ).execute()
-    files = resp.get('files', [])
-    if not files:
-        return None
-    files.sort(key=lambda f: f['name'])
-    file_id = files[0]['id']
-    return f"https://drive.google.com/uc?export=view&id={file_id}"
-
-def download_image(url: str, save_path: str):
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    resp = requests.get(url, stream=True)
-    resp.raise_for_status()
-    with open(save_path, 'wb') as f:
-        for chunk in resp.iter_content(8192):
-            f.write(chunk)
+def download_image(drive_service, file_id: str, save_path: str, md5_checksum: str = None):
+    result = download_drive_file(drive_service, file_id, save_path, acquire=check_drive_api_rate_limit,
+                                 md5_checksum=md5_checksum)
     logging.info(f"Downloaded: {save_path}")
+    return result
 
-def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str, start_row: int = 2):
+def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str, start_row: int = 2,
+                     download_workers: int = DEFAULT_DOWNLOAD_WORKERS):
     RANGE = f"{sheet_name}!A{start_row}:E"
-    resp = sheets_service.spreadsheets().values().get(
+    resp = execute_with_backoff(sheets_service.spreadsheets().values().get(
         spreadsheetId=spreadsheet_id,
         range=RANGE
-    ).execute()
+    ), sheets_read_rate_limiter)
     values = resp.get('values', [])
 
     drive_service = get_drive_service(creds)
     base_dir = os.path.abspath("downloaded_images")
+    manifest = open_download_manifest({}, base_dir)
 
+    targets = []
     for idx, row in enumerate(values, start=start_row):
         folder_url = row[0] if len(row) > 0 else ""
         save_name  = row[4] if len(row) > 4 else ""
@@ -134,7 +105,8 @@ def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str
             continue
 
         save_path = os.path.join(base_dir, f"{save_name}.jpg")
-        if os.path.exists(save_path):
+        # 台帳がある場合は、既存のファイルも先頭画像を調べてからエンジン側で判定する
+        if manifest is None and os.path.exists(save_path):
             logging.info(f"Row {idx}: {save_name}.jpg already exists. Skipped.")
             continue
 
@@ -143,23 +115,54 @@ def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str
             logging.warning(f"Row {idx}: Failed to extract folder ID from {folder_url}")
             continue
 
-        image_url = fetch_first_image_url(drive_service, folder_id)
-        if not image_url:
-            logging.warning(f"Row {idx}: No images found in folder {folder_id}")
-            continue
-
-        try:
-            download_image(image_url, save_path)
-        except Exception as e:
-            logging.error(f"Row {idx}: Download failed: {e}")
+        targets.append((idx, save_name, save_path, folder_id))
+
+    # 先頭画像の検索は最大100フォルダずつまとめて行う（親フォルダの OR 検索または BatchHttpRequest）
+    # ダウンロードは最大 download_workers 件を並列に行い、その間に次のバッチを検索する
+    failed_count = 0
+    drive_pool = get_drive_client_pool(creds)
+    with DownloadEngine(functools.partial(download_image, drive_pool), download_workers,
+                        manifest=manifest) as engine:
+        for i in range(0, len(targets), MAX_BATCH_SIZE):
+            batch = targets[i:i + MAX_BATCH_SIZE]
+            try:
+                images, errors = fetch_first_images(
+                    drive_service, [folder_id for _, _, _, folder_id in batch], acquire=check_drive_api_rate_limit
+                )
+            except Exception as e:
+                logging.error(f"Row {batch[0][0]}～{batch[-1][0]}: 画像検索のバッチでエラー: {e}")
+                failed_count += len(batch)
+                continue
+
+            for idx, save_name, save_path, folder_id in batch:
+                if folder_id in errors:
+                    logging.error(f"Row {idx}: {errors[folder_id]}")
+                    failed_count += 1
+                    continue
+                first_file = images.get(folder_id)
+                if not first_file:
+                    logging.warning(f"Row {idx}: No images found in folder {folder_id}")
+                    failed_count += 1
+                    continue
+                engine.submit(idx, save_name, save_path, first_file['id'],
+                              first_file.get('md5Checksum'), first_file.get('size'))
+
+    counts = dict(engine.counts)
+    counts[FAILED] += failed_count
+    logging.info(f"画像ダウンロードが完了しました: {format_download_counts(counts)}")
 
 def main():
     SPREADSHEET_ID = "1GWc8wGc2ebjxjCXlZdmg97hLvyJUiqYhGMiLqTHMYq0"
     SHEET_NAME    = "第3弾"
     START_ROW     = 2
 
+    setup_rate_limits({})
+    setup_http_transport({}, DEFAULT_DOWNLOAD_WORKERS)
     sheets_service, creds = authenticate()
     process_all_rows(sheets_service, creds, SPREADSHEET_ID, SHEET_NAME, START_ROW)
+    transport_stats = format_transport_stats()
+    if transport_stats:
+        logging.info(transport_stats)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Google API のディスカバリードキュメントを解析済みの形で保存・読み込むキャッシュ
+"""
+
+import os
+import sys
+import json
+import marshal
+import logging
+import threading
+
+from googleapiclient import discovery_cache
+
+try:
+    from googleapiclient.version import __version__ as LIBRARY_VERSION
+except ImportError:
+    LIBRARY_VERSION = "unknown"
+
+# 使用する API（ビルド時に同梱するディスカバリードキュメント）
+DISCOVERY_APIS = (('drive', 'v3'), ('sheets', 'v4'))
+# PyInstaller のビルドに同梱するディレクトリ名
+BUNDLED_DISCOVERY_DIR = "discovery"
+DEFAULT_DISCOVERY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".gdrive_image_downloader", "discovery")
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def _bundled_dir() -> str:
+    if getattr(sys, 'frozen', False):
+        # PyInstaller で作成された実行ファイルの場合は展開先から読み込む
+        base_path = getattr(sys, '_MEIPASS', os.path.dirname(sys.executable))
+    else:
+        base_path = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_path, BUNDLED_DISCOVERY_DIR)
+
+
+def _document_filename(service_name: str, version: str) -> str:
+    # marshal の形式は Python のバージョンごとに異なるため、ファイル名に含める
+    return f"{service_name}.{version}.py{sys.version_info[0]}{sys.version_info[1]}.marshal"
+
+
+def _read_document(path: str):
+    try:
+        with open(path, 'rb') as f:
+            return marshal.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logging.warning("ディスカバリーキャッシュを読み込めませんでした（%s）: %s", path, e)
+        return None
+
+
+def _write_document(path: str, document: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(document, f)
+    os.replace(tmp_path, path)
+
+
+def _load_static_document(service_name: str, version: str):
+    content = discovery_cache.get_static_doc(service_name, version)
+    return json.loads(content) if content else None
+
+
+def load_discovery_document(service_name: str, version: str, cache_dir: str = DEFAULT_DISCOVERY_CACHE_DIR):
+    """
+    解析済みのディスカバリードキュメント（dict）を返します。見つからなければ None。
+
+    次の順に探し、一度読み込んだものはプロセス内で使い回します。
+    ・ビルドに同梱した discovery/ ディレクトリ（write_discovery_cache で作成）
+    ・ユーザーのキャッシュディレクトリ（ライブラリのバージョンごと）
+    ・googleapiclient 同梱の JSON（解析してユーザーのキャッシュに保存）
+    """
+    key = (service_name, version)
+    with _documents_lock:
+        document = _documents.get(key)
+        if document is not None:
+            return document
+
+        filename = _document_filename(service_name, version)
+        document = _read_document(os.path.join(_bundled_dir(), filename))
+        if document is None:
+            cache_path = os.path.join(cache_dir, LIBRARY_VERSION, filename)
+            document = _read_document(cache_path)
+            if document is None:
+                document = _load_static_document(service_name, version)
+                if document is not None:
+                    try:
+                        _write_document(cache_path, document)
+                    except OSError as e:
+                        logging.warning("ディスカバリーキャッシュを保存できませんでした: %s", e)
+        if document is not None:
+            _documents[key] = document
+        return document
+
+
+def write_discovery_cache(directory: str = BUNDLED_DISCOVERY_DIR) -> list:
+    """
+    DISCOVERY_APIS のドキュメントを解析済みの形で directory に書き出します（ビルドスクリプト用）。
+    書き出したファイルのパスを返します。
+    """
+    paths = []
+    for service_name, version in DISCOVERY_APIS:
+        document = _load_static_document(service_name, version)
+        if document is None:
+            logging.warning("ディスカバリードキュメントが見つかりません: %s %s", service_name, version)
+            continue
+        path = os.path.join(directory, _document_filename(service_name, version))
+        _write_document(path, document)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    for written in write_discovery_cache(sys.argv[1] if len(sys.argv) > 1 else BUNDLED_DISCOVERY_DIR):
+        print(f"✅ {written}")
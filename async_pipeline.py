@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+シートの読み込みから画像ダウンロード・A列への書き込みまでを1スレッドで並行に行う asyncio パイプライン
+"""
+
+import os
+import asyncio
+import logging
+import concurrent.futures
+
+import httplib2
+from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from drive_lookup import (
+    folder_search_request, match_folder_names, chunk_folder_names, parent_images_request, pick_first_images,
+    chunk_parent_ids, resolve_folders_by_skus, folder_id_from_url, folder_url_from_id,
+)
+from drive_clients import build_service, get_drive_client_pool
+from download_engine import DOWNLOADED, SKIPPED, FAILED, STOPPED
+from download_manifest import CURRENT, CHANGED
+from drive_download import DOWNLOAD_CHUNK_SIZE, PartialDownload, backoff_delay
+from result_cache import cached_image
+from rate_limiter import (
+    drive_rate_limiter, sheets_read_rate_limiter, sheets_write_rate_limiter, is_rate_limit_error,
+    QuotaExceededError, MAX_BATCH_SIZE,
+)
+
+# config.json の engine に指定できる値（threads: スレッドで処理 / async: このパイプラインで処理）
+ENGINES = ('threads', 'async')
+DEFAULT_ENGINE = 'threads'
+# 段階ごとの同時実行数（config.json の async_concurrency で変更）
+# chunks は同時に処理する100行のチャンクの数（残りのチャンクはキューで待つ）
+DEFAULT_ASYNC_CONCURRENCY = {'chunks': 8, 'search': 4, 'listing': 8, 'download': 32}
+# A列への書き込みをまとめる行数
+WRITE_BATCH_SIZE = 500
+# 応答の読み込みが止まってからタイムアウトするまでの秒数
+HTTP_TIMEOUT = 120
+
+
+class AsyncGoogleClient:
+    """
+    googleapiclient で組み立てたリクエスト（HttpRequest）を aiohttp で送信するクライアント。
+
+    ・URI・ヘッダー・本文は googleapiclient が作ったものをそのまま送ります。
+    ・応答の解析はリクエストの postproc に任せるため、エラーは同期版と同じ HttpError になり、
+      is_rate_limit_error でスロットリングを判定できます。
+    ・アクセストークンの更新は別スレッドで行い、同時に必要になっても1回だけ実行します。
+    """
+
+    def __init__(self, creds, session):
+        self.creds = creds
+        self.session = session
+        self._refresh_lock = asyncio.Lock()
+
+    async def _refresh(self, stale_token=None):
+        async with self._refresh_lock:
+            # 待っている間に他のタスクが更新済みなら何もしない
+            if self.creds.valid and self.creds.token != stale_token:
+                return
+            await asyncio.to_thread(self.creds.refresh, Request())
+
+    async def _send(self, request, headers=None):
+        for attempt in range(2):
+            if not self.creds.valid:
+                await self._refresh()
+            headers = dict(headers or request.headers)
+            token = self.creds.token
+            self.creds.apply(headers)
+            async with self.session.request(request.method, request.uri, data=request.body,
+                                            headers=headers) as resp:
+                content = await resp.read()
+                status = resp.status
+                resp_headers = dict(resp.headers)
+            if status == 401 and attempt == 0:
+                # 期限前に失効したトークンは1回だけ更新して送り直す
+                await self._refresh(stale_token=token)
+                continue
+            break
+        return httplib2.Response({'status': status, **resp_headers}), content
+
+    async def execute(self, request, limiter, max_retries: int = 6, max_backoff: float = 64.0):
+        """
+        execute_with_backoff の asyncio 版です。
+        スロットリング応答はリミッターに通知して指数バックオフで再試行し、
+        max_retries 回失敗したら QuotaExceededError を送出します。
+        """
+        for attempt in range(max_retries + 1):
+            await limiter.acquire_async()
+            resp, content = await self._send(request)
+            try:
+                result = request.postproc(resp, content)
+            except HttpError as e:
+                if not is_rate_limit_error(e):
+                    raise
+                await self._back_off(limiter, e, attempt, max_retries, max_backoff)
+                continue
+            limiter.on_success()
+            return result
+
+    async def _back_off(self, limiter, error, attempt: int, max_retries: int, max_backoff: float):
+        await limiter.on_throttle_async()
+        if attempt == max_retries:
+            raise QuotaExceededError(f"{limiter.name} API のクォータ超過が解消しませんでした: {error}") from error
+        sleep_time = backoff_delay(attempt, max_backoff)
+        logging.warning("%s API のスロットリング（試行 %d/%d）。%.1f秒後に再試行します。",
+                        limiter.name, attempt + 1, max_retries, sleep_time)
+        await asyncio.sleep(sleep_time)
+
+    async def download_media(self, request, file_id: str, save_path: str, limiter, md5_checksum: str = None,
+                             size=None, chunk_size: int = DOWNLOAD_CHUNK_SIZE, max_retries: int = 6,
+                             max_backoff: float = 64.0) -> tuple:
+        """
+        files.get_media のリクエストを chunk_size ずつ Range 付きで取得して save_path に保存し、
+        (保存したバイト数, md5) を返します（download_drive_file の asyncio 版）。
+        スロットリングの場合は取得済みの位置から再試行します。
+        .part の続きからの取得・取得元の確認・md5 の照合は同期版と同じ PartialDownload で行います。
+        """
+        part = PartialDownload(save_path, file_id, md5_checksum, size, chunk_size)
+        # 残っていた .part の md5 の計算はファイルの読み込みなので、イベントループの外で行う
+        await asyncio.to_thread(part.open)
+        try:
+            attempt = 0
+            while not part.done:
+                await limiter.acquire_async()
+                resp, content = await self._send(request, part.range_headers(request.headers))
+                try:
+                    part.feed(resp, content, request.uri)
+                except HttpError as e:
+                    if not is_rate_limit_error(e):
+                        raise
+                    await self._back_off(limiter, e, attempt, max_retries, max_backoff)
+                    attempt += 1
+                    continue
+                limiter.on_success()
+                attempt = 0
+        finally:
+            part.close()
+        return await asyncio.to_thread(part.finish)
+
+
+class AsyncPipeline:
+    """
+    1回のシート読み込みから、SKU のフォルダ解決・A列への書き込み・先頭画像の検索・ダウンロードまでを
+    100行ずつのチャンクに分けて並行に進めるパイプライン。
+
+    ・各段階の同時実行数は asyncio.Semaphore で制限し（concurrency）、API 呼び出しは共有のレートリミッターを通します。
+    ・同じ SKU・同じフォルダの検索は、複数のチャンクに出てきても1回だけ行います。
+    ・先頭画像は親フォルダを OR でまとめた一覧（image_listing の bulk と同じ方法）で検索します。
+    ・should_stop() が真になると、新しいチャンクとダウンロードを開始しません。
+    """
+
+    def __init__(self, client: AsyncGoogleClient, creds, spreadsheet_id: str, sheet_name: str, download_dir: str,
+                 folder_index=None, roots=None, result_cache=None, manifest=None, blob_store=None,
+                 concurrency: dict = None,
+                 should_stop=None, log=None):
+        self.client = client
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.download_dir = download_dir
+        self.folder_index = folder_index
+        self.roots = roots
+        self.result_cache = result_cache
+        self.manifest = manifest
+        self.blob_store = blob_store
+        self._should_stop = should_stop or (lambda: False)
+        self._log = log or logging.info
+        # リクエストの組み立てにだけ使うクライアント（送信は AsyncGoogleClient が行う）
+        self.drive = build_service('drive', 'v3', creds)
+        self.sheets = build_service('sheets', 'v4', creds)
+        # 検索結果キャッシュの再検証は同期 API のため、別スレッドでプールのクライアントを使う
+        self.drive_pool = get_drive_client_pool(creds)
+        concurrency = {**DEFAULT_ASYNC_CONCURRENCY, **(concurrency or {})}
+        self._chunk_workers = max(1, int(concurrency['chunks']))
+        self._search_slots = asyncio.Semaphore(max(1, int(concurrency['search'])))
+        self._listing_slots = asyncio.Semaphore(max(1, int(concurrency['listing'])))
+        self._download_slots = asyncio.Semaphore(max(1, int(concurrency['download'])))
+        # 共有ストアの確認・登録（BlobStore.fetch）はファイル操作なので、ダウンロードの同時実行数と同じスレッドで行う
+        self._blob_executor = None
+        if blob_store is not None:
+            self._blob_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, int(concurrency['download'])), thread_name_prefix='blob'
+            )
+        self._write_lock = asyncio.Lock()
+        self._folders = {}
+        self._images = {}
+        self._claimed = set()
+        self._updates = []
+        self.counts = {'urls': 0, DOWNLOADED: 0, SKIPPED: 0, FAILED: 0, STOPPED: 0}
+
+    def _future(self, value):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        return future
+
+    async def run(self, start_row: int = 2) -> dict:
+        resp = await self.client.execute(self.sheets.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{self.sheet_name}!A{start_row}:E"
+        ), sheets_read_rate_limiter)
+
+        rows = []
+        for idx, row in enumerate(resp.get('values', []), start=start_row):
+            folder_url = row[0].strip() if len(row) > 0 else ""
+            sku = row[3] if len(row) > 3 else ""
+            save_name = row[4] if len(row) > 4 else ""
+            if folder_url or sku:
+                rows.append((idx, folder_url, sku, save_name))
+        self._log(f"📊 処理対象: {len(rows)}行")
+
+        if self.result_cache is not None:
+            await self._load_result_cache([sku for _, _, sku, _ in rows if sku])
+
+        # 全チャンクを一度に開始せず、chunks 個のワーカーがキューから順に取り出して処理する
+        queue = asyncio.Queue()
+        for i in range(0, len(rows), MAX_BATCH_SIZE):
+            queue.put_nowait(rows[i:i + MAX_BATCH_SIZE])
+        try:
+            await asyncio.gather(*(self._chunk_worker(queue) for _ in range(min(self._chunk_workers, queue.qsize()))))
+        finally:
+            if self._blob_executor is not None:
+                self._blob_executor.shutdown(wait=True)
+        await self._flush_updates(force=True)
+        return dict(self.counts)
+
+    async def _chunk_worker(self, queue: asyncio.Queue):
+        while True:
+            try:
+                chunk = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self._process_chunk(chunk)
+
+    async def _load_result_cache(self, skus):
+        # キャッシュ済みのフォルダ・先頭画像と、再検索の時期が来ていない「見つからなかった」SKUを先に登録する
+        try:
+            cached = await asyncio.to_thread(self.result_cache.lookup, self.drive_pool, skus, drive_rate_limiter.acquire)
+            missing = await asyncio.to_thread(self.result_cache.missing, [sku for sku in skus if sku not in cached])
+        except Exception as e:
+            self._log(f"❌ 検索結果キャッシュの読み込みでエラー: {e}")
+            return
+        for sku, entry in cached.items():
+            self._folders[sku] = self._future(entry['folder_id'])
+            if entry['image_id'] and entry['folder_id'] not in self._images:
+                self._images[entry['folder_id']] = self._future(cached_image(entry))
+        for sku, folder_id in missing.items():
+            if folder_id is None:
+                self._folders[sku] = self._future(None)
+            elif folder_id not in self._images:
+                self._images[folder_id] = self._future(None)
+        self._log(f"✅ キャッシュから解決: フォルダ {len(cached)}件, 前回見つからなかったSKU {len(missing)}件")
+
+    async def _process_chunk(self, chunk):
+        if self._should_stop():
+            return
+
+        # A列が空の行は、D列のSKUからフォルダを解決して書き込む
+        folders = await self._resolve_folders([sku for _, folder_url, sku, _ in chunk if not folder_url and sku])
+        for idx, folder_url, sku, _ in chunk:
+            if not folder_url and isinstance(folders.get(sku), str):
+                self._updates.append({
+                    'range': f"{self.sheet_name}!A{idx}",
+                    'values': [[folder_url_from_id(folders[sku])]]
+                })
+        await self._flush_updates()
+
+        targets = []
+        for idx, folder_url, sku, save_name in chunk:
+            folder_id = folder_id_from_url(folder_url) if folder_url else folders.get(sku)
+            if isinstance(folder_id, Exception):
+                # 検索に失敗したSKUは「見つからない」とは扱わず、エラーとして記録する
+                self._record(idx, save_name, FAILED, folder_id)
+                continue
+            if not folder_id:
+                if folder_url:
+                    self._record(idx, save_name, FAILED, f"フォルダIDの抽出に失敗: {folder_url}")
+                else:
+                    self._record(idx, save_name, FAILED, f"SKU '{sku}' に対応するフォルダが見つかりません")
+                continue
+            if not save_name:
+                self._log(f"⚠️ Row {idx}: E列（保存名）が空です。スキップします。")
+                continue
+            save_path = os.path.join(self.download_dir, f"{save_name}.jpg")
+            # 同じ保存名の行が複数ある場合は、先に受け付けた方を残す
+            # 台帳がある場合は、既存のファイルも先頭画像を調べてから判定する
+            if save_path in self._claimed or (self.manifest is None and os.path.exists(save_path)):
+                self._record(idx, save_name, SKIPPED)
+                continue
+            self._claimed.add(save_path)
+            targets.append((idx, sku, save_name, save_path, folder_id))
+        if not targets or self._should_stop():
+            return
+
+        images = await self._first_images([folder_id for _, _, _, _, folder_id in targets])
+        await self._store_images(targets, images)
+        downloads = []
+        for idx, _, save_name, save_path, folder_id in targets:
+            first_file = images.get(folder_id)
+            if isinstance(first_file, Exception):
+                self._record(idx, save_name, FAILED, first_file)
+            elif not first_file:
+                self._record(idx, save_name, FAILED, f"フォルダ {folder_id} に画像が見つかりません")
+            else:
+                state = None
+                if self.manifest is not None:
+                    state = await asyncio.to_thread(self.manifest.check, save_path, first_file['id'],
+                                                    first_file.get('md5Checksum'), first_file.get('size'))
+                if state == CURRENT:
+                    self._record(idx, save_name, SKIPPED)
+                    continue
+                if state == CHANGED:
+                    self._log(f"🔄 Row {idx}: {save_name}.jpg の元の画像が変わったため、再ダウンロードします")
+                downloads.append(self._download(idx, save_name, save_path, first_file['id'],
+                                                first_file.get('md5Checksum')))
+        await asyncio.gather(*downloads)
+
+    async def _resolve_folders(self, skus) -> dict:
+        owned = []
+        for sku in dict.fromkeys(skus):
+            if sku not in self._folders:
+                self._folders[sku] = asyncio.get_running_loop().create_future()
+                owned.append(sku)
+        if owned:
+            try:
+                found = await self._lookup_folders(owned)
+            except Exception as e:
+                # 例外は Future に残し、このSKUを待つ行はエラーとして扱う（「見つからない」とはしない）
+                self._log(f"❌ SKU検索でエラー: {e}")
+                for sku in owned:
+                    self._folders[sku].set_exception(e)
+            else:
+                for sku in owned:
+                    self._folders[sku].set_result(found.get(sku))
+        folders = {}
+        for sku in skus:
+            try:
+                folders[sku] = await self._folders[sku]
+            except Exception as e:
+                folders[sku] = e
+        return folders
+
+    async def _lookup_folders(self, skus) -> dict:
+        if self.roots is not None:
+            results = resolve_folders_by_skus(None, skus, roots=self.roots)
+        else:
+            results = {sku: None for sku in skus}
+            if self.folder_index is not None:
+                results.update(self.folder_index.lookup_many(skus))
+            pending = [sku for sku in skus if results[sku] is None]
+            found = {}
+            for chunk_found in await asyncio.gather(*(self._search_folders(chunk)
+                                                      for chunk in chunk_folder_names(pending))):
+                found.update(chunk_found)
+            results.update(found)
+            if self.folder_index is not None:
+                # インデックスへの追記は SQLite への書き込みなので、イベントループを止めないよう別スレッドで行う
+                await asyncio.to_thread(self.folder_index.add, found)
+        if self.result_cache is not None:
+            try:
+                await asyncio.to_thread(self.result_cache.store, self.drive_pool, {
+                    sku: (folder_id, None) for sku, folder_id in results.items() if folder_id
+                }, drive_rate_limiter.acquire)
+                await asyncio.to_thread(self.result_cache.record_misses,
+                                        {sku: None for sku, folder_id in results.items() if not folder_id},
+                                        self.roots)
+            except Exception as e:
+                self._log(f"❌ 検索結果キャッシュの保存でエラー: {e}")
+        return results
+
+    async def _search_folders(self, names) -> dict:
+        found = {}
+        page_token = None
+        async with self._search_slots:
+            while True:
+                resp = await self.client.execute(folder_search_request(self.drive, names, page_token), drive_rate_limiter)
+                match_folder_names(names, resp.get('files', []), found)
+                page_token = resp.get('nextPageToken')
+                if not page_token:
+                    break
+        return found
+
+    async def _first_images(self, folder_ids) -> dict:
+        owned = []
+        for folder_id in dict.fromkeys(folder_ids):
+            if folder_id not in self._images:
+                self._images[folder_id] = asyncio.get_running_loop().create_future()
+                owned.append(folder_id)
+        await asyncio.gather(*(self._list_images(chunk) for chunk in chunk_parent_ids(owned)))
+        images = {}
+        for folder_id in folder_ids:
+            try:
+                images[folder_id] = await self._images[folder_id]
+            except Exception as e:
+                images[folder_id] = e
+        return images
+
+    async def _list_images(self, folder_ids):
+        files = []
+        page_token = None
+        try:
+            async with self._listing_slots:
+                while True:
+                    resp = await self.client.execute(parent_images_request(self.drive, folder_ids, page_token),
+                                                     drive_rate_limiter)
+                    files.extend(resp.get('files', []))
+                    page_token = resp.get('nextPageToken')
+                    if not page_token:
+                        break
+        except Exception as e:
+            for folder_id in folder_ids:
+                self._images[folder_id].set_exception(e)
+            return
+        for folder_id, first_file in pick_first_images(folder_ids, files).items():
+            self._images[folder_id].set_result(first_file)
+
+    async def _store_images(self, targets, images):
+        if self.result_cache is None:
+            return
+        found = {sku: (folder_id, images[folder_id]) for _, sku, _, _, folder_id in targets
+                 if sku and isinstance(images.get(folder_id), dict)}
+        misses = {sku: folder_id for _, sku, _, _, folder_id in targets
+                  if sku and folder_id in images and images[folder_id] is None}
+        try:
+            await asyncio.to_thread(self.result_cache.store, self.drive_pool, found, drive_rate_limiter.acquire)
+            await asyncio.to_thread(self.result_cache.record_misses, misses)
+        except Exception as e:
+            self._log(f"❌ 検索結果キャッシュの保存でエラー: {e}")
+
+    async def _download(self, idx, save_name: str, save_path: str, file_id: str, md5_checksum: str = None):
+        async with self._download_slots:
+            if self._should_stop():
+                self._record(idx, save_name, STOPPED)
+                return
+            try:
+                if self.blob_store is not None:
+                    # 共有ストアのリンク・登録と同じ画像の取得のまとめ方は同期版と同じ BlobStore.fetch に任せ、
+                    # ストアにない画像の取得だけをイベントループに戻して行う
+                    loop = asyncio.get_running_loop()
+
+                    def download(file_id, save_path, md5_checksum):
+                        return asyncio.run_coroutine_threadsafe(
+                            self._download_media(file_id, save_path, md5_checksum), loop
+                        ).result()
+
+                    size, md5 = await loop.run_in_executor(self._blob_executor, self.blob_store.fetch,
+                                                           download, file_id, save_path, md5_checksum)
+                else:
+                    size, md5 = await self._download_media(file_id, save_path, md5_checksum)
+                if self.manifest is not None:
+                    await asyncio.to_thread(self.manifest.record, save_path, file_id, size, md5)
+            except Exception as e:
+                self._record(idx, save_name, FAILED, e)
+            else:
+                self._record(idx, save_name, DOWNLOADED)
+
+    async def _download_media(self, file_id: str, save_path: str, md5_checksum: str = None) -> tuple:
+        # 公開リンクではなく認証済みの files.get_media でチャンクごとに取得する
+        return await self.client.download_media(self.drive.files().get_media(fileId=file_id), file_id, save_path,
+                                                drive_rate_limiter, md5_checksum)
+
+    def _record(self, idx, save_name, status, error=None):
+        self.counts[status] += 1
+        if status == DOWNLOADED:
+            self._log(f"✅ Row {idx}: {save_name}.jpg をダウンロードしました")
+        elif status == SKIPPED:
+            self._log(f"⏭️ Row {idx}: {save_name}.jpg は既に存在します。スキップします。")
+        elif status == FAILED:
+            self._log(f"❌ Row {idx}: {error}")
+
+    async def _flush_updates(self, force: bool = False):
+        # A列への書き込みは WRITE_BATCH_SIZE 行ごと（最後は残り全部）にまとめる
+        async with self._write_lock:
+            while self._updates and (force or len(self._updates) >= WRITE_BATCH_SIZE):
+                batch, self._updates = self._updates[:WRITE_BATCH_SIZE], self._updates[WRITE_BATCH_SIZE:]
+                try:
+                    await self.client.execute(self.sheets.spreadsheets().values().batchUpdate(
+                        spreadsheetId=self.spreadsheet_id,
+                        body={'valueInputOption': 'RAW', 'data': batch}
+                    ), sheets_write_rate_limiter)
+                    self.counts['urls'] += len(batch)
+                    self._log(f"✅ A列にURLを記載しました: {len(batch)}行")
+                except Exception as e:
+                    self._log(f"❌ A列の書き込みでエラー: {e}")
+
+
+async def run_pipeline_async(creds, spreadsheet_id: str, sheet_name: str, start_row: int = 2,
+                             download_dir: str = None, concurrency: dict = None, **kwargs) -> dict:
+    """aiohttp のセッションを開いてパイプラインを最後まで実行し、結果の件数を返します。"""
+    concurrency = {**DEFAULT_ASYNC_CONCURRENCY, **(concurrency or {})}
+    # 接続プールは全段階の同時実行数の合計まで keep-alive で保持する
+    connector = aiohttp.TCPConnector(limit=sum(int(value) for value in concurrency.values()))
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=HTTP_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pipeline = AsyncPipeline(AsyncGoogleClient(creds, session), creds, spreadsheet_id, sheet_name,
+                                 download_dir or os.path.abspath("downloaded_images"),
+                                 concurrency=concurrency, **kwargs)
+        return await pipeline.run(start_row)
+
+
+def run_pipeline(creds, spreadsheet_id: str, sheet_name: str, start_row: int = 2, download_dir: str = None,
+                 **kwargs) -> dict:
+    """
+    同期コード（CLI・Web 版の実行スレッド）から asyncio パイプラインを実行します。
+    kwargs は AsyncPipeline の folder_index・roots・result_cache・manifest・blob_store・should_stop・log と concurrency です。
+    """
+    if aiohttp is None:
+        raise RuntimeError("engine=async には aiohttp が必要です（pip install aiohttp）")
+    return asyncio.run(run_pipeline_async(creds, spreadsheet_id, sheet_name, start_row, download_dir, **kwargs))
+
+
+def format_pipeline_counts(counts: dict) -> str:
+    """パイプラインの結果の件数をログ表示用の文字列にします。"""
+    summary = (f"{counts['urls']}行のURLを記載, {counts[DOWNLOADED]}個ダウンロード, "
+               f"{counts[SKIPPED]}個スキップ, {counts[FAILED]}個エラー")
+    if counts[STOPPED]:
+        summary += f", {counts[STOPPED]}個未実行（停止）"
+    return summary
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ダウンロードした画像を md5 で1つだけ保存し、各ダウンロード先からハードリンクする共有ストア
+"""
+
+import os
+import shutil
+import logging
+import threading
+
+from singleflight import SingleFlight
+
+DEFAULT_BLOB_STORE_PATH = os.path.join(os.path.expanduser("~"), ".gdrive_image_downloader", "blobs")
+
+
+class BlobStore:
+    """
+    画像の内容を md5 ごとに1ファイルだけ保存するストア（config.json の blob_store）。
+
+    ・blobs/<md5の先頭2文字>/<md5> に内容を、ids/<ファイルID> にそのファイルの md5 を保存します。
+    ・同じ画像が別の保存名・別のダウンロード先で必要になった場合は、Drive から取得せずにストアからハードリンクします。
+      ハードリンクできない場合（別のドライブなど）はコピーします。
+    ・同じ画像を複数のスレッドが同時に必要とした場合も、取得は SingleFlight で1回にまとめます。
+    ・一時ファイルはスレッドごとに別の名前で作り、既にある blob は上書きしません。
+    ・ハードリンクしたファイルはストアと内容を共有するため、保存後に直接編集するとストア側も変わります。
+    """
+
+    def __init__(self, root: str = DEFAULT_BLOB_STORE_PATH):
+        self.root = root
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "ids"), exist_ok=True)
+        self._flights = SingleFlight()
+
+    def _blob_path(self, md5: str) -> str:
+        return os.path.join(self.root, "blobs", md5[:2], md5)
+
+    def _id_path(self, file_id: str) -> str:
+        return os.path.join(self.root, "ids", file_id)
+
+    @staticmethod
+    def _temp_path(path: str) -> str:
+        # 同じプロセスの別スレッドと重ならないよう、スレッドIDも含める
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def find(self, file_id: str, md5_checksum: str = None):
+        """
+        file_id（md5_checksum が分かればその md5）の画像がストアにあれば (パス, md5) を、なければ None を返します。
+        """
+        md5 = md5_checksum
+        if not md5:
+            try:
+                with open(self._id_path(file_id), encoding='ascii') as f:
+                    md5 = f.read().strip()
+            except OSError:
+                return None
+        path = self._blob_path(md5)
+        return (path, md5) if md5 and os.path.exists(path) else None
+
+    def link(self, blob_path: str, save_path: str):
+        """ストアの画像を save_path にハードリンク（できなければコピー）します。既存の save_path は置き換えます。"""
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+        if os.path.exists(save_path) and os.path.samefile(blob_path, save_path):
+            return
+        tmp_path = self._temp_path(save_path)
+        try:
+            try:
+                os.link(blob_path, tmp_path)
+            except OSError:
+                shutil.copyfile(blob_path, tmp_path)
+            os.replace(tmp_path, save_path)
+        finally:
+            # 同じ inode 同士の置き換えは何もせずに成功するため、一時ファイルが残ることがある
+            _remove(tmp_path)
+
+    def add(self, save_path: str, file_id: str, md5: str):
+        """ダウンロードした save_path の画像をストアに登録します（ストア側からハードリンク、できなければコピー）。"""
+        path = self._blob_path(md5)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 既に同じ md5 の blob があれば（他のスレッドが先に登録した場合も）そのまま使う
+        try:
+            os.link(save_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            tmp_path = self._temp_path(path)
+            try:
+                shutil.copyfile(save_path, tmp_path)
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                _remove(tmp_path)
+        id_path = self._id_path(file_id)
+        tmp_path = self._temp_path(id_path)
+        try:
+            with open(tmp_path, 'w', encoding='ascii') as f:
+                f.write(md5)
+            os.replace(tmp_path, id_path)
+        except BaseException:
+            _remove(tmp_path)
+            raise
+
+    def fetch(self, download, file_id: str, save_path: str, md5_checksum: str = None) -> tuple:
+        """
+        ストアにあればハードリンクし、なければ download(file_id, save_path, md5_checksum) で取得してストアに登録します。
+        (サイズ, md5) を返します。
+        """
+        found = self.find(file_id, md5_checksum)
+        if found:
+            blob_path, md5 = found
+            self.link(blob_path, save_path)
+            logging.info("共有ストアからリンクしました: %s", save_path)
+            return os.path.getsize(save_path), md5
+        try:
+            owner_path, size, md5 = self._flights.do(
+                file_id, lambda: (save_path, *self._download(download, file_id, save_path, md5_checksum))
+            )
+        finally:
+            # 登録が済めば以降は find で見つかるため、結果を持ち続けない
+            self._flights.forget(file_id)
+        if owner_path != save_path:
+            # 他のスレッドが取得した画像をリンクする（ストアに登録できていなければその保存先から）
+            found = self.find(file_id, md5)
+            self.link(found[0] if found else owner_path, save_path)
+        return size, md5
+
+    def _download(self, download, file_id: str, save_path: str, md5_checksum: str = None) -> tuple:
+        size, md5 = download(file_id, save_path, md5_checksum)
+        try:
+            self.add(save_path, file_id, md5)
+        except OSError as e:
+            logging.warning("共有ストアに登録できませんでした（%s）: %s", save_path, e)
+        return size, md5
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_blob_store(config: dict):
+    """
+    config.json の blob_store 設定に従って共有ストアを開きます。未設定か false なら使いません。
+    true ならホームディレクトリの既定の場所、文字列ならそのディレクトリを使います。
+    """
+    settings = config.get('blob_store', False)
+    if not settings:
+        return None
+    try:
+        return BlobStore(settings if isinstance(settings, str) else DEFAULT_BLOB_STORE_PATH)
+    except OSError as e:
+        logging.warning("共有ストアを開けませんでした。共有ストアなしで実行します: %s", e)
+        return None
@@ -7,6 +7,8 @@ import subprocess
 import shutil
 import platform
 
+from api_discovery import write_discovery_cache, BUNDLED_DISCOVERY_DIR
+
 def build_web_gui():
     """Web版GUIアプリケーションをビルド（クロスプラットフォーム対応）"""
     print("🌐 Web版GUIアプリケーションのビルドを開始します...")
@@ -15,6 +17,10 @@ def build_web_gui():
     current_platform = platform.system()
     print(f"🖥️ プラットフォーム: {current_platform}")
     
+    # 解析済みのディスカバリードキュメントを書き出して同梱する（起動時の解析を省く）
+    for path in write_discovery_cache(BUNDLED_DISCOVERY_DIR):
+        print(f"✅ {path} を作成しました")
+    
     # PyInstallerコマンドを構築
     cmd = [
         'pyinstaller',
@@ -24,6 +30,7 @@ def build_web_gui():
         '--add-data=README.md:.',
         '--add-data=USAGE_GUIDE.md:.',
         '--add-data=request.py:.',
+        f'--add-data={BUNDLED_DISCOVERY_DIR}:{BUNDLED_DISCOVERY_DIR}',
         '--exclude-module=backports',
         '--exclude-module=jaraco',
         '--exclude-module=pkg_resources',
@@ -79,6 +86,20 @@ def create_web_gui_package(platform_name):
         (dist_path, executable_name),
         ('client_secret.json', 'client_secret.json'),
         ('request.py', 'request.py'),
+        ('rate_limiter.py', 'rate_limiter.py'),
+        ('planner.py', 'planner.py'),
+        ('drive_lookup.py', 'drive_lookup.py'),
+        ('folder_index.py', 'folder_index.py'),
+        ('result_cache.py', 'result_cache.py'),
+        ('singleflight.py', 'singleflight.py'),
+        ('drive_clients.py', 'drive_clients.py'),
+        ('http_transport.py', 'http_transport.py'),
+        ('api_discovery.py', 'api_discovery.py'),
+        ('download_engine.py', 'download_engine.py'),
+        ('async_pipeline.py', 'async_pipeline.py'),
+        ('drive_download.py', 'drive_download.py'),
+        ('download_manifest.py', 'download_manifest.py'),
+        ('blob_store.py', 'blob_store.py'),
         ('README.md', 'README.md'),
         ('USAGE_GUIDE.md', 'USAGE_GUIDE.md'),
         ('config.json', 'config.json')
@@ -58,7 +58,8 @@ if %errorlevel% neq 0 (
 
 echo.
 echo Building Windows application...
-pyinstaller --onefile --console --name=GoogleDriveDownloaderWeb --add-data=README.md:. --add-data=USAGE_GUIDE.md:. --add-data=request.py:. --exclude-module=backports --exclude-module=jaraco --exclude-module=pkg_resources --exclude-module=tkinter --exclude-module=matplotlib --exclude-module=numpy simple_gui.py
+python api_discovery.py discovery
+pyinstaller --onefile --console --name=GoogleDriveDownloaderWeb --add-data=README.md:. --add-data=USAGE_GUIDE.md:. --add-data=request.py:. --add-data=discovery:discovery --exclude-module=backports --exclude-module=jaraco --exclude-module=pkg_resources --exclude-module=tkinter --exclude-module=matplotlib --exclude-module=numpy simple_gui.py
 
 if %errorlevel% neq 0 (
     echo ERROR: Build failed
@@ -83,6 +84,20 @@ copy "README.md" "GoogleDriveDownloaderWeb_Package_Windows\"
 copy "USAGE_GUIDE.md" "GoogleDriveDownloaderWeb_Package_Windows\"
 copy "README_WINDOWS.md" "GoogleDriveDownloaderWeb_Package_Windows\"
 copy "request.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "rate_limiter.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "planner.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "drive_lookup.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "folder_index.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "result_cache.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "singleflight.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "drive_clients.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "http_transport.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "api_discovery.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "download_engine.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "async_pipeline.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "drive_download.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "download_manifest.py" "GoogleDriveDownloaderWeb_Package_Windows\"
+copy "blob_store.py" "GoogleDriveDownloaderWeb_Package_Windows\"
 
 REM Create Windows batch file
 echo @echo off > "GoogleDriveDownloaderWeb_Package_Windows\start_application.bat"
@@ -17,6 +17,20 @@ echo "📁 Windows用ビルドパッケージを作成中..."
 files_to_copy=(
     "simple_gui.py"
     "request.py"
+    "rate_limiter.py"
+    "planner.py"
+    "drive_lookup.py"
+    "folder_index.py"
+    "result_cache.py"
+    "singleflight.py"
+    "drive_clients.py"
+    "http_transport.py"
+    "api_discovery.py"
+    "download_engine.py"
+    "async_pipeline.py"
+    "drive_download.py"
+    "download_manifest.py"
+    "blob_store.py"
     "client_secret.json"
     "build_windows.bat"
     "requirements_windows.txt"
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+画像ダウンロードを並列数を制限して実行するエンジン
+"""
+
+import os
+import logging
+import threading
+import concurrent.futures
+
+from download_manifest import CURRENT, CHANGED
+
+# 同時にダウンロードする数（config.json の download_workers）
+DEFAULT_DOWNLOAD_WORKERS = 8
+# 停止要求を確認する間隔（秒）
+STOP_CHECK_INTERVAL = 0.5
+
+# ダウンロード結果の種類
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+STOPPED = 'stopped'
+
+
+def _log_result(idx, save_name, status, error):
+    # ダウンロード完了のログはダウンロード関数側で出す
+    if status == SKIPPED:
+        logging.info(f"Row {idx}: {save_name}.jpg already exists. Skipped.")
+    elif status == FAILED:
+        logging.error(f"Row {idx}: Download failed: {error}")
+
+
+class DownloadEngine:
+    """
+    画像のダウンロードを最大 workers 件まで並列に行うエンジン。
+
+    ・submit は実行待ちが workers の2倍に達すると空くまで待つため、画像検索とダウンロードが並行して進み、
+      メモリに積まれるジョブも一定数に収まります。
+    ・保存先が既に存在するか、同じ実行で既に受け付けた保存先はスキップします。
+    ・should_stop() が真になると新しいジョブを受け付けず、未開始のジョブは実行しません（実行中のものは完了を待ちます）。
+    ・結果は counts に集計し、1件ごとに on_result(行番号, 保存名, 結果, 例外) を呼び出します。
+    ・download は download(source, save_path, md5_checksum) の形で呼び出し、(サイズ, md5) を返します
+      （source は画像のファイルIDなど、md5_checksum は submit に渡された Drive の md5Checksum）。
+    ・manifest（DownloadManifest）を渡すと、保存先の存在ではなく台帳でスキップを判定し、
+      元の画像が変わった保存先は再ダウンロードします。完了したダウンロードは download の戻り値を記録します。
+    ・blob_store（BlobStore）を渡すと、ストアにある画像は download を呼ばずにハードリンクし、取得した画像はストアに登録します。
+    """
+
+    def __init__(self, download, workers: int = DEFAULT_DOWNLOAD_WORKERS, should_stop=None, on_result=None,
+                 manifest=None, blob_store=None):
+        self._download = download
+        self._manifest = manifest
+        self._blob_store = blob_store
+        self.workers = max(1, int(workers or DEFAULT_DOWNLOAD_WORKERS))
+        self._should_stop = should_stop or (lambda: False)
+        self._on_result = on_result or _log_result
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                               thread_name_prefix='download')
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._lock = threading.Lock()
+        self._claimed = set()
+        self.counts = {DOWNLOADED: 0, SKIPPED: 0, FAILED: 0, STOPPED: 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        self.close()
+
+    @property
+    def completed(self) -> int:
+        """結果が確定したジョブの数"""
+        with self._lock:
+            return sum(self.counts.values())
+
+    def _record(self, idx, save_name, status, error=None):
+        with self._lock:
+            self.counts[status] += 1
+        try:
+            self._on_result(idx, save_name, status, error)
+        except Exception as e:
+            logging.error(f"ダウンロード結果の通知でエラー: {e}")
+
+    def submit(self, idx, save_name: str, save_path: str, source, md5_checksum: str = None, size=None) -> bool:
+        """
+        ダウンロードを受け付けます。停止要求があって受け付けなかった場合は False を返します。
+        md5_checksum・size（Drive のメタデータ）を渡すと、台帳に記録した内容と比べてスキップを判定します。
+        """
+        if self._should_stop():
+            return False
+        with self._lock:
+            duplicate = save_path in self._claimed
+            self._claimed.add(save_path)
+        # 同じ保存名の行が複数ある場合は、先に受け付けた方を残す
+        if duplicate:
+            self._record(idx, save_name, SKIPPED)
+            return True
+        if self._manifest is not None:
+            state = self._manifest.check(save_path, source, md5_checksum, size)
+            if state == CURRENT:
+                self._record(idx, save_name, SKIPPED)
+                return True
+            if state == CHANGED:
+                logging.info(f"Row {idx}: {save_name}.jpg の元の画像が変わったため、再ダウンロードします。")
+        elif os.path.exists(save_path):
+            self._record(idx, save_name, SKIPPED)
+            return True
+
+        while not self._slots.acquire(timeout=STOP_CHECK_INTERVAL):
+            if self._should_stop():
+                return False
+        try:
+            self._executor.submit(self._run, idx, save_name, save_path, source, md5_checksum)
+        except BaseException:
+            self._slots.release()
+            raise
+        return True
+
+    def _run(self, idx, save_name, save_path, source, md5_checksum):
+        try:
+            if self._should_stop():
+                self._record(idx, save_name, STOPPED)
+                return
+            try:
+                if self._blob_store is not None:
+                    size, md5 = self._blob_store.fetch(self._download, source, save_path, md5_checksum)
+                else:
+                    size, md5 = self._download(source, save_path, md5_checksum)
+                if self._manifest is not None:
+                    self._manifest.record(save_path, source, size, md5)
+            except Exception as e:
+                self._record(idx, save_name, FAILED, e)
+            else:
+                self._record(idx, save_name, DOWNLOADED)
+        finally:
+            self._slots.release()
+
+    def close(self) -> dict:
+        """受け付けたジョブの完了を待ち、結果の件数を返します。"""
+        self._executor.shutdown(wait=True)
+        return dict(self.counts)
+
+
+def format_download_counts(counts: dict) -> str:
+    """ダウンロード結果の件数をログ表示用の文字列にします。"""
+    summary = f"{counts[DOWNLOADED]}個ダウンロード, {counts[SKIPPED]}個スキップ, {counts[FAILED]}個エラー"
+    if counts[STOPPED]:
+        summary += f", {counts[STOPPED]}個未実行（停止）"
+    return summary
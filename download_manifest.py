@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ダウンロード先ディレクトリごとの台帳（保存名 → 取得元のファイルID・サイズ・md5・取得時刻）
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from drive_download import file_md5
+from sqlite_readonly import connect_read_only
+
+# ダウンロード先ディレクトリに作成する台帳のファイル名
+MANIFEST_FILENAME = ".download_manifest.sqlite3"
+
+# check の結果（CURRENT: 取得済みで最新 / CHANGED: 元の画像が変わった / MISSING: 未取得）
+CURRENT = 'current'
+CHANGED = 'changed'
+MISSING = 'missing'
+
+
+class DownloadManifest:
+    """
+    ダウンロード先ディレクトリに SQLite で保存する、保存名ごとの取得記録。
+
+    ・起動時に台帳とディレクトリ内のファイル名（os.scandir で1回だけ一覧）をメモリに読み込むため、
+      行ごとに保存先の存在を確認（stat）しません。
+    ・記録するのはダウンロードが完了して保存名に置き換えた後なので、台帳にあるファイルは途中までのファイルではありません。
+    ・先頭画像の md5Checksum が分かる場合は記録した md5 と比べ、内容が同じならファイルIDが違ってもスキップします。
+      md5 が分からない場合は、サイズとファイルIDが記録と違えば元の画像が変わったものとして CHANGED を返します。
+    ・台帳にない既存のファイル（台帳を使う前に保存したもの）や md5 を記録していないファイルは、
+      md5Checksum と比べるときに一度だけ内容の md5 を計算して記録します。
+      md5Checksum が分からない台帳にない既存のファイルは、サイズが一致する場合だけ取得済みとみなします。
+    ・read_only=True の場合は保存済みの台帳を変更せずに開きます（get・recorded だけが使えます）。
+    """
+
+    def __init__(self, directory: str, filename: str = MANIFEST_FILENAME, read_only: bool = False):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self._filename = filename
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = connect_read_only(self.path)
+            if self._conn is None:
+                raise FileNotFoundError(self.path)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    name TEXT PRIMARY KEY,
+                    file_id TEXT,
+                    size INTEGER,
+                    md5 TEXT,
+                    downloaded_at REAL NOT NULL
+                );
+                """
+            )
+        self._entries = {
+            name: {'file_id': file_id, 'size': size, 'md5': md5, 'downloaded_at': downloaded_at}
+            for name, file_id, size, md5, downloaded_at in self._conn.execute(
+                "SELECT name, file_id, size, md5, downloaded_at FROM files"
+            )
+        }
+        self._names = self._scan()
+        logging.info("ダウンロード台帳を読み込みました: %d件記録, %d個のファイル", len(self._entries), len(self._names))
+
+    def _scan(self) -> set:
+        # DirEntry.is_file はディレクトリの一覧に含まれる種別を使うため、多くの環境でファイルごとの stat は不要
+        with os.scandir(self.directory) as entries:
+            # 台帳自身（とジャーナル）は数えない
+            return {entry.name for entry in entries if entry.is_file() and not entry.name.startswith(self._filename)}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, save_path: str):
+        """保存先の記録を dict で返します。記録がなければ None。"""
+        with self._lock:
+            entry = self._entries.get(os.path.basename(save_path))
+            return dict(entry) if entry else None
+
+    def recorded(self, save_path: str) -> bool:
+        """保存先が台帳に記録され、ディレクトリにも存在するかを返します。"""
+        name = os.path.basename(save_path)
+        with self._lock:
+            return name in self._entries and name in self._names
+
+    def check(self, save_path: str, file_id: str, md5_checksum: str = None, size=None) -> str:
+        """
+        保存先を file_id の画像（md5_checksum・size は Drive のメタデータ）で更新する必要があるかを
+        CURRENT・CHANGED・MISSING で返します。
+        台帳にない既存のファイルは、md5_checksum がなければサイズが size と一致する場合だけ file_id のものとして登録して
+        CURRENT を返し、一致しない（または size も分からない）場合は内容を確認できないため CHANGED を返します。
+        """
+        name = os.path.basename(save_path)
+        with self._lock:
+            if name not in self._names:
+                return MISSING
+            entry = self._entries.get(name)
+        if md5_checksum and not (entry and entry['md5']):
+            try:
+                md5 = file_md5(save_path).hexdigest()
+                local_size = os.path.getsize(save_path)
+            except OSError:
+                return MISSING
+            # 内容が違う場合は、ダウンロードし直すまで元のファイルIDのままにしておく
+            recorded_id = file_id if md5 == md5_checksum else (entry['file_id'] if entry else None)
+            self.record(save_path, recorded_id, local_size, md5)
+            return CURRENT if md5 == md5_checksum else CHANGED
+        if entry is None:
+            try:
+                local_size = os.path.getsize(save_path)
+            except OSError:
+                return MISSING
+            if size is None or int(size) != local_size:
+                return CHANGED
+            self.record(save_path, file_id, local_size)
+            return CURRENT
+        if md5_checksum:
+            if entry['md5'] != md5_checksum:
+                return CHANGED
+            if entry['file_id'] != file_id:
+                # 内容が同じ別のファイルに置き換わった場合は、ファイルIDだけ記録し直す
+                self.record(save_path, file_id, entry['size'], entry['md5'])
+            return CURRENT
+        if size is not None and entry['size'] is not None and int(size) != entry['size']:
+            return CHANGED
+        return CURRENT if entry['file_id'] == file_id else CHANGED
+
+    def record(self, save_path: str, file_id: str, size: int = None, md5: str = None):
+        """保存先に file_id の画像を保存したことを記録します。"""
+        name = os.path.basename(save_path)
+        entry = {'file_id': file_id, 'size': size, 'md5': md5, 'downloaded_at': time.time()}
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (name, file_id, size, md5, downloaded_at) VALUES (?, ?, ?, ?, ?)",
+                (name, file_id, size, md5, entry['downloaded_at'])
+            )
+            self._entries[name] = entry
+            self._names.add(name)
+
+
+def open_download_manifest(config: dict, download_dir: str, read_only: bool = False):
+    """
+    config.json の download_manifest 設定に従って download_dir の台帳を開きます。
+    false なら台帳を使わず、これまで通り保存先の存在だけでスキップを判定します。
+    read_only=True なら保存済みの台帳を変更せずに開き、まだなければ None を返します（--plan）。
+    """
+    if config.get('download_manifest', True) is False:
+        return None
+    if read_only and not os.path.exists(os.path.join(download_dir, MANIFEST_FILENAME)):
+        return None
+    try:
+        return DownloadManifest(download_dir, read_only=read_only)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning("ダウンロード台帳を開けませんでした。台帳なしで実行します: %s", e)
+        return None
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+並列ワーカー用の Drive API クライアントプール
+"""
+
+import logging
+import threading
+
+import google_auth_httplib2
+from googleapiclient.discovery import build, build_from_document, Resource
+from googleapiclient.http import build_http
+
+from api_discovery import load_discovery_document
+from http_transport import get_authorized_http
+
+# (API名, バージョン) ごとに一度だけ構築するクライアントのひな形
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def _get_template(service_name: str, version: str):
+    with _templates_lock:
+        template = _templates.get((service_name, version))
+        if template is None:
+            document = load_discovery_document(service_name, version)
+            if document is None:
+                return None
+            # ひな形自体はリクエストに使わないため、認証なしの接続で構築する
+            template = build_from_document(document, http=build_http())
+            _templates[(service_name, version)] = template
+        return template
+
+
+def _clone_service(template, http):
+    # Resource の pickle 用の状態を使い、解析済みのドキュメント・スキーマを共有したまま接続だけを差し替える
+    state = template.__getstate__()
+    state['_http'] = http
+    client = Resource.__new__(Resource)
+    client.__setstate__(state)
+    return client
+
+
+def build_service(service_name: str, version: str, creds):
+    """
+    Google API クライアントを作成します。
+    解析済みのディスカバリードキュメントから構築したひな形を複製するため、2つ目以降はほぼ即座に作成できます。
+    http_transport が requests なら、認証情報ごとに共有する keep-alive 接続プールを使います。
+    """
+    http = get_authorized_http(creds)
+    template = _get_template(service_name, version)
+    if template is None:
+        # ディスカバリードキュメントが見つからない場合は googleapiclient に任せる
+        if http is not None:
+            return build(service_name, version, http=http)
+        return build(service_name, version, credentials=creds)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+    return _clone_service(template, http)
+
+
+class DriveClientPool:
+    """
+    ワーカースレッドごとに専用の Drive クライアントを渡すプール。
+
+    ・httplib2 ベースのクライアントはスレッドセーフではないため、1つのクライアントを同時に使うのは1スレッドだけです。
+      requests 方式（http_transport）では、各クライアントが共有の接続プールを使います。
+    ・終了したスレッドのクライアントは回収して次のスレッドに渡すため、ThreadPoolExecutor を作り直しても
+      クライアントを作り直す必要はありません（作成数は同時に動くスレッド数まで）。
+    """
+
+    def __init__(self, creds, build_client=None):
+        self.creds = creds
+        self._build_client = build_client or (lambda creds: build_service('drive', 'v3', creds))
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._idle = []
+        self.created = 0
+
+    def _reclaim(self):
+        for thread in [thread for thread in self._clients if not thread.is_alive()]:
+            self._idle.append(self._clients.pop(thread))
+
+    def get(self):
+        """現在のスレッド専用のクライアントを返します。"""
+        thread = threading.current_thread()
+        with self._lock:
+            client = self._clients.get(thread)
+            if client is not None:
+                return client
+            self._reclaim()
+            if self._idle:
+                client = self._idle.pop()
+                self._clients[thread] = client
+                return client
+        client = self._build_client(self.creds)
+        with self._lock:
+            self._clients[thread] = client
+            self.created += 1
+            logging.debug("Drive クライアントを作成しました（%d個目）。", self.created)
+        return client
+
+    def __call__(self):
+        # resolve_folders_by_skus などの「スレッドごとのサービスを返す関数」としてそのまま渡せる
+        return self.get()
+
+
+# 認証情報ごとに共有するプール
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_drive_client_pool(creds) -> DriveClientPool:
+    """認証情報に対応する共有のクライアントプールを返します。"""
+    with _pools_lock:
+        pool = _pools.get(id(creds))
+        if pool is None or pool.creds is not creds:
+            pool = DriveClientPool(creds)
+            _pools[id(creds)] = pool
+        return pool
+
+
+def get_drive_client(creds):
+    """共有プールから、現在のスレッド専用の Drive クライアントを返します。"""
+    return get_drive_client_pool(creds).get()
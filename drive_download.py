@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Drive API（files.get_media）による画像ダウンロード
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from rate_limiter import drive_rate_limiter, is_rate_limit_error, QuotaExceededError
+
+# 1回のリクエストで取得するバイト数（大きな元画像は複数回に分けて Range で取得する）
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# 5xx・通信エラーを再試行する回数
+MEDIA_NUM_RETRIES = 3
+# ダウンロード中のファイルに付ける拡張子（完了すると保存名に置き換える）
+PART_SUFFIX = '.part'
+# .part の取得元（ファイルID・サイズ・md5）を記録するファイルの拡張子
+PART_META_SUFFIX = '.part.json'
+# ローカルのファイルの md5 を計算するときに1回で読み込むバイト数
+HASH_CHUNK_SIZE = 1024 * 1024
+# files.get_media のリクエストから Range 取得では送らないヘッダー（MediaIoBaseDownload と同じ）
+_STRIPPED_HEADERS = ('accept', 'accept-encoding', 'user-agent')
+
+
+class ChecksumMismatchError(Exception):
+    """ダウンロードした内容の md5 が Drive の md5Checksum と一致しない場合に送出される例外"""
+
+
+def file_md5(path: str):
+    """ファイルの内容の md5（hashlib のオブジェクト）を返します。"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5
+
+
+def part_path(save_path: str) -> str:
+    """save_path のダウンロード途中のデータを保存するパスを返します。"""
+    return save_path + PART_SUFFIX
+
+
+def content_total(resp):
+    """Content-Range ヘッダー（bytes a-b/全体）からファイル全体のバイト数を返します。不明なら None。"""
+    length = resp.get('content-range', '').rsplit('/', 1)[-1]
+    return int(length) if length.isdigit() else None
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PartialDownload:
+    """
+    save_path + '.part' への Range 取得の状態（取得済みの位置・書き込みながら計算する md5・取得元）を管理します。
+
+    ・HTTP の送信は呼び出し側（同期版は download_drive_file、asyncio 版は AsyncGoogleClient.download_media）が行い、
+      range_headers で作ったヘッダーで送った応答を feed に渡します。
+    ・.part を作るときに取得元（ファイルID・サイズ・md5）を save_path + '.part.json' に記録し、
+      次回はそれが一致する場合だけ .part の続きから取得します。ファイルID・md5・サイズ（Drive が返す全体の長さ）の
+      どれかが違えば .part を破棄して最初から取得するため、別のファイルの途中データとつながることはありません。
+    ・finish で md5_checksum と照合し、一致すれば save_path に置き換えます。
+    """
+
+    def __init__(self, save_path: str, file_id: str, md5_checksum: str = None, size=None,
+                 chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        self.save_path = save_path
+        self.part_path = part_path(save_path)
+        self.meta_path = save_path + PART_META_SUFFIX
+        self.source = {'file_id': file_id, 'md5': md5_checksum or None, 'size': int(size) if size else None}
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.done = False
+        self._file = None
+        self._md5 = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        self.close()
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.source, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _same_source(self, meta) -> bool:
+        if not isinstance(meta, dict) or meta.get('file_id') != self.source['file_id']:
+            return False
+        # 片方しか分からない値は比べず、両方分かっている値が違えば別の内容とみなす
+        return all(meta.get(key) is None or self.source[key] is None or meta.get(key) == self.source[key]
+                   for key in ('md5', 'size'))
+
+    def open(self):
+        """.part を開きます。取得元が同じ .part が残っていれば、その続きから取得できるよう md5 を計算し直します。"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.save_path)), exist_ok=True)
+        name = os.path.basename(self.save_path)
+        meta = self._read_meta()
+        if os.path.exists(self.part_path):
+            if self._same_source(meta):
+                for key in ('md5', 'size'):
+                    self.source[key] = self.source[key] or meta.get(key)
+            else:
+                logging.warning("%s の途中データは別の取得元のものなので破棄します。", name)
+                _remove(self.part_path)
+        self._md5 = file_md5(self.part_path) if os.path.exists(self.part_path) else hashlib.md5()
+        self._write_meta()
+        self._file = open(self.part_path, 'ab')
+        self.offset = self._file.tell()
+        if self.offset:
+            logging.info("%s を %dバイト目から再開します。", name, self.offset)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def range_headers(self, request_headers) -> dict:
+        """files.get_media のリクエストのヘッダーに、次のチャンクの Range を付けたものを返します。"""
+        headers = {k: v for k, v in request_headers.items() if k.lower() not in _STRIPPED_HEADERS}
+        headers['range'] = f"bytes={self.offset}-{self.offset + self.chunk_size - 1}"
+        return headers
+
+    def _restart(self, reason: str):
+        logging.warning("%s の%sため、最初から取得します。", os.path.basename(self.save_path), reason)
+        self._file.seek(0)
+        self._file.truncate()
+        self._md5 = hashlib.md5()
+        self.offset = 0
+
+    def _set_size(self, total):
+        if total is not None and self.source['size'] is None:
+            self.source['size'] = total
+            self._write_meta()
+
+    def feed(self, resp, content: bytes, uri: str = None):
+        """
+        Range 取得の応答（httplib2.Response と本文）を反映します。全体を取得すると done が真になります。
+        取得できなかった応答は HttpError を送出します（スロットリングの判定と再試行は呼び出し側で行います）。
+        """
+        if resp.status == 416:
+            total = content_total(resp)
+            if total is not None and total == self.offset:
+                # 0バイトのファイルか、.part が既に全体と同じ長さ
+                self._set_size(total)
+                self.done = True
+                return
+            if self.offset:
+                self._restart("途中データが元のファイルより長い")
+                return
+        if resp.status not in (200, 206):
+            raise HttpError(resp, content, uri=uri)
+
+        if resp.status == 206:
+            total = content_total(resp)
+        else:
+            total = int(resp['content-length']) if 'content-length' in resp else None
+        if self.offset and self.source['size'] is not None and total is not None and total != self.source['size']:
+            self._restart("元のファイルの長さが途中データの記録と違う")
+            self.source['size'] = total
+            self._write_meta()
+            if resp.status == 206:
+                # 途中からの応答は使えないので、最初から取り直す
+                return
+        elif resp.status == 200 and self.offset:
+            self._restart("Range を無視して全体が返された")
+        self._set_size(total)
+        self._md5.update(content)
+        self._file.write(content)
+        self.offset += len(content)
+        if resp.status == 200 or total is None or self.offset >= total:
+            self.done = True
+
+    def finish(self) -> tuple:
+        """
+        .part を閉じて md5 を照合し、save_path に置き換えます。(保存したバイト数, md5) を返します。
+        md5_checksum と一致しなければ .part を削除して ChecksumMismatchError を送出します。
+        """
+        self.close()
+        md5 = self._md5.hexdigest()
+        expected = self.source['md5']
+        if expected and md5 != expected:
+            _remove(self.part_path)
+            _remove(self.meta_path)
+            raise ChecksumMismatchError(f"{os.path.basename(self.save_path)} の md5 が一致しません（{md5} != {expected}）")
+        os.replace(self.part_path, self.save_path)
+        _remove(self.meta_path)
+        return self.offset, md5
+
+
+def backoff_delay(attempt: int, max_backoff: float) -> float:
+    """attempt 回目の再試行までの待ち時間（指数バックオフ＋ジッター）を返します。"""
+    return min(max_backoff, 2 ** attempt) + random.uniform(0, 1)
+
+
+def download_drive_file(drive_service, file_id: str, save_path: str, acquire=None, md5_checksum: str = None,
+                        size=None, chunk_size: int = DOWNLOAD_CHUNK_SIZE, max_retries: int = 6,
+                        max_backoff: float = 64.0) -> tuple:
+    """
+    認証済みの files.get_media で Drive のファイルを save_path に保存し、(保存したバイト数, md5) を返します。
+
+    ・chunk_size ずつ Range 付きで取得し、各チャンクがレートリミッターの実行枠を1回消費します。
+    ・スロットリング（403/429）の場合は取得済みの位置から指数バックオフで再試行するため、
+      途中まで取得した分を取り直すことはありません。5xx・通信エラーも MEDIA_NUM_RETRIES 回まで再試行します。
+    ・公開リンク（uc?export=view）と違い、大きなファイルでも確認ページの HTML が保存されることはありません。
+    ・取得中のデータの扱い（.part・取得元の確認・md5 の照合）は PartialDownload を参照してください。
+    """
+    # スレッドごとのサービスを返す関数が渡された場合は、実行中のスレッドで取得する
+    service = drive_service() if callable(drive_service) else drive_service
+    acquire = acquire or drive_rate_limiter.acquire
+    request = service.files().get_media(fileId=file_id)
+    with PartialDownload(save_path, file_id, md5_checksum, size, chunk_size) as part:
+        throttled = 0
+        failures = 0
+        while not part.done:
+            acquire()
+            try:
+                resp, content = request.http.request(request.uri, 'GET', headers=part.range_headers(request.headers))
+                part.feed(resp, content, request.uri)
+            except HttpError as e:
+                if is_rate_limit_error(e):
+                    drive_rate_limiter.on_throttle()
+                    if throttled == max_retries:
+                        raise QuotaExceededError(f"drive API のクォータ超過が解消しませんでした: {e}") from e
+                    sleep_time = backoff_delay(throttled, max_backoff)
+                    logging.warning("ダウンロードのスロットリング（試行 %d/%d）。%.1f秒後に再試行します。",
+                                    throttled + 1, max_retries, sleep_time)
+                    throttled += 1
+                    time.sleep(sleep_time)
+                    continue
+                if e.resp.status < 500 or failures == MEDIA_NUM_RETRIES:
+                    raise
+                failures += 1
+                time.sleep(backoff_delay(failures, max_backoff))
+                continue
+            except (OSError, httplib2.HttpLib2Error) as e:
+                if failures == MEDIA_NUM_RETRIES:
+                    raise
+                failures += 1
+                logging.warning("ダウンロードの通信エラー（%s）。再試行します。", e)
+                time.sleep(backoff_delay(failures, max_backoff))
+                continue
+            drive_rate_limiter.on_success()
+            throttled = 0
+            failures = 0
+        return part.finish()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Google Drive のフォルダ検索・画像検索をまとめて行うヘルパー
+"""
+
+import re
+import logging
+import threading
+import urllib.parse
+
+from rate_limiter import drive_rate_limiter, execute_with_backoff, execute_batch_with_backoff
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# 1回のクエリに含める name 条件の最大数と、URLエンコード後のクエリ長の上限
+MAX_QUERY_TERMS = 100
+MAX_QUERY_LENGTH = 5000
+# files().list の1ページあたりの最大件数
+PAGE_SIZE = 1000
+# 複数フォルダの画像をまとめて一覧する際に、1回のクエリに含める親フォルダの最大数
+MAX_PARENT_TERMS = 50
+# 先頭画像の検索で取得する件数（並び替えは Drive 側で行うため1件で足りる）
+IMAGE_PAGE_SIZE = 1
+# 先頭画像について取得するフィールド（md5Checksum・size はダウンロード済みのファイルとの比較に使う）
+IMAGE_FIELDS = "id,name,md5Checksum,size"
+# フォルダ検索で取得するフィールド（modifiedTime は検索結果キャッシュの再検証に使う）
+FOLDER_FIELDS = "id,name,modifiedTime"
+
+# 先頭画像の選び方（config.json の image_order）と files().list の orderBy の対応
+IMAGE_ORDERS = {
+    'name': 'name',
+    'createdTime': 'createdTime',
+    'modifiedTime': 'modifiedTime desc',
+    'largest': 'quotaBytesUsed desc',
+}
+DEFAULT_IMAGE_ORDER = 'name'
+_image_order = DEFAULT_IMAGE_ORDER
+
+# 複数フォルダの先頭画像の取得方法（config.json の image_listing）
+#   bulk:  親フォルダを OR でまとめた検索を同じ orderBy で一覧し、フォルダごとに最初に現れた画像を選ぶ
+#   batch: フォルダごとの1件検索を BatchHttpRequest でまとめて送る
+IMAGE_LISTINGS = ('bulk', 'batch')
+DEFAULT_IMAGE_LISTING = 'bulk'
+_image_listing = DEFAULT_IMAGE_LISTING
+
+# 実行中の検索・一覧で分かったフォルダの modifiedTime（フォルダID → modifiedTime）
+_folder_modified = {}
+_folder_modified_lock = threading.Lock()
+
+
+def folder_name_key(name: str) -> str:
+    """
+    フォルダ名を照合するときのキーを返します。
+    Drive の name 検索は大文字小文字を区別しないため、検索結果・ルート直下の一覧・インデックスの照合はすべてこのキーで行います。
+    """
+    return name.lower()
+
+
+def remember_folder_modified(files):
+    """検索・一覧で返されたフォルダ（id と modifiedTime を含む dict）の modifiedTime を記録します。"""
+    with _folder_modified_lock:
+        for f in files:
+            if f.get('id') and f.get('modifiedTime'):
+                _folder_modified[f['id']] = f['modifiedTime']
+
+
+def known_folder_modified(folder_ids) -> dict:
+    """
+    実行中に分かったフォルダの modifiedTime を {フォルダID: modifiedTime} で返します。
+    ここにあるフォルダは、検索結果キャッシュの保存・再検証でメタデータを取得し直しません。
+    """
+    with _folder_modified_lock:
+        return {folder_id: _folder_modified[folder_id] for folder_id in folder_ids if folder_id in _folder_modified}
+
+
+def escape_query_value(value: str) -> str:
+    """Drive API のクエリ文字列用にバックスラッシュとシングルクォートをエスケープします。"""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def folder_url_from_id(folder_id: str) -> str:
+    return f"https://drive.google.com/drive/folders/{folder_id}"
+
+
+def image_url_from_id(file_id: str) -> str:
+    return f"https://drive.google.com/uc?export=view&id={file_id}"
+
+
+def folder_id_from_url(url: str):
+    """フォルダURL（/folders/<ID> または ?id=<ID>）からフォルダIDを取り出します。見つからなければ None。"""
+    m = re.search(r'/folders/([a-zA-Z0-9_-]+)', url) or re.search(r'[?&]id=([a-zA-Z0-9_-]+)', url)
+    return m.group(1) if m else None
+
+
+def _folder_name_query(names) -> str:
+    terms = " or ".join(f"name='{escape_query_value(name)}'" for name in names)
+    return f"({terms}) and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+
+
+def _chunk_query_terms(items, build_query, max_terms: int, max_length: int):
+    chunks = []
+    current = []
+    for item in items:
+        candidate = current + [item]
+        if current and (len(candidate) > max_terms
+                        or len(urllib.parse.quote(build_query(candidate))) > max_length):
+            chunks.append(current)
+            candidate = [item]
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_folder_names(names, max_terms: int = MAX_QUERY_TERMS, max_length: int = MAX_QUERY_LENGTH):
+    """
+    フォルダ名を、1回のクエリに収まるチャンクに分割します。
+    各チャンクは max_terms 件以下で、URLエンコード後のクエリ長が max_length 以下になります。
+    """
+    return _chunk_query_terms(names, _folder_name_query, max_terms, max_length)
+
+
+def search_folders_by_names(drive_service, names, execute=None) -> dict:
+    """
+    複数のフォルダ名を1つの OR クエリで検索し、{フォルダ名: フォルダID} を返します。
+    結果は nextPageToken をたどってすべて取得し、同名のフォルダが複数ある場合は最初の1件を使います。
+    """
+    execute = execute or (lambda request: execute_with_backoff(request, drive_rate_limiter))
+    # スレッドごとのサービスを返す関数が渡された場合は、実行中のスレッドで取得する
+    service = drive_service() if callable(drive_service) else drive_service
+    found = {}
+    page_token = None
+    while True:
+        resp = execute(folder_search_request(service, names, page_token))
+        match_folder_names(names, resp.get('files', []), found)
+        page_token = resp.get('nextPageToken')
+        if not page_token:
+            break
+    return found
+
+
+def folder_search_request(drive_service, names, page_token: str = None):
+    """複数のフォルダ名を OR でまとめて検索するリクエストを作ります。"""
+    return drive_service.files().list(
+        q=_folder_name_query(names),
+        fields=f"nextPageToken, files({FOLDER_FIELDS})",
+        pageSize=PAGE_SIZE,
+        pageToken=page_token
+    )
+
+
+def match_folder_names(names, files, found: dict) -> dict:
+    """
+    検索結果のフォルダを検索した名前に対応付けて found（{フォルダ名: フォルダID}）に追加します。
+    大文字小文字だけが異なる名前で返ってきた場合も対応付け、同名のフォルダは最初の1件を使います。
+    """
+    remember_folder_modified(files)
+    wanted = set(names)
+    wanted_keys = {}
+    for name in names:
+        wanted_keys.setdefault(folder_name_key(name), name)
+    for f in files:
+        name = f.get('name', '')
+        if name not in wanted:
+            name = wanted_keys.get(folder_name_key(name))
+        if name and name not in found:
+            found[name] = f['id']
+    return found
+
+
+def parse_root_folder_ids(roots) -> list:
+    """
+    config.json の sku_root_folders（フォルダURLまたはIDの文字列・リスト）からフォルダIDのリストを作ります。
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+    folder_ids = []
+    for root in roots or []:
+        root = root.strip()
+        m = re.search(r'/folders/([a-zA-Z0-9_-]+)', root) or re.search(r'[?&]id=([a-zA-Z0-9_-]+)', root)
+        folder_id = m.group(1) if m else root
+        if folder_id and folder_id not in folder_ids:
+            folder_ids.append(folder_id)
+    return folder_ids
+
+
+def _child_folders_query(root_ids) -> str:
+    terms = " or ".join(f"'{escape_query_value(root_id)}' in parents" for root_id in root_ids)
+    return f"({terms}) and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+
+
+def chunk_root_ids(root_ids, max_terms: int = MAX_PARENT_TERMS, max_length: int = MAX_QUERY_LENGTH):
+    """ルートフォルダIDを、親フォルダ条件の OR クエリ1回に収まるチャンクに分割します。"""
+    return _chunk_query_terms(root_ids, _child_folders_query, max_terms, max_length)
+
+
+# 実行中に一覧したルートフォルダの子フォルダ（ルートIDの組 → {フォルダ名: フォルダID}）
+_root_folders_cache = {}
+_root_folders_lock = threading.Lock()
+
+
+def list_root_folders(drive_service, root_ids, execute=None) -> dict:
+    """
+    ルートフォルダ直下のフォルダを一覧し、{フォルダ名: フォルダID} を返します。
+
+    結果は nextPageToken をたどってすべて取得し、同じ実行中はキャッシュを返します。
+    同名のフォルダが複数のルートにある場合は、root_ids で先に指定したルートのものを使います。
+    """
+    key = tuple(root_ids)
+    with _root_folders_lock:
+        if key in _root_folders_cache:
+            return _root_folders_cache[key]
+        execute = execute or (lambda request: execute_with_backoff(request, drive_rate_limiter))
+        service = drive_service() if callable(drive_service) else drive_service
+        by_root = {root_id: {} for root_id in root_ids}
+        for chunk in chunk_root_ids(list(root_ids)):
+            page_token = None
+            while True:
+                resp = execute(service.files().list(
+                    q=_child_folders_query(chunk),
+                    fields=f"nextPageToken, files({FOLDER_FIELDS},parents)",
+                    pageSize=PAGE_SIZE,
+                    pageToken=page_token
+                ))
+                remember_folder_modified(resp.get('files', []))
+                for f in resp.get('files', []):
+                    for parent in f.get('parents', []):
+                        if parent in by_root:
+                            by_root[parent].setdefault(f.get('name', ''), f['id'])
+                page_token = resp.get('nextPageToken')
+                if not page_token:
+                    break
+        folders = {}
+        for root_id in root_ids:
+            for name, folder_id in by_root[root_id].items():
+                folders.setdefault(name, folder_id)
+        _root_folders_cache[key] = folders
+        return folders
+
+
+def open_root_folders(config: dict, drive_service, execute=None, roots=None):
+    """
+    config.json の sku_root_folders（または roots 引数）に指定したルートフォルダの子フォルダを一覧します。
+    ルートが指定されていない場合は None を返し、SKU はドライブ全体から検索します。
+    """
+    root_ids = parse_root_folder_ids(roots if roots else config.get('sku_root_folders'))
+    if not root_ids:
+        return None
+    folders = list_root_folders(drive_service, root_ids, execute)
+    logging.info("ルートフォルダ %d 件の直下から %d 件のフォルダを読み込みました。", len(root_ids), len(folders))
+    return folders
+
+
+def resolve_folders_by_skus(drive_service, skus, execute=None, executor=None, index=None, roots=None) -> dict:
+    """
+    SKU（フォルダ名）の一覧をまとめて検索し、{SKU: フォルダID または None} を返します。
+
+    roots（open_root_folders の結果）を渡すと、ルートフォルダ直下のフォルダだけで解決し、
+    Drive 全体の検索やインデックスは使いません。
+    index（FolderIndex）を渡すと、まずローカルのインデックスで解決し、
+    見つからなかったSKUだけを Drive で検索して結果をインデックスに追記します。
+    重複を除いたSKUを OR クエリのチャンクに分割するため、呼び出し回数は SKU 数ではなく
+    チャンク数になります。executor を渡すとチャンクを並列に検索します。
+    並列に検索する場合、drive_service にはスレッドごとのサービスを返す関数を渡してください。
+    """
+    unique_skus = list(dict.fromkeys(sku for sku in skus if sku))
+    results = {sku: None for sku in unique_skus}
+    if roots is not None:
+        # 大文字小文字だけが異なる名前も対応付けられるようにする
+        root_keys = {}
+        for name, folder_id in roots.items():
+            root_keys.setdefault(folder_name_key(name), folder_id)
+        for sku in unique_skus:
+            results[sku] = roots.get(sku) or root_keys.get(folder_name_key(sku))
+        return results
+    if index is not None:
+        results.update(index.lookup_many(unique_skus))
+        unique_skus = [sku for sku in unique_skus if results[sku] is None]
+
+    chunks = chunk_folder_names(unique_skus)
+    found = {}
+    if executor is not None and len(chunks) > 1:
+        futures = [executor.submit(search_folders_by_names, drive_service, chunk, execute) for chunk in chunks]
+        for future in futures:
+            found.update(future.result())
+    else:
+        for chunk in chunks:
+            found.update(search_folders_by_names(drive_service, chunk, execute))
+    results.update(found)
+    if index is not None:
+        index.add(found)
+    return results
+
+
+def configure_image_order(order: str = None):
+    """
+    フォルダ内のどの画像を「先頭の画像」とするかを設定します（config.json の image_order）。
+    name（名前順）・createdTime（最初に作成された画像）・modifiedTime（最後に更新された画像）・
+    largest（サイズが最大の画像）のいずれかで、未指定なら name です。
+    """
+    global _image_order
+    order = order or DEFAULT_IMAGE_ORDER
+    if order not in IMAGE_ORDERS:
+        raise ValueError(f"image_order は {', '.join(IMAGE_ORDERS)} のいずれかを指定してください: {order}")
+    _image_order = order
+
+
+def get_image_order() -> str:
+    """現在の先頭画像の選び方（configure_image_order で設定した値）を返します。"""
+    return _image_order
+
+
+def configure_image_listing(listing: str = None):
+    """
+    複数フォルダの先頭画像の取得方法を設定します（config.json の image_listing）。
+    bulk（親フォルダをまとめて一覧）または batch（BatchHttpRequest）で、未指定なら bulk です。
+    """
+    global _image_listing
+    listing = listing or DEFAULT_IMAGE_LISTING
+    if listing not in IMAGE_LISTINGS:
+        raise ValueError(f"image_listing は {', '.join(IMAGE_LISTINGS)} のいずれかを指定してください: {listing}")
+    _image_listing = listing
+
+
+def image_listing_calls(folder_count: int) -> int:
+    """
+    folder_count 件のフォルダの先頭画像を取得するのに必要な Drive API 呼び出し数の目安を返します。
+    bulk では親フォルダのチャンク数（ページ送りを除く）、batch ではフォルダ数です。
+    """
+    if _image_listing == 'bulk':
+        return -(-folder_count // MAX_PARENT_TERMS)  # 天井除算
+    return folder_count
+
+
+def _parent_images_query(folder_ids) -> str:
+    terms = " or ".join(f"'{escape_query_value(folder_id)}' in parents" for folder_id in folder_ids)
+    return f"({terms}) and mimeType contains 'image/' and trashed=false"
+
+
+def chunk_parent_ids(folder_ids, max_terms: int = MAX_PARENT_TERMS, max_length: int = MAX_QUERY_LENGTH):
+    """フォルダIDを、親フォルダ条件の OR クエリ1回に収まるチャンクに分割します。"""
+    return _chunk_query_terms(folder_ids, _parent_images_query, max_terms, max_length)
+
+
+def list_first_images(drive_service, folder_ids, execute=None) -> dict:
+    """
+    複数フォルダの画像を1つの OR クエリ（'<f1>' in parents or ...）でまとめて一覧し、
+    {フォルダID: 先頭画像の {id, name, md5Checksum, size} または None} を返します。
+
+    1フォルダずつの検索（first_image_request）と同じ orderBy で Drive 側で並べ、parents で振り分けて
+    フォルダごとに最初に現れた画像を選びます。結果は nextPageToken をたどってすべて取得します。
+    """
+    execute = execute or (lambda request: execute_with_backoff(request, drive_rate_limiter))
+    # スレッドごとのサービスを返す関数が渡された場合は、実行中のスレッドで取得する
+    service = drive_service() if callable(drive_service) else drive_service
+    files = []
+    page_token = None
+    while True:
+        resp = execute(parent_images_request(service, folder_ids, page_token))
+        files.extend(resp.get('files', []))
+        page_token = resp.get('nextPageToken')
+        if not page_token:
+            break
+    return pick_first_images(folder_ids, files)
+
+
+def parent_images_request(drive_service, folder_ids, page_token: str = None):
+    """
+    複数フォルダの画像を親フォルダの OR 条件でまとめて一覧するリクエストを作ります。
+    どの取得方法でも同じ画像を先頭に選ぶよう、並び替えは first_image_request と同じく Drive 側（orderBy）で行います。
+    """
+    return drive_service.files().list(
+        q=_parent_images_query(folder_ids),
+        orderBy=IMAGE_ORDERS[_image_order],
+        fields=f"nextPageToken, files({IMAGE_FIELDS},parents)",
+        pageSize=PAGE_SIZE,
+        pageToken=page_token
+    )
+
+
+def pick_first_images(folder_ids, files) -> dict:
+    """
+    parent_images_request（orderBy 済み）で一覧した画像を、取得した順に親フォルダごとに振り分け、
+    フォルダごとに最初に現れた画像を {フォルダID: {id, name, md5Checksum, size} または None} で返します。
+    Drive の並び順をそのまま使うため、1フォルダずつの検索（pick_first_image）と同じ画像を選びます。
+    """
+    images = {folder_id: None for folder_id in folder_ids}
+    for f in files:
+        for parent in f.get('parents', []):
+            if parent in images and images[parent] is None:
+                images[parent] = {key: f[key] for key in IMAGE_FIELDS.split(',') if key in f}
+    return images
+
+
+def first_image_request(drive_service, folder_id: str, page_token: str = None):
+    """
+    フォルダ内の先頭画像を取得するリクエストを作ります。
+    並び替えは Drive 側（orderBy）で行い、1件だけを最小限の fields で取得します。
+    """
+    return drive_service.files().list(
+        q=f"'{escape_query_value(folder_id)}' in parents and mimeType contains 'image/' and trashed=false",
+        orderBy=IMAGE_ORDERS[_image_order],
+        fields=f"nextPageToken, files({IMAGE_FIELDS})",
+        pageSize=IMAGE_PAGE_SIZE,
+        pageToken=page_token
+    )
+
+
+def pick_first_image(files):
+    """orderBy 済みの画像一覧から先頭の画像を返します。画像がなければ None。"""
+    return files[0] if files else None
+
+
+def fetch_first_image(drive_service, folder_id: str, execute=None):
+    """
+    フォルダ内の先頭画像の {id, name, md5Checksum, size} を返します。画像がなければ None。
+    Drive は条件付きの検索で空のページを返すことがあるため、画像が見つかるまで nextPageToken をたどります。
+    """
+    execute = execute or (lambda request: execute_with_backoff(request, drive_rate_limiter))
+    page_token = None
+    while True:
+        resp = execute(first_image_request(drive_service, folder_id, page_token))
+        first_file = pick_first_image(resp.get('files', []))
+        page_token = resp.get('nextPageToken')
+        if first_file or not page_token:
+            return first_file
+
+
+def fetch_first_images(drive_service, folder_ids, acquire=None) -> tuple:
+    """
+    複数フォルダの先頭画像をまとめて取得します。
+
+    戻り値は ({フォルダID: 先頭画像の {id, name, md5Checksum, size} または None}, {フォルダID: 例外}) です。
+    先頭画像は configure_image_order で設定した並び順で選びます。
+    image_listing が bulk の場合は、親フォルダを OR でまとめた数回の一覧（list_first_images）で取得します。
+    batch の場合は BatchHttpRequest（1回最大100件）で送り、各サブリクエストがレート制限の対象になります。
+    """
+    # スレッドごとのサービスを返す関数が渡された場合は、実行中のスレッドで取得する
+    service = drive_service() if callable(drive_service) else drive_service
+    unique_ids = list(dict.fromkeys(folder_id for folder_id in folder_ids if folder_id))
+    images = {}
+    errors = {}
+    if _image_listing == 'bulk':
+        def execute(request):
+            return execute_with_backoff(request, drive_rate_limiter, acquire=acquire)
+
+        for chunk in chunk_parent_ids(unique_ids):
+            try:
+                images.update(list_first_images(service, chunk, execute))
+            except Exception as e:
+                errors.update({folder_id: e for folder_id in chunk})
+        return images, errors
+
+    page_tokens = {folder_id: None for folder_id in unique_ids}
+    # 空のページと nextPageToken が返ったフォルダだけを、次のページで再度まとめて検索する
+    while page_tokens:
+        requests = {
+            folder_id: first_image_request(service, folder_id, page_token)
+            for folder_id, page_token in page_tokens.items()
+        }
+        responses, batch_errors = execute_batch_with_backoff(service, requests, drive_rate_limiter, acquire=acquire)
+        errors.update(batch_errors)
+        page_tokens = {}
+        for folder_id, resp in responses.items():
+            first_file = pick_first_image(resp.get('files', []))
+            if first_file or not resp.get('nextPageToken'):
+                images[folder_id] = first_file
+            else:
+                page_tokens[folder_id] = resp['nextPageToken']
+    return images, errors
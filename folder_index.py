@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Google Drive のフォルダ名 → フォルダID のローカルインデックス
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from googleapiclient.errors import HttpError
+
+from drive_lookup import (
+    FOLDER_MIME_TYPE, FOLDER_FIELDS, PAGE_SIZE, folder_name_key, remember_folder_modified, known_folder_modified,
+)
+from rate_limiter import drive_rate_limiter, execute_with_backoff
+from sqlite_readonly import connect_read_only
+
+DEFAULT_FOLDER_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".gdrive_image_downloader", "folder_index.sqlite3")
+
+
+class FolderIndex:
+    """
+    ゴミ箱以外の全フォルダを一度だけ列挙し、名前・ID・親フォルダを SQLite に保存するインデックス。
+
+    ・起動時に名前 → ID の対応をメモリに読み込むため、検索は Drive API を呼び出さずに完了します。
+      名前は Drive の検索（match_folder_names）と同じく folder_name_key で大文字小文字を区別せずに照合します。
+    ・フォルダの modifiedTime も保存し、lookup_many で見つかったフォルダは検索結果キャッシュの再検証に使えるよう記録します。
+    ・インデックスにないSKUだけを Drive で検索し、見つかったフォルダは add で追記します。
+    ・構築後は changes.list の変更フィードで差分だけを反映します（refresh）。
+    ・read_only=True の場合は保存済みのインデックスを変更せずに開きます（検索だけが使えます）。
+    """
+
+    def __init__(self, path: str = DEFAULT_FOLDER_INDEX_PATH, read_only: bool = False):
+        self.path = path
+        self._by_name = {}
+        self._modified = {}
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = connect_read_only(path)
+            if self._conn is None:
+                raise FileNotFoundError(path)
+            self._load()
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS folders (id TEXT PRIMARY KEY, name TEXT NOT NULL, parent TEXT, modified TEXT);
+            CREATE INDEX IF NOT EXISTS folders_name ON folders (name);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        # modified 列がない以前のインデックスには列を追加する（値は次の構築・更新で入る）
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(folders)")}
+        if 'modified' not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE folders ADD COLUMN modified TEXT")
+        self._load()
+
+    def _load(self):
+        by_name = {}
+        modified = {}
+        # 同名のフォルダが複数ある場合は、ID順で最初のものを使う
+        for folder_id, name, folder_modified in self._conn.execute(
+            "SELECT id, name, modified FROM folders ORDER BY id DESC"
+        ):
+            by_name[folder_name_key(name)] = folder_id
+            if folder_modified:
+                modified[folder_id] = folder_modified
+        self._by_name = by_name
+        self._modified = modified
+
+    def _get_meta(self, key: str):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def built_at(self):
+        """最後に全件を構築した時刻（UNIX 時間）。未構築なら None。"""
+        with self._lock:
+            value = self._get_meta('built_at')
+        return float(value) if value else None
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def build(self, drive_service, execute=None):
+        """
+        ゴミ箱以外の全フォルダを列挙してインデックスを作り直します。
+        fields は id・name・modifiedTime・parents のみに絞り、1ページ1000件でページングします。
+        """
+        execute = execute or (lambda request: execute_with_backoff(request, drive_rate_limiter))
+        logging.info("フォルダインデックスを構築します...")
+        # 列挙中の変更も取りこぼさないよう、列挙を始める前の変更トークンを保存する
+        start_page_token = execute(drive_service.changes().getStartPageToken()).get('startPageToken')
+        rows = []
+        page_token = None
+        while True:
+            resp = execute(drive_service.files().list(
+                q=f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false",
+                fields=f"nextPageToken, files({FOLDER_FIELDS},parents)",
+                pageSize=PAGE_SIZE,
+                pageToken=page_token
+            ))
+            for f in resp.get('files', []):
+                parents = f.get('parents') or [None]
+                rows.append((f['id'], f.get('name', ''), parents[0], f.get('modifiedTime')))
+            page_token = resp.get('nextPageToken')
+            if not page_token:
+                break
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM folders")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO folders (id, name, parent, modified) VALUES (?, ?, ?, ?)", rows
+                )
+                self._set_meta('built_at', str(time.time()))
+                self._set_meta('page_token', start_page_token)
+            self._load()
+        logging.info("フォルダインデックスを構築しました: %d件", len(rows))
+
+    def refresh(self, drive_service, execute=None):
+        """
+        前回の構築・更新以降の変更を changes.list で取得してインデックスに反映します。
+        フォルダの作成・名前変更・移動は上書きし、ゴミ箱への移動と削除はインデックスから除きます。
+        変更トークンがない、または無効になっている場合は全件を構築し直します。
+        """
+        execute = execute or (lambda request: execute_with_backoff(request, drive_rate_limiter))
+        with self._lock:
+            page_token = self._get_meta('page_token')
+        if not page_token:
+            self.build(drive_service, execute)
+            return
+
+        upserts = {}
+        removals = set()
+        try:
+            while True:
+                resp = execute(drive_service.changes().list(
+                    pageToken=page_token,
+                    fields="nextPageToken, newStartPageToken, "
+                           "changes(fileId, removed, file(id, name, mimeType, parents, trashed, modifiedTime))",
+                    pageSize=PAGE_SIZE,
+                    includeRemoved=True,
+                    spaces='drive'
+                ))
+                for change in resp.get('changes', []):
+                    file_id = change.get('fileId')
+                    f = change.get('file') or {}
+                    if change.get('removed') or f.get('trashed'):
+                        removals.add(file_id)
+                        upserts.pop(file_id, None)
+                    elif f.get('mimeType') == FOLDER_MIME_TYPE:
+                        parents = f.get('parents') or [None]
+                        upserts[file_id] = (file_id, f.get('name', ''), parents[0], f.get('modifiedTime'))
+                        removals.discard(file_id)
+                if resp.get('newStartPageToken'):
+                    page_token = resp['newStartPageToken']
+                    break
+                page_token = resp['nextPageToken']
+        except HttpError as e:
+            logging.warning("変更フィードを取得できないため、フォルダインデックスを構築し直します: %s", e)
+            self.build(drive_service, execute)
+            return
+
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("DELETE FROM folders WHERE id = ?", [(file_id,) for file_id in removals])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO folders (id, name, parent, modified) VALUES (?, ?, ?, ?)",
+                    list(upserts.values())
+                )
+                self._set_meta('page_token', page_token)
+            if upserts or removals:
+                self._load()
+        logging.info("フォルダインデックスを更新しました: 追加・変更 %d件, 削除 %d件", len(upserts), len(removals))
+
+    def lookup(self, name: str):
+        """フォルダ名に対応するフォルダIDを返します。インデックスにない場合は None。"""
+        return self._by_name.get(folder_name_key(name))
+
+    def lookup_many(self, names) -> dict:
+        """インデックスにあるフォルダ名だけを {フォルダ名: フォルダID} で返します。"""
+        by_name = self._by_name
+        found = {}
+        for name in names:
+            folder_id = by_name.get(folder_name_key(name))
+            if folder_id:
+                found[name] = folder_id
+        modified = self._modified
+        remember_folder_modified(
+            {'id': folder_id, 'modifiedTime': modified.get(folder_id)} for folder_id in found.values()
+        )
+        return found
+
+    def add(self, folders: dict):
+        """Drive で見つかった {フォルダ名: フォルダID} をインデックスに追記します。"""
+        if not folders:
+            return
+        # 検索で分かった modifiedTime も一緒に保存する
+        modified = known_folder_modified(folders.values())
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO folders (id, name, parent, modified) VALUES (?, ?, NULL, ?)",
+                    [(folder_id, name, modified.get(folder_id)) for name, folder_id in folders.items()]
+                )
+            by_name = dict(self._by_name)
+            for name, folder_id in folders.items():
+                by_name.setdefault(folder_name_key(name), folder_id)
+            self._by_name = by_name
+            self._modified = {**self._modified, **modified}
+
+
+def open_folder_index(config: dict, drive_service, execute=None, rebuild: bool = False):
+    """
+    config.json の folder_index 設定に従ってインデックスを開きます。
+    未構築または rebuild=True の場合は全件を構築し、それ以外は変更フィードで差分を反映します。
+    folder_index が false なら None を返します。
+    """
+    path = config.get('folder_index')
+    if path is False:
+        return None
+    try:
+        index = FolderIndex(path or DEFAULT_FOLDER_INDEX_PATH)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning("フォルダインデックスを開けませんでした。Drive で直接検索します: %s", e)
+        return None
+    if rebuild or index.built_at is None:
+        index.build(drive_service, execute)
+    else:
+        index.refresh(drive_service, execute)
+    return index
+
+
+def load_folder_index(config: dict):
+    """
+    構築済みのインデックスを Drive API を呼び出さず、ファイルも変更せずに開きます（--plan の見積もり用、差分は反映しません）。
+    未構築・folder_index が false・開けない場合は None を返します。
+    """
+    path = config.get('folder_index')
+    if path is False:
+        return None
+    path = path or DEFAULT_FOLDER_INDEX_PATH
+    if not os.path.exists(path):
+        return None
+    try:
+        index = FolderIndex(path, read_only=True)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning("フォルダインデックスを開けませんでした: %s", e)
+        return None
+    return index if index.built_at is not None else None
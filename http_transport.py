@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Google API クライアント用の keep-alive 接続プール（requests / urllib3）
+"""
+
+import logging
+import threading
+
+import httplib2
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+# config.json の http_transport に指定できる値
+#   httplib2: クライアントごとに httplib2 の接続を持つ（googleapiclient の既定）
+#   requests: 認証済みの requests セッションを全クライアントで共有し、urllib3 の接続プールで keep-alive する
+HTTP_TRANSPORTS = ('httplib2', 'requests')
+DEFAULT_HTTP_TRANSPORT = 'httplib2'
+# 接続プールの既定サイズ（ワーカー数に合わせて configure_http_transport で変更）
+DEFAULT_HTTP_POOL_SIZE = 10
+# 1リクエストのタイムアウト（秒）
+HTTP_TIMEOUT = 120
+
+_transport = DEFAULT_HTTP_TRANSPORT
+_pool_size = DEFAULT_HTTP_POOL_SIZE
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class RequestsHttp:
+    """
+    googleapiclient から httplib2.Http の代わりに使える、requests ベースの HTTP クライアント。
+
+    ・AuthorizedSession がアクセストークンの付与と更新を行います。
+    ・urllib3 の接続プールは pool_size 本まで接続を保持し、スレッド間で共有して再利用します。
+      そのため TLS ハンドシェイクは接続ごとに1回で済みます。
+    """
+
+    def __init__(self, creds, pool_size: int = DEFAULT_HTTP_POOL_SIZE, timeout: float = HTTP_TIMEOUT):
+        self.creds = creds
+        self.timeout = timeout
+        self.session = AuthorizedSession(creds)
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        with self._lock:
+            self.requests += 1
+        response = self.session.request(method, uri, data=body, headers=headers,
+                                        allow_redirects=redirections > 0, timeout=self.timeout)
+        content = response.content
+        resp = httplib2.Response({'status': response.status_code, **response.headers})
+        resp.reason = response.reason
+        # requests は gzip を展開済みのため、httplib2 と同じく展開後の内容として扱う
+        if resp.get('content-encoding') in ('gzip', 'deflate'):
+            resp['-content-encoding'] = resp.pop('content-encoding')
+            resp['content-length'] = str(len(content))
+        return resp, content
+
+    def stats(self) -> dict:
+        """送信したリクエスト数と、urllib3 が作成した接続数を返します。"""
+        connections = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            pool_requests += pool.num_requests
+        return {'requests': self.requests, 'connections': connections, 'pool_requests': pool_requests}
+
+    def close(self):
+        self.session.close()
+
+
+def configure_http_transport(transport: str = None, pool_size: int = None):
+    """
+    Google API クライアントの HTTP 実装を設定します（config.json の http_transport / http_pool_size）。
+    pool_size には並列ワーカー数を指定します。
+    """
+    global _transport, _pool_size
+    transport = transport or DEFAULT_HTTP_TRANSPORT
+    if transport not in HTTP_TRANSPORTS:
+        raise ValueError(f"http_transport は {', '.join(HTTP_TRANSPORTS)} のいずれかを指定してください: {transport}")
+    _transport = transport
+    if pool_size:
+        _pool_size = max(1, int(pool_size))
+
+
+def setup_http_transport(config: dict, workers: int = None):
+    """config.json の設定を読み込み、接続プールのサイズは http_pool_size（未指定ならワーカー数）にします。"""
+    try:
+        configure_http_transport(config.get('http_transport'), config.get('http_pool_size') or workers)
+    except ValueError as e:
+        logging.warning("%s（httplib2 を使用します）", e)
+        configure_http_transport(DEFAULT_HTTP_TRANSPORT, workers)
+
+
+def get_authorized_http(creds):
+    """
+    requests 方式なら認証情報ごとに共有する RequestsHttp を、httplib2 方式なら None を返します。
+    None の場合は build(..., credentials=creds) でクライアントごとに接続を作ります。
+    """
+    if _transport != 'requests':
+        return None
+    with _sessions_lock:
+        http = _sessions.get(id(creds))
+        if http is None or http.creds is not creds:
+            http = RequestsHttp(creds, _pool_size)
+            _sessions[id(creds)] = http
+            logging.info("keep-alive 接続プールを作成しました（最大 %d 接続）。", _pool_size)
+        return http
+
+
+def transport_stats() -> dict:
+    """
+    requests 方式の接続の再利用状況を返します。
+    connections が作成した接続数、requests が送信したリクエスト数で、reuse_ratio は再利用された割合です。
+    """
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    totals = {'requests': 0, 'connections': 0}
+    for http in sessions:
+        stats = http.stats()
+        totals['requests'] += stats['requests']
+        totals['connections'] += stats['connections']
+    requests_sent = totals['requests']
+    totals['reuse_ratio'] = (1 - totals['connections'] / requests_sent) if requests_sent else 0.0
+    return totals
+
+
+def format_transport_stats() -> str:
+    """接続の再利用状況をログ表示用の文字列にします。requests 方式でなければ空文字列。"""
+    if _transport != 'requests':
+        return ""
+    stats = transport_stats()
+    return (f"HTTP接続: {stats['requests']}リクエスト / {stats['connections']}接続 "
+            f"（再利用率 {stats['reuse_ratio'] * 100:.1f}%）")
@@ -5,8 +5,10 @@
 
 import os
 import re
+import json
 import time
 import logging
+import argparse
 import threading
 import concurrent.futures
 import tkinter as tk
@@ -14,7 +16,21 @@ import tkinter as tk
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+
+from drive_lookup import (
+    resolve_folders_by_skus, folder_url_from_id, image_url_from_id, open_root_folders, parse_root_folder_ids,
+    fetch_first_image, fetch_first_images, configure_image_order, configure_image_listing, IMAGE_ORDERS,
+)
+from folder_index import open_folder_index, load_folder_index
+from result_cache import open_result_cache, cached_image
+from singleflight import SingleFlight
+from planner import plan_image_formula_run, known_lookups, estimate_runtime, format_plan
+from drive_clients import build_service, get_drive_client
+from http_transport import setup_http_transport, format_transport_stats
+from rate_limiter import (
+    drive_rate_limiter, sheets_read_rate_limiter, sheets_write_rate_limiter,
+    execute_with_backoff, setup_rate_limits, QuotaExceededError, MAX_BATCH_SIZE,
+)
 
 # ============================================================
 # ログ設定（DEBUGレベルで詳細ログ出力）
@@ -27,65 +43,39 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive'
 ]
 
-# ------------------------------------------------------------
-# 各スレッドごとのDriveサービス保持用のスレッドローカル変数
-_thread_local = threading.local()
-
-# ------------------------------------------------------------
-# レートリミット管理用（トークンバケット方式）
-# ここでは1分間あたりの最大リクエスト数（トークン数）を1500と仮定
-RATE_LIMIT_MAX_DRIVE = 2000
-token_bucket = RATE_LIMIT_MAX_DRIVE  # 初期状態は満タン
-last_refill = time.time()
-rate_limit_lock = threading.Lock()
-# ------------------------------------------------------------
+# 並列実行中の同じSKU・同じフォルダの個別検索を1回にまとめる（process_sheet の実行ごとにクリア）
+_folder_link_flights = SingleFlight()
+_image_url_flights = SingleFlight()
 
 def check_drive_api_rate_limit():
     """
-    トークンバケット方式でドライブAPIのレート使用状況を管理する。
-    
-    ・1分間にRATE_LIMIT_MAX_DRIVE個のトークン（＝リクエスト）が補充されると仮定。
-    ・もし前回のリセットから1分以上経過している場合、10秒間待機してからトークンバケットをリセット（＝満タンに戻す）します。
-    ・その後、トークンが不足している場合は、十分なトークンが貯まるまで待機し、各API呼び出し時に1トークンを消費します。
-    ・使用率はログに出力されます。（使用率＝(1 - (残トークン/最大トークン))×100）
+    共有のスライディングウィンドウ・レートリミッターで Drive API の呼び出しを制御する。
+
+    ・直近60秒間のリクエスト数が RATE_LIMIT_MAX_DRIVE を超えないよう実行枠を予約します。
+    ・待機はロックの外で行うため、他のワーカースレッドはブロックされません。
+    ・待機した場合だけ使用率をログに出力します。（使用率＝直近60秒の呼び出し数／最大数×100）
+      使用率の集計は共有ストアのロックを取るため、呼び出しごとには行いません。
     """
-    global token_bucket, last_refill
-    with rate_limit_lock:
-        now = time.time()
-        if now - last_refill >= 60:
-            logging.info("1分経過のため、10秒待機してレート使用率をリセットします。")
-            time.sleep(10)
-            token_bucket = RATE_LIMIT_MAX_DRIVE  # リセット
-            last_refill = time.time()
-            now = last_refill  # リセット後の時刻
-
-        # 補充：1分間にRATE_LIMIT_MAX_DRIVE個補充される（1秒あたり RATE_LIMIT_MAX_DRIVE/60 個）
-        elapsed = now - last_refill
-        refill = elapsed * (RATE_LIMIT_MAX_DRIVE / 60)
-        token_bucket = min(RATE_LIMIT_MAX_DRIVE, token_bucket + refill)
-        last_refill = now
-
-        while token_bucket < 1:
-            wait_time = (1 - token_bucket) * (60 / RATE_LIMIT_MAX_DRIVE)
-            logging.info("トークン不足のため、{:.2f}秒待機します。".format(wait_time))
-            time.sleep(wait_time)
-            now = time.time()
-            elapsed = now - last_refill
-            token_bucket = min(RATE_LIMIT_MAX_DRIVE, token_bucket + elapsed * (RATE_LIMIT_MAX_DRIVE / 60))
-            last_refill = now
-
-        token_bucket -= 1  # API呼び出しとして1トークン消費
-        usage_percentage = (1 - token_bucket / RATE_LIMIT_MAX_DRIVE) * 100
-        logging.info("ドライブAPI使用率: {:.2f}% (残トークン: {:.2f})".format(usage_percentage, token_bucket))
+    wait_time = drive_rate_limiter.acquire()
+    if wait_time > 0:
+        usage = drive_rate_limiter.usage_percentage()
+        logging.info("レート上限に達したため、{:.2f}秒待機しました。ドライブAPI使用率: {:.2f}% (残リクエスト: {:.0f})".format(
+            wait_time, usage, drive_rate_limiter.remaining(usage)))
+
+def execute_drive_request(request):
+    """
+    Drive API リクエストをレート制御付きで実行します。
+    スロットリング（403/429）の場合はリミッターの上限を下げて指数バックオフで再試行し、
+    解消しなければ QuotaExceededError を送出します。
+    """
+    return execute_with_backoff(request, drive_rate_limiter, acquire=check_drive_api_rate_limit)
 
 def get_thread_local_drive_service(creds):
     """
     各スレッドで独自の Drive サービスオブジェクトを取得します。
+    共有のクライアントプールから取得するため、終了したスレッドのクライアントは次のスレッドで再利用されます。
     """
-    if not hasattr(_thread_local, 'drive_service'):
-        _thread_local.drive_service = build('drive', 'v3', credentials=creds)
-        logging.debug("新しいDriveサービスオブジェクトを生成しました。")
-    return _thread_local.drive_service
+    return get_drive_client(creds)
 
 def authenticate_google_apis():
     """
@@ -115,7 +105,7 @@ def authenticate_google_apis():
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
             logging.debug("新しい token.json を保存しました。")
-    sheets_service = build('sheets', 'v4', credentials=creds)
+    sheets_service = build_service('sheets', 'v4', creds)
     logging.info("Google Sheets および Drive API の認証が完了しました。")
     return sheets_service, creds
 
@@ -148,19 +138,15 @@ def get_folder_link_by_sku(creds, sku):
     """
     SKU（フォルダ名と仮定）に対応するGoogle Drive上のフォルダを検索し、
     該当する場合はフォルダリンク（https://drive.google.com/drive/folders/{folder_id}）を返します。
+    検索のエラーは None にせず送出します（SingleFlight に「見つからなかった」として残さないため）。
     """
     drive_service = get_thread_local_drive_service(creds)
     query = f"name = '{sku}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
     logging.debug("SKU '%s' の検索クエリ: %s", sku, query)
-    try:
-        check_drive_api_rate_limit()
-        response = drive_service.files().list(
-            q=query,
-            fields="files(id, name)"
-        ).execute()
-    except Exception as e:
-        logging.error("SKU '%s' のフォルダ検索中にエラー発生: %s", sku, e)
-        return None
+    response = execute_drive_request(drive_service.files().list(
+        q=query,
+        fields="files(id, name)"
+    ))
     files = response.get('files', [])
     if not files:
         logging.warning("SKU '%s' に対応するフォルダが見つかりませんでした。", sku)
@@ -173,28 +159,16 @@ def get_folder_link_by_sku(creds, sku):
 def get_first_image_url_from_folder(creds, folder_id):
     """
     指定されたフォルダ内の画像ファイル（mimeTypeが'image/'で始まる）を
-    名前順にソートし、先頭の画像の表示用URLを返します。画像が見つからなければNoneを返します。
+    設定した並び順（既定は名前順）で Drive 側で並べ、先頭の画像の表示用URLを返します。
+    画像が見つからなければNoneを返し、一覧取得のエラーは送出します。
     """
     drive_service = get_thread_local_drive_service(creds)
-    query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed = false"
-    logging.debug("フォルダID '%s' の画像検索クエリ: %s", folder_id, query)
-    try:
-        check_drive_api_rate_limit()
-        response = drive_service.files().list(
-            q=query,
-            fields="files(id, name)"
-        ).execute()
-    except Exception as e:
-        logging.error("フォルダ %s 内の画像一覧取得に失敗しました: %s", folder_id, e)
-        return None
-    files = response.get('files', [])
-    if not files:
+    logging.debug("フォルダID '%s' の画像を検索します。", folder_id)
+    first_file = fetch_first_image(drive_service, folder_id, execute=execute_drive_request)
+    if not first_file:
         logging.warning("フォルダ %s 内に画像が見つかりませんでした。", folder_id)
         return None
-    files.sort(key=lambda f: f.get('name', ''))
-    first_file = files[0]
-    file_id = first_file.get('id')
-    image_url = f"https://drive.google.com/uc?export=view&id={file_id}"
+    image_url = image_url_from_id(first_file.get('id'))
     logging.info("フォルダ %s 内の最初の画像URLを取得: %s", folder_id, image_url)
     return image_url
 
@@ -205,22 +179,47 @@ progress_lock = threading.Lock()
 processing_done = False
 # -------------------------------------------------------
 
-def process_single_row(row_index, sku, creds):
+def process_single_row(row_index, sku, creds, folder_ids=None, first_images=None):
     """
     1行分の処理:
       - SKUからフォルダリンク（B列用）取得
       - フォルダ内の1枚目の画像URL取得しIMAGE関数（A列用）生成
+    folder_ids にまとめて検索済みの {SKU: フォルダID} があればそれを使い、なければ個別に検索します。
+    個別の検索は SingleFlight で、同じSKU・フォルダについて実行中の検索があればその結果を待ちます。
+    first_images にまとめて取得済みの {フォルダID: 先頭画像} があればそれを使います。
     戻り値は (IMAGE関数, フォルダリンク, SKU) のタプル
     """
     logging.info("行 %d: SKU = '%s' の処理を開始します。", row_index, sku)
     folder_link = ""
     image_formula = ""
     if sku:
-        folder_link = get_folder_link_by_sku(creds, sku)
+        if folder_ids is not None and sku in folder_ids:
+            folder_link = folder_url_from_id(folder_ids[sku]) if folder_ids[sku] else None
+        else:
+            try:
+                folder_link = _folder_link_flights.do(sku, lambda: get_folder_link_by_sku(creds, sku))
+            except QuotaExceededError:
+                raise
+            except Exception as e:
+                # エラーは SingleFlight に残らないため、同じSKUの後の行では再検索される
+                logging.error("行 %d: SKU '%s' のフォルダ検索中にエラー発生: %s", row_index, sku, e)
+                return (image_formula, folder_link, sku)
         if folder_link:
             folder_id = extract_folder_id(folder_link)
             if folder_id:
-                image_url = get_first_image_url_from_folder(creds, folder_id)
+                if first_images is not None and folder_id in first_images:
+                    first_file = first_images[folder_id]
+                    image_url = image_url_from_id(first_file['id']) if first_file else None
+                else:
+                    try:
+                        image_url = _image_url_flights.do(
+                            folder_id, lambda: get_first_image_url_from_folder(creds, folder_id)
+                        )
+                    except QuotaExceededError:
+                        raise
+                    except Exception as e:
+                        logging.error("行 %d: フォルダ %s 内の画像一覧取得に失敗しました: %s", row_index, folder_id, e)
+                        image_url = None
                 if image_url:
                     image_formula = f'=IMAGE("{image_url}")'
                     logging.info("行 %d: IMAGE関数数式を生成しました: %s", row_index, image_formula)
@@ -241,10 +240,10 @@ def update_sheet_values(sheets_service, spreadsheet_id, update_data, max_retries
     """
     for attempt in range(max_retries):
         try:
-            result = sheets_service.spreadsheets().values().batchUpdate(
+            result = execute_with_backoff(sheets_service.spreadsheets().values().batchUpdate(
                 spreadsheetId=spreadsheet_id,
                 body=update_data
-            ).execute()
+            ), sheets_write_rate_limiter)
             logging.info("バッチ更新成功")
             return result
         except Exception as e:
@@ -253,23 +252,17 @@ def update_sheet_values(sheets_service, spreadsheet_id, update_data, max_retries
             time.sleep(sleep_time)
     raise Exception("バッチ更新に失敗しました")
 
-def process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=2, max_workers=20):
+def read_sku_list(sheets_service, spreadsheet_id, sheet_name, start_row=2):
     """
-    シートのC列（SKU）を読み込み、各行を処理後、
-    A列（IMAGE関数）、B列（フォルダリンク）、C列（SKU）をバッチ更新します。
-    また、処理進捗はglobal_progressにより更新します。
-    
-    ※ここでは並列処理部分を全体の90%として進捗を更新し、バッチ更新部分で残り10%を更新します。
+    シートのC列（SKU）を読み込み、開始行からのSKUのリストを返します。
     """
-    global global_progress, global_total_rows, processing_done
-    logging.info("シート '%s' の処理を開始します。開始行: %d", sheet_name, start_row)
     range_c = f"{sheet_name}!C{start_row}:C"
     logging.debug("セル範囲 %s を取得します。", range_c)
-    response = sheets_service.spreadsheets().get(
+    response = execute_with_backoff(sheets_service.spreadsheets().get(
         spreadsheetId=spreadsheet_id,
         ranges=[range_c],
         includeGridData=True
-    ).execute()
+    ), sheets_read_rate_limiter)
 
     sheet_data = response['sheets'][0]['data'][0]
     row_data = sheet_data.get('rowData', [])
@@ -280,6 +273,26 @@ def process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=2
             cell = row['values'][0]
             cell_value = cell.get('formattedValue', '').strip()
         sku_list.append(cell_value)
+    return sku_list
+
+def process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=2, max_workers=20, folder_index=None,
+                  roots=None, result_cache=None):
+    """
+    シートのC列（SKU）を読み込み、各行を処理後、
+    A列（IMAGE関数）、B列（フォルダリンク）、C列（SKU）をバッチ更新します。
+    folder_index を渡すと、SKUのフォルダはまずローカルのフォルダインデックスで解決します。
+    roots を渡すと、SKUのフォルダはルートフォルダ直下のフォルダだけで解決します。
+    result_cache を渡すと、前回までに解決したSKUはキャッシュのフォルダ・先頭画像を使います。
+    フォルダや画像が見つからなかったSKUは記録し、再検索の時期が来るまで検索しません。
+    また、処理進捗はglobal_progressにより更新します。
+    
+    ※ここでは並列処理部分を全体の90%として進捗を更新し、バッチ更新部分で残り10%を更新します。
+    """
+    global global_progress, global_total_rows, processing_done
+    _folder_link_flights.clear()
+    _image_url_flights.clear()
+    logging.info("シート '%s' の処理を開始します。開始行: %d", sheet_name, start_row)
+    sku_list = read_sku_list(sheets_service, spreadsheet_id, sheet_name, start_row)
     num_rows = len(sku_list)
     global_total_rows = num_rows
     logging.info("処理対象の行数（SKUの数）: %d", num_rows)
@@ -290,8 +303,70 @@ def process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=2
 
     start_time = time.time()
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 前回までに解決したSKUはキャッシュのフォルダ・先頭画像を使う（期限切れのものはまとめて再検証）
+        folder_ids = {}
+        first_images = {}
+        if result_cache is not None:
+            try:
+                cached = result_cache.lookup(get_thread_local_drive_service(creds), sku_list, check_drive_api_rate_limit)
+            except Exception as e:
+                logging.error("検索結果キャッシュの読み込みに失敗しました: %s", e)
+                cached = {}
+            for sku, entry in cached.items():
+                if entry['image_id']:
+                    folder_ids[sku] = entry['folder_id']
+                    first_images[entry['folder_id']] = cached_image(entry)
+            logging.info("SKU %d 件をキャッシュから解決しました。", len(folder_ids))
+            try:
+                missing = result_cache.missing(sku for sku in sku_list if sku not in folder_ids)
+            except Exception as e:
+                logging.error("検索結果キャッシュの読み込みに失敗しました: %s", e)
+                missing = {}
+            for sku, folder_id in missing.items():
+                folder_ids[sku] = folder_id
+                if folder_id:
+                    first_images[folder_id] = None
+            logging.info("前回見つからなかったSKU %d 件は再検索の時期まで検索しません。", len(missing))
+        pending_skus = [sku for sku in sku_list if sku not in folder_ids]
+        # 重複を除いたSKUをインデックスで解決し、残りを OR クエリでまとめて検索（失敗したSKUは各行で個別に検索）
+        try:
+            resolved = resolve_folders_by_skus(
+                lambda: get_thread_local_drive_service(creds), pending_skus,
+                execute=execute_drive_request, executor=executor, index=folder_index, roots=roots
+            )
+            folder_ids.update(resolved)
+            logging.info("SKU %d 件のフォルダをまとめて検索しました。", len(resolved))
+        except Exception as e:
+            logging.error("SKU のまとめ検索に失敗したため、行ごとに検索します: %s", e)
+            resolved = {}
+        # 見つかったフォルダの先頭画像を最大100件ずつまとめて取得（失敗したフォルダは各行で個別に検索）
+        resolved_ids = list(dict.fromkeys(folder_id for folder_id in resolved.values() if folder_id))
+        image_futures = [
+            executor.submit(fetch_first_images, lambda: get_thread_local_drive_service(creds),
+                            resolved_ids[i:i + MAX_BATCH_SIZE], check_drive_api_rate_limit)
+            for i in range(0, len(resolved_ids), MAX_BATCH_SIZE)
+        ]
+        for future in image_futures:
+            try:
+                images, errors = future.result()
+                first_images.update(images)
+            except Exception as e:
+                logging.error("先頭画像のまとめ取得に失敗したため、行ごとに検索します: %s", e)
+        logging.info("フォルダ %d 件の先頭画像をまとめて取得しました。", len(first_images))
+        if result_cache is not None:
+            try:
+                result_cache.store(get_thread_local_drive_service(creds), {
+                    sku: (folder_id, first_images[folder_id])
+                    for sku, folder_id in resolved.items() if first_images.get(folder_id)
+                }, check_drive_api_rate_limit)
+                result_cache.record_misses({
+                    sku: folder_id for sku, folder_id in resolved.items()
+                    if not folder_id or (folder_id in first_images and first_images[folder_id] is None)
+                }, roots=roots)
+            except Exception as e:
+                logging.error("検索結果キャッシュの保存に失敗しました: %s", e)
         future_to_index = {
-            executor.submit(process_single_row, start_row + idx, sku_list[idx], creds): idx
+            executor.submit(process_single_row, start_row + idx, sku_list[idx], creds, folder_ids, first_images): idx
             for idx in range(num_rows)
         }
         processed = 0
@@ -304,9 +379,10 @@ def process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=2
                 sku_values[idx] = sku
             except Exception as e:
                 logging.error("行 %d の処理中にエラー: %s", start_row + idx, e)
-                image_formulas[idx] = ""
-                folder_links[idx] = ""
-                sku_values[idx] = ""
+                # None のセルは batchUpdate で書き込まれないため、既存の値を残して次回に再試行する
+                image_formulas[idx] = None
+                folder_links[idx] = None
+                sku_values[idx] = None
             processed += 1
             # 進捗更新（全体の90%が並列処理側とする）
             with progress_lock:
@@ -355,6 +431,20 @@ def process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=2
     logging.info("シートのバッチ更新が全て完了しました。")
     processing_done = True
 
+def plan_sheet(sheets_service, spreadsheet_id, sheet_name, start_row=2, root_ids=None, folder_index=None,
+               result_cache=None):
+    """
+    シートを1回だけ読み込み、process_sheet に必要な API 呼び出し数と所要時間を見積もります（--plan）。
+    folder_index・result_cache を渡すと、それで解決できるSKUの検索・画像一覧は数えません。
+    """
+    sku_list = read_sku_list(sheets_service, spreadsheet_id, sheet_name, start_row)
+    known = known_lookups(sku_list, folder_index=folder_index, result_cache=result_cache)
+    plan = plan_image_formula_run(sku_list, root_ids=root_ids, known=known)
+    estimate = estimate_runtime(plan)
+    for line in format_plan(plan, estimate):
+        logging.info(line)
+    return plan, estimate
+
 # ============================================================
 # GUIパート：Tkinter で 円形プログレスバーを表示するウィンドウ
 # ============================================================
@@ -397,16 +487,28 @@ def gui_update_processing(progressbar, root):
         root.after(100, gui_update_processing, progressbar, root)
 
 def gui_update_api_usage(api_usage_bar, root):
-    with rate_limit_lock:
-        # 使用率 = (1 - (残トークン / 最大トークン)) * 100
-        usage_percentage = (1 - token_bucket / RATE_LIMIT_MAX_DRIVE) * 100
+    # 使用率 = 直近60秒の呼び出し数 / 最大数 * 100
+    usage_percentage = drive_rate_limiter.usage_percentage()
     # 色：80%以上なら赤、それ以外は緑
     arc_color = "red" if usage_percentage >= 80 else "green"
     api_usage_bar.update_progress(usage_percentage, arc_color=arc_color)
     root.after(100, gui_update_api_usage, api_usage_bar, root)
 
-def start_processing(sheets_service, creds, spreadsheet_id, sheet_name, start_row, max_workers):
-    process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=start_row, max_workers=max_workers)
+def start_processing(sheets_service, creds, spreadsheet_id, sheet_name, start_row, max_workers, rebuild_index=False,
+                     root_folders=None, recheck_missing=False, config=None):
+    # ルートフォルダの一覧・フォルダインデックスの構築は処理スレッド側で行い、GUIを止めない
+    config = config or {}
+    drive_service = get_thread_local_drive_service(creds)
+    roots = open_root_folders(config, drive_service, execute_drive_request, roots=root_folders)
+    folder_index = None
+    if roots is None:
+        folder_index = open_folder_index(config, drive_service, execute_drive_request, rebuild=rebuild_index)
+    result_cache = open_result_cache(config, recheck_missing=recheck_missing)
+    process_sheet(sheets_service, creds, spreadsheet_id, sheet_name, start_row=start_row, max_workers=max_workers,
+                  folder_index=folder_index, roots=roots, result_cache=result_cache)
+    transport_stats = format_transport_stats()
+    if transport_stats:
+        logging.info(transport_stats)
 
 # ============================================================
 # メイン
@@ -416,9 +518,53 @@ def main():
     START_ROW = 2
     MAX_WORKERS = 20
 
+    # 設定ファイルの読み込み（request.py と同じ config.json）
+    config_file = 'config.json'
+    config = {}
+    if os.path.exists(config_file):
+        try:
+            with open(config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            logging.info("設定ファイルを読み込みました。")
+        except Exception as e:
+            logging.warning("設定ファイルの読み込みに失敗しました: %s", e)
+
+    parser = argparse.ArgumentParser(description='IMAGE関数生成')
+    parser.add_argument('--plan', action='store_true',
+                        help='実行せずに必要なAPI呼び出し数と所要時間を見積もる')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='フォルダインデックスを作り直す')
+    parser.add_argument('--image-order', choices=list(IMAGE_ORDERS), default=config.get('image_order', 'name'),
+                        help='フォルダ内のどの画像を使うか（デフォルト: name）')
+    parser.add_argument('--recheck-missing', action='store_true',
+                        help='前回フォルダや画像が見つからなかったSKUも再検索する')
+    parser.add_argument('--root-folder', action='append',
+                        help='SKUフォルダを探すルートフォルダのURLまたはID（複数指定可）')
+    args = parser.parse_args()
+    # config.json の値は argparse の choices で検査されないため、不正な値は警告して既定値で実行する
+    try:
+        configure_image_order(args.image_order)
+    except ValueError as e:
+        logging.warning("%s（名前順を使用します）", e)
+    try:
+        configure_image_listing(config.get('image_listing'))
+    except ValueError as e:
+        logging.warning("%s（bulk を使用します）", e)
+
     logging.info("プログラムを開始します。")
+    # CLI・Web 版と同じクォータを共有する
+    setup_rate_limits(config)
+    setup_http_transport(config, MAX_WORKERS)
     sheets_service, creds = authenticate_google_apis()
 
+    if args.plan:
+        root_ids = parse_root_folder_ids(args.root_folder or config.get('sku_root_folders'))
+        # インデックスとキャッシュは構築・更新せず、保存済みのファイルを読み取り専用で開いて見積もる
+        plan_sheet(sheets_service, SPREADSHEET_ID, SHEET_NAME, START_ROW, root_ids=root_ids,
+                   folder_index=None if root_ids else load_folder_index(config),
+                   result_cache=open_result_cache(config, recheck_missing=args.recheck_missing, read_only=True))
+        return
+
     root = tk.Tk()
     root.title("進捗状況")
     
@@ -437,7 +583,8 @@ def main():
 
     processing_thread = threading.Thread(
         target=start_processing, 
-        args=(sheets_service, creds, SPREADSHEET_ID, SHEET_NAME, START_ROW, MAX_WORKERS),
+        args=(sheets_service, creds, SPREADSHEET_ID, SHEET_NAME, START_ROW, MAX_WORKERS, args.rebuild_index,
+              args.root_folder, args.recheck_missing, config),
         daemon=True
     )
     processing_thread.start()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+実行前に必要な API 呼び出し数と所要時間を見積もるプランナー
+"""
+
+import os
+import math
+
+from drive_lookup import chunk_folder_names, chunk_root_ids, image_listing_calls, folder_id_from_url
+from rate_limiter import RATE_LIMITERS
+
+# 1ファイルあたりのダウンロード時間の目安（秒）
+DEFAULT_DOWNLOAD_SECONDS = 0.5
+
+
+def known_lookups(skus, folder_index=None, result_cache=None) -> dict:
+    """
+    フォルダインデックスと検索結果キャッシュで、Drive を検索せずに解決できるSKUを数えます（Drive API は呼び出しません）。
+
+    戻り値の 'folders' はフォルダが分かっているSKUの {SKU: フォルダID}、'images' は先頭画像も分かっているSKU、
+    'missing' は前回見つからず再検索の時期が来ていないSKUの {SKU: フォルダID または None}（ResultCache.missing と同じ）、
+    'revalidations' は ttl を過ぎて再検証が必要なキャッシュの件数です。
+    """
+    skus = list(dict.fromkeys(sku for sku in skus if sku))
+    folders = folder_index.lookup_many(skus) if folder_index is not None else {}
+    images = set()
+    missing = {}
+    revalidations = 0
+    if result_cache is not None:
+        cached = result_cache.peek(skus)
+        folders.update({sku: entry['folder_id'] for sku, entry in cached.items()})
+        images.update(sku for sku, entry in cached.items() if entry['image_id'])
+        revalidations = sum(1 for entry in cached.values() if entry['stale'])
+        missing = result_cache.missing(sku for sku in skus if sku not in cached)
+    return {'folders': folders, 'images': images, 'missing': missing, 'revalidations': revalidations}
+
+
+def _no_known_lookups() -> dict:
+    return {'folders': {}, 'images': set(), 'missing': {}, 'revalidations': 0}
+
+
+def _lookup_queries(skus, root_ids=None) -> int:
+    if not skus:
+        return 0
+    if root_ids:
+        return len(chunk_root_ids(root_ids))
+    return len(chunk_folder_names(skus))
+
+
+def plan_download_run(values, download_dir: str, batch_size: int = 500, root_ids=None, manifest=None,
+                      known=None) -> dict:
+    """
+    ダウンロードモード（update_sheet_with_urls → process_all_rows）で必要な呼び出し数を数えます。
+
+    values は A〜E 列の値（Sheets API の values().get の結果）です。
+    A列が記入済みの行・既存ファイル・重複SKU・重複保存名はスキップとして数えます。
+    root_ids を渡すと、フォルダ検索はルートフォルダ直下の一覧（ページ送りを除く）として数えます。
+    manifest（DownloadManifest）を渡すと、実行時と同じく既存ファイルも先頭画像を調べてから判定するため、
+    台帳に記録済みのファイルは画像一覧だけ数えてスキップとし、台帳にない既存のファイルはダウンロードとして数えます。
+    known（known_lookups の結果）を渡すと、インデックス・キャッシュで解決できるSKUは検索・画像一覧から除きます。
+    前回見つからなかったSKUは実行時と同じく、フォルダが見つからなかったSKUはA列が空の行だけ、
+    画像が見つからなかったSKUは記録したフォルダが行のフォルダと同じ場合だけスキップとして数えます。
+    """
+    known = known or _no_known_lookups()
+    missing = known['missing']
+    lookup_skus = set()
+    listed_names = set()
+    lookup_rows = 0
+    save_names = set()
+    checked_names = set()
+    skipped_filled = 0
+    skipped_existing = 0
+    skipped_duplicate_sku = 0
+    skipped_duplicate_name = 0
+    skipped_empty = 0
+    skipped_missing = 0
+
+    for row in values:
+        folder_url = row[0].strip() if len(row) > 0 else ""
+        sku = row[3] if len(row) > 3 else ""
+        save_name = row[4] if len(row) > 4 else ""
+
+        if folder_url:
+            skipped_filled += 1
+            folder_id = folder_id_from_url(folder_url)
+        elif sku:
+            # 前回フォルダが見つからなかったSKUは検索せず、A列も空のままなのでダウンロードもしない
+            if sku in missing and missing[sku] is None:
+                skipped_missing += 1
+                continue
+            lookup_rows += 1
+            if sku in lookup_skus:
+                skipped_duplicate_sku += 1
+            lookup_skus.add(sku)
+            folder_id = known['folders'].get(sku)
+        else:
+            folder_id = None
+
+        # ステップ1でURLが記入される見込みの行もダウンロード対象に含める
+        if not (folder_url or sku) or not save_name:
+            skipped_empty += 1
+            continue
+        # 前回同じフォルダに画像がなかったSKUは、画像を検索せずにスキップする
+        if sku and folder_id and missing.get(sku) == folder_id:
+            skipped_missing += 1
+            continue
+        if save_name in save_names or save_name in checked_names:
+            skipped_duplicate_name += 1
+            continue
+        save_path = os.path.join(download_dir, f"{save_name}.jpg")
+        if manifest is not None:
+            if manifest.recorded(save_path):
+                skipped_existing += 1
+                checked_names.add(save_name)
+                if sku not in known['images']:
+                    listed_names.add(save_name)
+                continue
+        elif os.path.exists(save_path):
+            skipped_existing += 1
+            continue
+        save_names.add(save_name)
+        if sku not in known['images']:
+            listed_names.add(save_name)
+
+    cached_lookups = len(lookup_skus & known['folders'].keys())
+    lookup_skus.difference_update(known['folders'])
+    lookup_queries = _lookup_queries(list(lookup_skus), root_ids)
+    image_listings = image_listing_calls(len(listed_names))
+    return {
+        'rows': len(values),
+        'drive_calls': lookup_queries + image_listings + known['revalidations'],
+        'drive_lookups': len(lookup_skus),
+        'lookup_queries': lookup_queries,
+        'image_listings': image_listings,
+        'cached_lookups': cached_lookups,
+        'cache_revalidations': known['revalidations'],
+        'downloads': len(save_names),
+        'sheets_reads': 2,
+        'sheets_writes': math.ceil(lookup_rows / batch_size),
+        'skipped_filled': skipped_filled,
+        'skipped_existing': skipped_existing,
+        'skipped_duplicate_sku': skipped_duplicate_sku,
+        'skipped_duplicate_name': skipped_duplicate_name,
+        'skipped_empty': skipped_empty,
+        'skipped_missing': skipped_missing,
+    }
+
+
+def plan_image_formula_run(sku_list, chunk_size: int = 500, root_ids=None, known=None) -> dict:
+    """
+    IMAGE関数生成モード（process_sheet）で必要な呼び出し数を数えます。
+    フォルダ検索は OR クエリでまとめて行い、画像一覧は image_listing の設定に応じて数えます。
+    known（known_lookups の結果）を渡すと、インデックス・キャッシュで解決できるSKUと
+    前回見つからなかったSKUは検索・画像一覧から除きます。
+    """
+    known = known or _no_known_lookups()
+    skus = list(dict.fromkeys(sku for sku in sku_list if sku))
+    skipped_empty = sum(1 for sku in sku_list if not sku)
+    pending = [sku for sku in skus if sku not in known['missing']]
+    lookup_skus = [sku for sku in pending if sku not in known['folders']]
+    lookup_queries = _lookup_queries(lookup_skus, root_ids)
+    image_listings = image_listing_calls(sum(1 for sku in pending if sku not in known['images']))
+    return {
+        'rows': len(sku_list),
+        'drive_calls': lookup_queries + image_listings + known['revalidations'],
+        'drive_lookups': len(lookup_skus),
+        'lookup_queries': lookup_queries,
+        'image_listings': image_listings,
+        'cached_lookups': len(pending) - len(lookup_skus),
+        'cache_revalidations': known['revalidations'],
+        'downloads': 0,
+        'sheets_reads': 1,
+        'sheets_writes': math.ceil(len(sku_list) / chunk_size),
+        'skipped_filled': 0,
+        'skipped_existing': 0,
+        'skipped_duplicate_sku': len(sku_list) - skipped_empty - len(skus),
+        'skipped_duplicate_name': 0,
+        'skipped_empty': skipped_empty,
+        'skipped_missing': sum(1 for sku in sku_list if sku in known['missing']),
+    }
+
+
+def estimate_runtime(plan: dict, download_seconds: float = DEFAULT_DOWNLOAD_SECONDS,
+                     download_workers: int = 1) -> dict:
+    """
+    設定済みのクォータから各 API の所要時間（秒）と全体の見積もりを返します。
+    API ごとの時間はクォータで決まる下限で、全体はその最大値とダウンロード時間の合計です。
+    """
+    def quota_seconds(calls, name):
+        limiter = RATE_LIMITERS[name]
+        # 最初のウィンドウは上限まで即時に実行できる
+        if calls <= limiter.max_calls:
+            return 0.0
+        return (calls - limiter.max_calls) / limiter.max_calls * limiter.period
+
+    estimate = {
+        'drive': quota_seconds(plan['drive_calls'], 'drive'),
+        'sheets_read': quota_seconds(plan['sheets_reads'], 'sheets_read'),
+        'sheets_write': quota_seconds(plan['sheets_writes'], 'sheets_write'),
+        'downloads': plan['downloads'] * download_seconds / max(1, download_workers),
+    }
+    estimate['total'] = max(estimate['drive'], estimate['sheets_read'], estimate['sheets_write']) + estimate['downloads']
+    return estimate
+
+
+def format_duration(seconds: float) -> str:
+    """秒数を「X時間Y分Z秒」の形式にします。"""
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}時間{minutes}分{seconds}秒"
+    if minutes:
+        return f"{minutes}分{seconds}秒"
+    return f"{seconds}秒"
+
+
+def format_plan(plan: dict, estimate: dict) -> list:
+    """見積もり結果を表示用の行リストにします。"""
+    return [
+        f"📊 対象行数: {plan['rows']}行",
+        f"🔍 Drive フォルダ検索: {plan['drive_lookups']}件（{plan['lookup_queries']}回のクエリ）",
+        f"📦 インデックス・キャッシュで解決: {plan['cached_lookups']}件（再検証 {plan['cache_revalidations']}回）",
+        f"🖼️ Drive 画像一覧: {plan['image_listings']}回",
+        f"📥 画像ダウンロード: {plan['downloads']}件",
+        f"📄 Sheets 読み取り: {plan['sheets_reads']}回 / 書き込み: {plan['sheets_writes']}回",
+        f"⏭️ スキップ: A列記入済み {plan['skipped_filled']}行, 既存ファイル {plan['skipped_existing']}行, "
+        f"重複SKU {plan['skipped_duplicate_sku']}行, 重複保存名 {plan['skipped_duplicate_name']}行, "
+        f"空欄 {plan['skipped_empty']}行, 前回見つからなかったSKU {plan['skipped_missing']}行",
+        f"⏱️ Drive クォータによる下限: {format_duration(estimate['drive'])}",
+        f"⏱️ Sheets クォータによる下限: {format_duration(max(estimate['sheets_read'], estimate['sheets_write']))}",
+        f"⏱️ ダウンロード時間の目安: {format_duration(estimate['downloads'])}",
+        f"⏱️ 全体の見積もり: {format_duration(estimate['total'])}",
+    ]
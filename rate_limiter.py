@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Google API 呼び出し用の共有レートリミッター
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+import threading
+import collections
+
+from googleapiclient.errors import HttpError
+
+# Drive API の1分あたりの初期リクエスト数
+RATE_LIMIT_MAX_DRIVE = 2000
+# AIMD 制御で探索する Drive API の上限（プロジェクトの既定クォータ）
+RATE_LIMIT_CEILING_DRIVE = 12000
+# Sheets API の1分あたりの読み取り・書き込みリクエスト数（ユーザーごとの既定クォータ）
+RATE_LIMIT_MAX_SHEETS_READ = 60
+RATE_LIMIT_MAX_SHEETS_WRITE = 60
+
+# BatchHttpRequest 1回にまとめられるサブリクエストの最大数
+MAX_BATCH_SIZE = 100
+
+# スロットリングとみなす 403 エラーの reason
+RATE_LIMIT_REASONS = (
+    b'userRateLimitExceeded',
+    b'rateLimitExceeded',
+    b'RATE_LIMIT_EXCEEDED',
+)
+
+
+# プロセス間で共有するレート制限ストアの既定パス
+DEFAULT_SHARED_STORE_PATH = os.path.join(os.path.expanduser("~"), ".gdrive_image_downloader", "rate_limits.sqlite3")
+
+
+class QuotaExceededError(Exception):
+    """再試行してもスロットリングが解消しなかった場合に送出される例外"""
+
+
+class SharedRateStore:
+    """
+    同じマシン上の複数プロセス（CLI・Tk GUI・Web サーバー）でレート制限の状態を共有する SQLite ストア。
+
+    ・予約済みの実行時刻と AIMD の現在の上限をバケットごとに保持します。
+    ・予約は BEGIN IMMEDIATE のトランザクション内で計算するため、プロセス間でも一貫します。
+    ・直近ウィンドウ内に予約したプロセス数で上限を割り、各プロセスの取り分を公平にします。
+    ・時刻はプロセス間で比べるため clock（既定は time.time）の壁時計で記録します。
+    """
+
+    def __init__(self, path: str = DEFAULT_SHARED_STORE_PATH, client_id: str = None, clock=time.time):
+        self.path = path
+        self.client_id = client_id or f"{os.getpid()}"
+        self.clock = clock
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS slots (bucket TEXT NOT NULL, client TEXT NOT NULL, ts REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS slots_bucket_ts ON slots (bucket, ts);
+            CREATE INDEX IF NOT EXISTS slots_bucket_client_ts ON slots (bucket, client, ts);
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY, lim REAL NOT NULL, last_decrease REAL NOT NULL DEFAULT 0
+            );
+            """
+        )
+
+    def _transaction(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn, self.clock())
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    @staticmethod
+    def _load_limit(conn, name: str, default_limit: float) -> float:
+        conn.execute("INSERT OR IGNORE INTO buckets (name, lim) VALUES (?, ?)", (name, default_limit))
+        return conn.execute("SELECT lim FROM buckets WHERE name = ?", (name,)).fetchone()[0]
+
+    def reserve(self, name: str, period: float, default_limit: float, ceiling: float,
+                pending_increase: float = 0.0):
+        """
+        1回分の実行枠を予約し、(待機秒数, 現在の上限) を返します。
+        pending_increase は前回の予約以降に成功した呼び出しによる上限の引き上げ分です。
+        """
+        def reserve_slot(conn, now):
+            limit = self._load_limit(conn, name, default_limit)
+            if pending_increase:
+                limit = min(ceiling, limit + pending_increase)
+                conn.execute("UPDATE buckets SET lim = ? WHERE name = ?", (limit, name))
+            conn.execute("DELETE FROM slots WHERE bucket = ? AND ts <= ?", (name, now - period))
+            clients = conn.execute(
+                "SELECT COUNT(DISTINCT client) FROM slots WHERE bucket = ? AND client != ?",
+                (name, self.client_id)
+            ).fetchone()[0] + 1
+            total_limit = max(1, int(limit))
+            share = max(1, total_limit // clients)
+            slot = now
+            # 全体の上限: total_limit 件前の予約がウィンドウから外れる時刻
+            row = conn.execute(
+                "SELECT ts FROM slots WHERE bucket = ? ORDER BY ts DESC LIMIT 1 OFFSET ?",
+                (name, total_limit - 1)
+            ).fetchone()
+            if row:
+                slot = max(slot, row[0] + period)
+            # 公平な取り分: 自プロセスの share 件前の予約がウィンドウから外れる時刻
+            row = conn.execute(
+                "SELECT ts FROM slots WHERE bucket = ? AND client = ? ORDER BY ts DESC LIMIT 1 OFFSET ?",
+                (name, self.client_id, share - 1)
+            ).fetchone()
+            if row:
+                slot = max(slot, row[0] + period)
+            conn.execute("INSERT INTO slots (bucket, client, ts) VALUES (?, ?, ?)", (name, self.client_id, slot))
+            return slot - now, limit
+
+        return self._transaction(reserve_slot)
+
+    def decrease(self, name: str, default_limit: float, factor: float, min_limit: float, cooldown: float):
+        """
+        上限を factor 倍に下げて新しい上限を返します。
+        他プロセスが直前に下げたばかりの場合は None を返します。
+        """
+        def decrease_limit(conn, now):
+            limit = self._load_limit(conn, name, default_limit)
+            last_decrease = conn.execute(
+                "SELECT last_decrease FROM buckets WHERE name = ?", (name,)
+            ).fetchone()[0]
+            if now - last_decrease < cooldown:
+                return None
+            limit = max(min_limit, limit * factor)
+            conn.execute("UPDATE buckets SET lim = ?, last_decrease = ? WHERE name = ?", (limit, now, name))
+            return limit
+
+        return self._transaction(decrease_limit)
+
+    def set_limit(self, name: str, limit: float, ceiling: float) -> float:
+        """
+        上限を設定し直し、共有している上限を返します。
+        他プロセスが使用中の上限（AIMD で下げた値と直前に下げた時刻）は初期化せず、ceiling を超える分だけ下げます。
+        """
+        def update_limit(conn, now):
+            conn.execute("INSERT OR IGNORE INTO buckets (name, lim) VALUES (?, ?)", (name, limit))
+            conn.execute("UPDATE buckets SET lim = MIN(lim, ?) WHERE name = ?", (ceiling, name))
+            return conn.execute("SELECT lim FROM buckets WHERE name = ?", (name,)).fetchone()[0]
+
+        return self._transaction(update_limit)
+
+    def used(self, name: str, period: float) -> int:
+        """直近ウィンドウ内で全プロセスが実行した呼び出し数を返します。"""
+        now = self.clock()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM slots WHERE bucket = ? AND ts > ? AND ts <= ?",
+                (name, now - period, now)
+            ).fetchone()[0]
+
+
+class RateLimiter:
+    """
+    スライディングウィンドウ方式のレートリミッター。
+
+    ・直近 period 秒間の呼び出し数が上限を超えないように各呼び出しの実行時刻を予約します。
+    ・予約の計算だけをロック内で行い、待機（sleep）はロックの外で行うため、
+      待機中のスレッドが他のスレッドをブロックしません。
+    ・adaptive=True の場合は AIMD 方式で上限を調整します。
+      403/429 のスロットリング応答で上限を decrease_factor 倍に下げ、
+      成功が続くと1ウィンドウあたり increase_step ずつ ceiling まで引き上げます。
+    ・clock は単調増加する時刻（既定は time.monotonic）を返す関数です。
+    """
+
+    def __init__(self, max_calls: int, period: float = 60.0, name: str = "drive",
+                 adaptive: bool = False, ceiling: int = None, min_calls: int = None,
+                 increase_step: float = None, decrease_factor: float = 0.5,
+                 decrease_cooldown: float = None, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.max_calls = max_calls
+        self.period = period
+        self.adaptive = adaptive
+        self.ceiling = ceiling or max_calls
+        self.min_calls = min_calls or max(1, max_calls // 20)
+        self.increase_step = increase_step or max(1.0, max_calls / 20)
+        self.decrease_factor = decrease_factor
+        # 連続したスロットリング応答で何度も下げないよう、下げた後しばらくは据え置く
+        self.decrease_cooldown = decrease_cooldown if decrease_cooldown is not None else period / 6
+        self.limit = float(max_calls)
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        # 予約済みの実行時刻（昇順）。未来の時刻を含むことがあります。
+        self._slots = collections.deque()
+        # プロセス間で共有する場合のストア（enable_shared_rate_limits で設定）
+        self.store = None
+        self._pending_increase = 0.0
+
+    def configure(self, max_calls: int, ceiling: int = None):
+        """上限を設定し直します（config.json の rate_limits から呼ばれます）。"""
+        with self._lock:
+            self.max_calls = max_calls
+            self.ceiling = max(max_calls, ceiling or self.ceiling)
+            self.min_calls = max(1, max_calls // 20)
+            self.increase_step = max(1.0, max_calls / 20)
+            self.limit = float(max_calls)
+        if self.store:
+            self.limit = self.store.set_limit(self.name, self.limit, self.ceiling)
+
+    def _purge(self, now: float):
+        while self._slots and self._slots[0] <= now - self.period:
+            self._slots.popleft()
+
+    def reserve(self) -> float:
+        """
+        1回分の実行枠を予約し、実行まで待機すべき秒数を返します（待機はしません）。
+        """
+        if self.store:
+            return self._reserve_shared()
+        with self._lock:
+            now = self.clock()
+            self._purge(now)
+            limit = max(1, int(self.limit))
+            if len(self._slots) < limit:
+                slot = now
+            else:
+                # limit 件前の予約がウィンドウから外れる時刻まで待つ
+                slot = max(now, self._slots[-limit] + self.period)
+            self._slots.append(slot)
+        return slot - now
+
+    def _reserve_shared(self) -> float:
+        with self._lock:
+            pending, self._pending_increase = self._pending_increase, 0.0
+        try:
+            wait_time, limit = self.store.reserve(self.name, self.period, self.limit, self.ceiling, pending)
+        except sqlite3.Error as e:
+            logging.warning("共有レート制限ストアが使えないため、プロセス内の制限に切り替えます: %s", e)
+            self.store = None
+            return self.reserve()
+        self.limit = limit
+        return wait_time
+
+    def acquire(self) -> float:
+        """
+        実行枠を予約し、必要ならロックの外で待機します。待機した秒数を返します。
+        """
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+    async def acquire_async(self) -> float:
+        """
+        acquire の asyncio 版です。待機中もイベントループを止めません。
+        共有ストアでの予約は SQLite のロック待ちでブロックすることがあるため、別スレッドで行います。
+        """
+        wait_time = await asyncio.to_thread(self.reserve) if self.store else self.reserve()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        return wait_time
+
+    def on_success(self):
+        """成功応答を記録し、上限を加算的に引き上げます（adaptive のみ）。"""
+        if not self.adaptive:
+            return
+        with self._lock:
+            if self.limit < self.ceiling:
+                increase = self.increase_step / self.limit
+                self.limit = min(self.ceiling, self.limit + increase)
+                if self.store:
+                    # 共有ストアへは次回の予約時にまとめて反映する
+                    self._pending_increase += increase
+
+    def on_throttle(self):
+        """スロットリング応答を記録し、上限を乗算的に引き下げます（adaptive のみ）。"""
+        if not self.adaptive:
+            return
+        if self.store:
+            try:
+                new_limit = self.store.decrease(self.name, self.limit, self.decrease_factor,
+                                                self.min_calls, self.decrease_cooldown)
+            except sqlite3.Error as e:
+                logging.warning("共有レート制限ストアの更新に失敗しました: %s", e)
+                return
+            if new_limit is None:
+                return
+            self.limit = new_limit
+            logging.warning("%s API のスロットリングを検出したため、上限を %.0f 回/分に下げます。",
+                            self.name, new_limit)
+            return
+        with self._lock:
+            now = self.clock()
+            if now - self._last_decrease < self.decrease_cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_calls, self.limit * self.decrease_factor)
+            new_limit = self.limit
+        logging.warning("%s API のスロットリングを検出したため、上限を %.0f 回/分に下げます。",
+                        self.name, new_limit)
+
+    async def on_throttle_async(self):
+        """on_throttle の asyncio 版です。共有ストアの更新は別スレッドで行います。"""
+        if self.store:
+            await asyncio.to_thread(self.on_throttle)
+        else:
+            self.on_throttle()
+
+    def usage_percentage(self) -> float:
+        """直近ウィンドウ内の使用率（%）を返します。"""
+        if self.store:
+            used = self.store.used(self.name, self.period)
+            return min(100.0, used / max(1, int(self.limit)) * 100)
+        with self._lock:
+            now = self.clock()
+            self._purge(now)
+            used = sum(1 for slot in self._slots if slot <= now)
+            limit = max(1, int(self.limit))
+        return min(100.0, used / limit * 100)
+
+    def remaining(self, usage: float = None) -> float:
+        """
+        直近ウィンドウ内の残り呼び出し可能数を返します。
+        usage（usage_percentage の値）を渡すと、使用率を数え直さずにその値から計算します。
+        """
+        if usage is None:
+            usage = self.usage_percentage()
+        return max(0.0, self.limit * (1 - usage / 100))
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """HttpError がスロットリング（429 または rateLimitExceeded 系の 403）かどうかを判定します。"""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status == 429:
+        return True
+    if status == 403:
+        content = error.content or b''
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def execute_with_backoff(request, limiter: RateLimiter, acquire=None,
+                         max_retries: int = 6, max_backoff: float = 64.0):
+    """
+    googleapiclient のリクエストをレート制御付きで実行します。
+
+    スロットリング応答の場合はリミッターに通知したうえで指数バックオフで再試行し、
+    max_retries 回失敗したら QuotaExceededError を送出します。
+    それ以外のエラーはそのまま送出します。
+    """
+    acquire = acquire or limiter.acquire
+    for attempt in range(max_retries + 1):
+        acquire()
+        try:
+            result = request.execute()
+        except HttpError as e:
+            if not is_rate_limit_error(e):
+                raise
+            limiter.on_throttle()
+            if attempt == max_retries:
+                raise QuotaExceededError(f"{limiter.name} API のクォータ超過が解消しませんでした: {e}") from e
+            sleep_time = min(max_backoff, 2 ** attempt) + random.uniform(0, 1)
+            logging.warning("%s API のスロットリング（試行 %d/%d）。%.1f秒後に再試行します。",
+                            limiter.name, attempt + 1, max_retries, sleep_time)
+            time.sleep(sleep_time)
+            continue
+        limiter.on_success()
+        return result
+
+
+def execute_batch_with_backoff(service, requests: dict, limiter: RateLimiter, acquire=None,
+                               max_retries: int = 6, max_backoff: float = 64.0):
+    """
+    複数のリクエストを BatchHttpRequest（1回あたり最大 MAX_BATCH_SIZE 件）でまとめて実行します。
+
+    requests は {キー: リクエスト} で、({キー: 応答}, {キー: 例外}) を返します。
+    サブリクエストも1件ずつリミッターの実行枠を消費します。スロットリングされたサブリクエストだけを
+    指数バックオフで再試行し、max_retries 回失敗したものは QuotaExceededError を例外として返します。
+    """
+    acquire = acquire or limiter.acquire
+    responses = {}
+    errors = {}
+    pending = list(requests)
+    for attempt in range(max_retries + 1):
+        throttled = []
+        for i in range(0, len(pending), MAX_BATCH_SIZE):
+            keys = pending[i:i + MAX_BATCH_SIZE]
+
+            def callback(request_id, response, exception):
+                key = keys[int(request_id)]
+                if exception is None:
+                    limiter.on_success()
+                    responses[key] = response
+                elif is_rate_limit_error(exception):
+                    throttled.append(key)
+                else:
+                    errors[key] = exception
+
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, key in enumerate(keys):
+                acquire()
+                batch.add(requests[key], request_id=str(request_id))
+            try:
+                batch.execute()
+            except HttpError as e:
+                if not is_rate_limit_error(e):
+                    raise
+                # バッチ全体が拒否された場合は、応答のなかったサブリクエストをすべて再試行する
+                throttled.extend(key for key in keys if key not in responses and key not in errors
+                                 and key not in throttled)
+        if not throttled:
+            break
+        limiter.on_throttle()
+        if attempt == max_retries:
+            for key in throttled:
+                errors[key] = QuotaExceededError(f"{limiter.name} API のクォータ超過が解消しませんでした")
+            break
+        sleep_time = min(max_backoff, 2 ** attempt) + random.uniform(0, 1)
+        logging.warning("%s API のバッチで %d 件がスロットリングされました（試行 %d/%d）。%.1f秒後に再試行します。",
+                        limiter.name, len(throttled), attempt + 1, max_retries, sleep_time)
+        time.sleep(sleep_time)
+        pending = throttled
+    return responses, errors
+
+
+# 全エントリーポイント（request.py / a.py / image.py / simple_gui.py）で共有する API・操作ごとのリミッター
+drive_rate_limiter = RateLimiter(RATE_LIMIT_MAX_DRIVE, name="drive", adaptive=True,
+                                 ceiling=RATE_LIMIT_CEILING_DRIVE)
+sheets_read_rate_limiter = RateLimiter(RATE_LIMIT_MAX_SHEETS_READ, name="sheets_read", adaptive=True)
+sheets_write_rate_limiter = RateLimiter(RATE_LIMIT_MAX_SHEETS_WRITE, name="sheets_write", adaptive=True)
+
+RATE_LIMITERS = {
+    limiter.name: limiter
+    for limiter in (drive_rate_limiter, sheets_read_rate_limiter, sheets_write_rate_limiter)
+}
+
+
+def configure_rate_limits(rate_limits: dict):
+    """
+    config.json の rate_limits 設定を各リミッターに反映します。
+
+    例: {"drive": 2000, "sheets_read": 60, "sheets_write": {"max": 60, "ceiling": 60}}
+    """
+    for name, value in (rate_limits or {}).items():
+        limiter = RATE_LIMITERS.get(name)
+        if limiter is None:
+            logging.warning("不明なレート制限 '%s' は無視します。", name)
+            continue
+        if isinstance(value, dict):
+            limiter.configure(int(value['max']), value.get('ceiling'))
+        else:
+            limiter.configure(int(value))
+
+
+def enable_shared_rate_limits(path: str = None):
+    """
+    全リミッターの状態を SQLite ファイルで共有し、同じマシン上の複数プロセスが
+    1つのクォータを公平に分け合うようにします。ストアを開けない場合はプロセス内の制限を使い続けます。
+    """
+    try:
+        store = SharedRateStore(path or DEFAULT_SHARED_STORE_PATH)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning("共有レート制限ストアを開けませんでした。プロセス内の制限を使用します: %s", e)
+        return None
+    for limiter in RATE_LIMITERS.values():
+        limiter.store = store
+    return store
+
+
+def setup_rate_limits(config: dict):
+    """
+    config.json の設定からレート制限を初期化します。
+
+    ・rate_limit_store: 共有ストアのパス（省略時は既定のパス、false でプロセス内のみ）
+    ・rate_limits: API・操作ごとの上限（configure_rate_limits を参照）
+    """
+    store_path = config.get('rate_limit_store')
+    if store_path is not False:
+        enable_shared_rate_limits(store_path)
+    configure_rate_limits(config.get('rate_limits'))
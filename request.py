@@ -1,67 +1,63 @@
 import os
 import re
 import sys
-import time
 import logging
-import threading
-import requests
+import functools
 import argparse
 from typing import Union
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from google.auth.exceptions import RefreshError
 
+from drive_lookup import (
+    resolve_folders_by_skus, folder_url_from_id, open_root_folders, parse_root_folder_ids,
+    fetch_first_images, configure_image_order, configure_image_listing, IMAGE_ORDERS,
+)
+from folder_index import open_folder_index, load_folder_index
+from result_cache import open_result_cache, cached_image
+from download_manifest import open_download_manifest
+from blob_store import open_blob_store
+from planner import plan_download_run, known_lookups, estimate_runtime, format_plan
+from drive_clients import build_service, get_drive_client, get_drive_client_pool
+from http_transport import setup_http_transport, format_transport_stats
+from drive_download import download_drive_file
+from download_engine import DownloadEngine, DEFAULT_DOWNLOAD_WORKERS, FAILED, format_download_counts
+from async_pipeline import ENGINES, DEFAULT_ENGINE, run_pipeline, format_pipeline_counts
+from rate_limiter import (
+    drive_rate_limiter, sheets_read_rate_limiter, sheets_write_rate_limiter,
+    execute_with_backoff, setup_rate_limits, MAX_BATCH_SIZE,
+)
+
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
+# SKU を並列で検索するワーカー数
+SEARCH_WORKERS = 10
+
 # 使用スコープ
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive.readonly'
 ]
 
-# スレッドローカルに Drive サービス保持
-_thread_local = threading.local()
-
-# トークンバケット方式で Drive API レート制御
-RATE_LIMIT_MAX_DRIVE = 2000
-token_bucket = RATE_LIMIT_MAX_DRIVE
-last_refill = time.time()
-rate_limit_lock = threading.Lock()
-
+# スライディングウィンドウ方式で Drive API レート制御（全エントリーポイントで共有）
 def check_drive_api_rate_limit():
-    global token_bucket, last_refill
-    with rate_limit_lock:
-        now = time.time()
-        if now - last_refill >= 60:
-            logging.info("1分経過のため、10秒待機してトークンをリセットします。")
-            time.sleep(10)
-            token_bucket = RATE_LIMIT_MAX_DRIVE
-            last_refill = time.time()
-            now = last_refill
-
-        elapsed = now - last_refill
-        token_bucket = min(RATE_LIMIT_MAX_DRIVE, token_bucket + elapsed * (RATE_LIMIT_MAX_DRIVE/60))
-        last_refill = now
-
-        while token_bucket < 1:
-            wait_time = (1 - token_bucket) * (60 / RATE_LIMIT_MAX_DRIVE)
-            logging.info(f"トークン不足のため {wait_time:.2f}秒待機します。")
-            time.sleep(wait_time)
-            now = time.time()
-            elapsed = now - last_refill
-            token_bucket = min(RATE_LIMIT_MAX_DRIVE, token_bucket + elapsed * (RATE_LIMIT_MAX_DRIVE/60))
-            last_refill = now
-
-        token_bucket -= 1
+    wait_time = drive_rate_limiter.acquire()
+    if wait_time > 0:
+        logging.info(f"レート上限に達したため {wait_time:.2f}秒待機しました。")
+
+def execute_drive_request(request):
+    """
+    Drive API リクエストをレート制御付きで実行する。
+    スロットリング（403/429）の場合はリミッターの上限を下げて再試行します。
+    """
+    return execute_with_backoff(request, drive_rate_limiter, acquire=check_drive_api_rate_limit)
 
 def get_drive_service(creds):
-    if not hasattr(_thread_local, 'drive'):
-        _thread_local.drive = build('drive', 'v3', credentials=creds)
-    return _thread_local.drive
+    # 共有のクライアントプールから、スレッドごとに専用のクライアントを取得する
+    return get_drive_client(creds)
 
 def authenticate():
     """
@@ -137,7 +133,7 @@ def authenticate():
         with open(token_path, 'w') as f:
             f.write(creds.to_json())
 
-    sheets_service = build('sheets', 'v4', credentials=creds)
+    sheets_service = build_service('sheets', 'v4', creds)
     return sheets_service, creds
 
 def extract_folder_id(url: str) -> Union[str, None]:
@@ -165,58 +161,25 @@ def extract_spreadsheet_id(url: str) -> Union[str, None]:
     
     return None
 
-def fetch_first_image_url(drive_service, folder_id: str) -> Union[str, None]:
-    check_drive_api_rate_limit()
-    resp = drive_service.files().list(
-        q=f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false",
-        fields="files(id,name)"
-    ).execute()
-    files = resp.get('files', [])
-    if not files:
-        return None
-    files.sort(key=lambda f: f['name'])
-    file_id = files[0]['id']
-    return f"https://drive.google.com/uc?export=view&id={file_id}"
-
-def search_folder_by_sku(drive_service, sku: str) -> Union[str, None]:
-    """
-    SKU名でGoogle Drive内のフォルダを検索し、フォルダURLを返す（高速化版）
-    """
-    check_drive_api_rate_limit()
-    
-    # SKU名でフォルダを検索（より効率的なクエリ）
-    query = f"name='{sku}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-    try:
-        resp = drive_service.files().list(
-            q=query,
-            fields="files(id,name)",
-            pageSize=1  # 最初の1件のみ取得
-        ).execute()
-        files = resp.get('files', [])
-        
-        if not files:
-            return None
-        
-        folder_id = files[0]['id']
-        folder_url = f"https://drive.google.com/drive/folders/{folder_id}"
-        return folder_url
-    except Exception as e:
-        logging.error(f"SKU '{sku}' の検索でエラー: {e}")
-        return None
-
-def update_sheet_with_urls(sheets_service, drive_service, spreadsheet_id: str, sheet_name: str, start_row: int = 2):
+def update_sheet_with_urls(sheets_service, drive_service, spreadsheet_id: str, sheet_name: str, start_row: int = 2,
+                           folder_index=None, roots=None, result_cache=None):
     """
     D列のSKUからフォルダURLを検索してA列に記載する（高速化版）
+    drive_service は並列のワーカーからも使うため、スレッドごとのクライアントを返す関数（DriveClientPool）を渡す
+    folder_index を渡すとローカルのフォルダインデックスで解決し、ないSKUだけを Drive で検索する
+    roots を渡すとルートフォルダ直下のフォルダだけで解決する
+    result_cache を渡すと前回までに解決したSKUはキャッシュを使い、新たに解決したSKUを保存する
+    （フォルダが見つからなかったSKUは記録し、再検索の時期が来るまで検索しない）
     """
     print("=" * 60)
     print("🚀 A列URL記載を高速化モードで開始します...")
     print("=" * 60)
     
     RANGE = f"{sheet_name}!A{start_row}:E"
-    resp = sheets_service.spreadsheets().values().get(
+    resp = execute_with_backoff(sheets_service.spreadsheets().values().get(
         spreadsheetId=spreadsheet_id,
         range=RANGE
-    ).execute()
+    ), sheets_read_rate_limiter)
     values = resp.get('values', [])
     
     # 処理対象の行を特定
@@ -239,86 +202,108 @@ def update_sheet_with_urls(sheets_service, drive_service, spreadsheet_id: str, s
     
     print(f"📊 処理対象: {len(target_rows)}行")
     
-    # 並列処理でURL検索を高速化
+    # 複数SKUを OR クエリでまとめて検索し、チャンクは並列処理で高速化
     import concurrent.futures
-    from functools import partial
-    
-    def search_sku_with_cache(sku, cache):
-        if sku in cache:
-            return cache[sku]
-        result = search_folder_by_sku(drive_service, sku)
-        cache[sku] = result
-        return result
     
-    # キャッシュを初期化
+    # キャッシュを初期化（永続キャッシュにあるSKUは検索しない）
     sku_cache = {}
+    if result_cache is not None:
+        try:
+            cached = result_cache.lookup(drive_service, [sku for _, sku in target_rows], check_drive_api_rate_limit)
+            sku_cache.update({sku: entry['folder_id'] for sku, entry in cached.items()})
+            print(f"📦 キャッシュから解決: {len(cached)}件")
+            missing = result_cache.missing(sku for _, sku in target_rows if sku not in sku_cache)
+            no_folder = {sku for sku, folder_id in missing.items() if folder_id is None}
+            if no_folder:
+                target_rows = [(idx, sku) for idx, sku in target_rows if sku not in no_folder]
+                print(f"⏭️ 前回フォルダが見つからなかったSKU: {len(no_folder)}件（再検索の時期まで検索しません）")
+        except Exception as e:
+            logging.error(f"検索結果キャッシュの読み込みでエラー: {e}")
     updates = []
     processed_count = 0
     
-    # バッチサイズを設定（API制限を考慮）
-    BATCH_SIZE = 50
+    # バッチサイズを設定（バッチごとに検索結果をシートへ書き込む）
+    BATCH_SIZE = 500
     
-    for i in range(0, len(target_rows), BATCH_SIZE):
-        batch = target_rows[i:i + BATCH_SIZE]
-        
-        # 並列処理でURL検索
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            # 部分関数を作成
-            search_func = partial(search_sku_with_cache, cache=sku_cache)
-            # 並列実行
-            future_to_sku = {executor.submit(search_func, sku): (idx, sku) for idx, sku in batch}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+        for i in range(0, len(target_rows), BATCH_SIZE):
+            batch = target_rows[i:i + BATCH_SIZE]
+            
+            # 未検索のSKUだけをまとめて検索
+            pending_skus = [sku for _, sku in batch if sku not in sku_cache]
+            try:
+                resolved = resolve_folders_by_skus(
+                    drive_service, pending_skus, execute=execute_drive_request, executor=executor,
+                    index=folder_index, roots=roots
+                )
+                sku_cache.update(resolved)
+            except Exception as e:
+                logging.error(f"行 {batch[0][0]}～{batch[-1][0]} のSKU検索でエラー: {e}")
+                continue
+            if result_cache is not None:
+                try:
+                    result_cache.store(drive_service, {
+                        sku: (folder_id, None) for sku, folder_id in resolved.items() if folder_id
+                    }, check_drive_api_rate_limit)
+                    result_cache.record_misses({sku: None for sku, folder_id in resolved.items() if not folder_id},
+                                               roots=roots)
+                except Exception as e:
+                    logging.error(f"検索結果キャッシュの保存でエラー: {e}")
             
-            for future in concurrent.futures.as_completed(future_to_sku):
-                idx, sku = future_to_sku[future]
+            for idx, sku in batch:
+                folder_id = sku_cache.get(sku)
+                if folder_id:
+                    updates.append({
+                        'range': f"{sheet_name}!A{idx}",
+                        'values': [[folder_url_from_id(folder_id)]]
+                    })
+                    processed_count += 1
+                    if processed_count % 10 == 0:
+                        print(f"⏳ 処理中... {processed_count}/{len(target_rows)}行完了")
+            
+            # バッチごとに更新を実行
+            if updates:
                 try:
-                    folder_url = future.result()
-                    if folder_url:
-                        updates.append({
-                            'range': f"{sheet_name}!A{idx}",
-                            'values': [[folder_url]]
-                        })
-                        processed_count += 1
-                        if processed_count % 10 == 0:
-                            print(f"⏳ 処理中... {processed_count}/{len(target_rows)}行完了")
+                    body = {
+                        'valueInputOption': 'RAW',
+                        'data': updates
+                    }
+                    execute_with_backoff(sheets_service.spreadsheets().values().batchUpdate(
+                        spreadsheetId=spreadsheet_id,
+                        body=body
+                    ), sheets_write_rate_limiter)
+                    print(f"✅ バッチ更新完了: {len(updates)}行")
+                    updates = []  # 更新リストをリセット
                 except Exception as e:
-                    logging.error(f"Row {idx}: SKU '{sku}' の処理でエラー: {e}")
+                    logging.error(f"バッチ更新でエラー: {e}")
         
-        # バッチごとに更新を実行
-        if updates:
-            try:
-                body = {
-                    'valueInputOption': 'RAW',
-                    'data': updates
-                }
-                sheets_service.spreadsheets().values().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body=body
-                ).execute()
-                print(f"✅ バッチ更新完了: {len(updates)}行")
-                updates = []  # 更新リストをリセット
-            except Exception as e:
-                logging.error(f"バッチ更新でエラー: {e}")
-    
     print("=" * 60)
     print(f"🎉 A列URL記載が完了しました！")
     print(f"📈 処理結果: {processed_count}行のURLを記載")
     print("=" * 60)
 
-def download_image(url: str, save_path: str):
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    resp = requests.get(url, stream=True)
-    resp.raise_for_status()
-    with open(save_path, 'wb') as f:
-        for chunk in resp.iter_content(8192):
-            f.write(chunk)
+def download_image(drive_service, file_id: str, save_path: str, md5_checksum: str = None):
+    # 公開リンクではなく認証済みの files.get_media でチャンクごとに取得する
+    result = download_drive_file(drive_service, file_id, save_path, acquire=check_drive_api_rate_limit,
+                                 md5_checksum=md5_checksum)
     logging.info(f"Downloaded: {save_path}")
+    return result
 
-def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str, start_row: int = 2):
+def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str, start_row: int = 2,
+                     result_cache=None, download_workers: int = DEFAULT_DOWNLOAD_WORKERS, manifest=None,
+                     blob_store=None):
+    """
+    A列のフォルダURLから先頭画像を探し、E列の保存名でダウンロードする
+    result_cache を渡すと、D列のSKUでキャッシュ済みの先頭画像を使い、新たに見つけた画像を保存する
+    manifest（ダウンロード台帳）を渡すと、既存のファイルも元の画像が変わっていないかを確認してスキップする
+    blob_store（共有ストア）を渡すと、他の保存名・ダウンロード先で取得済みの画像はハードリンクで済ませる
+    ダウンロードは最大 download_workers 件を並列に行い、その間に次のバッチの画像を検索する
+    """
     RANGE = f"{sheet_name}!A{start_row}:E"
-    resp = sheets_service.spreadsheets().values().get(
+    resp = execute_with_backoff(sheets_service.spreadsheets().values().get(
         spreadsheetId=spreadsheet_id,
         range=RANGE
-    ).execute()
+    ), sheets_read_rate_limiter)
     values = resp.get('values', [])
 
     drive_service = get_drive_service(creds)
@@ -327,10 +312,13 @@ def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str
     if 'DOWNLOAD_BASE_DIR' in globals():
         base_dir = DOWNLOAD_BASE_DIR
     else:
-    base_dir = os.path.abspath("downloaded_images")
+        base_dir = os.path.abspath("downloaded_images")
 
+    # ダウンロード対象の行を特定
+    targets = []
     for idx, row in enumerate(values, start=start_row):
         folder_url = row[0] if len(row) > 0 else ""
+        sku        = row[3] if len(row) > 3 else ""
         save_name  = row[4] if len(row) > 4 else ""
         
         # A列にURLが記載されていない場合はスキップ
@@ -343,7 +331,8 @@ def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str
             continue
 
         save_path = os.path.join(base_dir, f"{save_name}.jpg")
-        if os.path.exists(save_path):
+        # 台帳がある場合は、既存のファイルも先頭画像を調べてからエンジン側で判定する
+        if manifest is None and os.path.exists(save_path):
             logging.info(f"Row {idx}: {save_name}.jpg already exists. Skipped.")
             continue
 
@@ -352,15 +341,102 @@ def process_all_rows(sheets_service, creds, spreadsheet_id: str, sheet_name: str
             logging.warning(f"Row {idx}: Failed to extract folder ID from {folder_url}")
             continue
 
-        image_url = fetch_first_image_url(drive_service, folder_id)
-        if not image_url:
-            logging.warning(f"Row {idx}: No images found in folder {folder_id}")
-            continue
+        targets.append((idx, sku, save_name, save_path, folder_id))
 
+    # キャッシュ済みの先頭画像（SKUとフォルダが一致するもの）は検索しない
+    cached_images = {}
+    if result_cache is not None:
         try:
-            download_image(image_url, save_path)
+            cached = result_cache.lookup(drive_service, [sku for _, sku, _, _, _ in targets], check_drive_api_rate_limit)
+            for _, sku, _, _, folder_id in targets:
+                entry = cached.get(sku)
+                if entry and entry['image_id'] and entry['folder_id'] == folder_id:
+                    cached_images[folder_id] = cached_image(entry)
+            logging.info(f"キャッシュから先頭画像を解決: {len(cached_images)}件")
+            # 前回同じフォルダに画像がなかったSKUは、再検索の時期が来るまで検索しない
+            missing = result_cache.missing(sku for _, sku, _, _, folder_id in targets if folder_id not in cached_images)
+            skipped = [target for target in targets if target[1] in missing and missing[target[1]] == target[4]]
+            for idx, _, _, _, folder_id in skipped:
+                logging.info(f"Row {idx}: 前回フォルダ {folder_id} に画像がなかったためスキップします。")
+            targets = [target for target in targets if target not in skipped]
         except Exception as e:
-            logging.error(f"Row {idx}: Download failed: {e}")
+            logging.error(f"検索結果キャッシュの読み込みでエラー: {e}")
+
+    # 先頭画像の検索は最大100フォルダずつまとめて行う（親フォルダの OR 検索または BatchHttpRequest）
+    # 同じフォルダが複数のバッチに出てくる場合も、検索は最初の1回だけにする
+    failed_count = 0
+    drive_pool = get_drive_client_pool(creds)
+    with DownloadEngine(functools.partial(download_image, drive_pool), download_workers,
+                        manifest=manifest, blob_store=blob_store) as engine:
+        for i in range(0, len(targets), MAX_BATCH_SIZE):
+            batch = targets[i:i + MAX_BATCH_SIZE]
+            pending_ids = [folder_id for _, _, _, _, folder_id in batch if folder_id not in cached_images]
+            try:
+                images, errors = fetch_first_images(drive_service, pending_ids, acquire=check_drive_api_rate_limit)
+            except Exception as e:
+                logging.error(f"Row {batch[0][0]}～{batch[-1][0]}: 画像検索のバッチでエラー: {e}")
+                failed_count += len(batch)
+                continue
+            if result_cache is not None:
+                try:
+                    result_cache.store(drive_service, {
+                        sku: (folder_id, images[folder_id])
+                        for _, sku, _, _, folder_id in batch if images.get(folder_id)
+                    }, check_drive_api_rate_limit)
+                    result_cache.record_misses({
+                        sku: folder_id for _, sku, _, _, folder_id in batch
+                        if folder_id in images and images[folder_id] is None
+                    })
+                except Exception as e:
+                    logging.error(f"検索結果キャッシュの保存でエラー: {e}")
+            cached_images.update(images)
+            images = cached_images
+
+            for idx, sku, save_name, save_path, folder_id in batch:
+                if folder_id in errors:
+                    logging.error(f"Row {idx}: {errors[folder_id]}")
+                    failed_count += 1
+                    continue
+                first_file = images.get(folder_id)
+                if not first_file:
+                    logging.warning(f"Row {idx}: No images found in folder {folder_id}")
+                    failed_count += 1
+                    continue
+                # 既に存在する保存先と、同じ保存名の2行目以降はエンジン側でスキップする
+                engine.submit(idx, save_name, save_path, first_file['id'],
+                              first_file.get('md5Checksum'), first_file.get('size'))
+
+    counts = dict(engine.counts)
+    counts[FAILED] += failed_count
+    logging.info(f"画像ダウンロードが完了しました: {format_download_counts(counts)}")
+
+def plan_run(sheets_service, spreadsheet_id: str, sheet_name: str, start_row: int = 2, download_dir: str = None,
+             root_ids=None, download_workers: int = DEFAULT_DOWNLOAD_WORKERS, manifest=None, folder_index=None,
+             result_cache=None):
+    """
+    シートを1回だけ読み込み、実行に必要な API 呼び出し数と所要時間を見積もる（--plan）
+    folder_index・result_cache を渡すと、それで解決できるSKUの検索・画像一覧は数えない
+    """
+    RANGE = f"{sheet_name}!A{start_row}:E"
+    resp = execute_with_backoff(sheets_service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=RANGE
+    ), sheets_read_rate_limiter)
+    values = resp.get('values', [])
+
+    known = known_lookups((row[3] for row in values if len(row) > 3), folder_index=folder_index,
+                          result_cache=result_cache)
+    plan = plan_download_run(values, download_dir or os.path.abspath("downloaded_images"), root_ids=root_ids,
+                             manifest=manifest, known=known)
+    estimate = estimate_runtime(plan, download_workers=download_workers)
+
+    print("=" * 60)
+    print("📋 実行計画（Drive API は呼び出しません）")
+    print("=" * 60)
+    for line in format_plan(plan, estimate):
+        print(line)
+    print("=" * 60)
+    return plan, estimate
 
 def main():
     # 設定ファイルの読み込み
@@ -376,6 +452,9 @@ def main():
         except Exception as e:
             print(f"⚠️ 設定ファイルの読み込みに失敗しました: {e}")
     
+    # API・操作ごとのレート制限（同じマシン上の他のプロセスとクォータを共有）
+    setup_rate_limits(config)
+    
     # コマンドライン引数の設定
     parser = argparse.ArgumentParser(description='Google Drive 画像ダウンローダー')
     parser.add_argument('--url', '-u', 
@@ -394,8 +473,35 @@ def main():
                        help='対話式で設定を入力')
     parser.add_argument('--setup', action='store_true',
                        help='設定ファイルを作成')
+    parser.add_argument('--plan', action='store_true',
+                       help='実行せずに必要なAPI呼び出し数と所要時間を見積もる')
+    parser.add_argument('--rebuild-index', action='store_true',
+                       help='フォルダインデックスを作り直す')
+    parser.add_argument('--image-order', choices=list(IMAGE_ORDERS),
+                       default=config.get('image_order', 'name'),
+                       help='フォルダ内のどの画像をダウンロードするか（デフォルト: name）')
+    parser.add_argument('--recheck-missing', action='store_true',
+                       help='前回フォルダや画像が見つからなかったSKUも再検索する')
+    parser.add_argument('--download-workers', type=int,
+                       default=config.get('download_workers', DEFAULT_DOWNLOAD_WORKERS),
+                       help=f'同時にダウンロードする数（デフォルト: {DEFAULT_DOWNLOAD_WORKERS}）')
+    parser.add_argument('--engine', choices=ENGINES, default=config.get('engine', DEFAULT_ENGINE),
+                       help='threads: スレッドで処理 / async: asyncio パイプラインで処理（aiohttp が必要）')
+    parser.add_argument('--root-folder', action='append',
+                       help='SKUフォルダを探すルートフォルダのURLまたはID（複数指定可、config.json の sku_root_folders より優先）')
     
     args = parser.parse_args()
+    # Google API の HTTP 実装（接続プールは SKU 検索・ダウンロードのうち多い方のワーカー数に合わせる）
+    setup_http_transport(config, max(SEARCH_WORKERS, args.download_workers))
+    # config.json の値は argparse の choices で検査されないため、不正な値は警告して既定値で実行する
+    try:
+        configure_image_order(args.image_order)
+    except ValueError as e:
+        logging.warning("%s（名前順を使用します）", e)
+    try:
+        configure_image_listing(config.get('image_listing'))
+    except ValueError as e:
+        logging.warning("%s（bulk を使用します）", e)
     
     # 設定ファイル作成モード
     if args.setup:
@@ -518,19 +624,61 @@ def main():
     
     print("✅ Google認証が完了しました！")
     
+    # 実行計画モード
+    if args.plan:
+        root_ids = parse_root_folder_ids(args.root_folder or config.get('sku_root_folders'))
+        # インデックス・キャッシュ・台帳は構築・更新せず、保存済みのファイルを読み取り専用で開いて見積もる
+        plan_run(sheets_service, spreadsheet_id, args.sheet, args.start_row, args.download_dir,
+                 root_ids=root_ids, download_workers=args.download_workers,
+                 manifest=open_download_manifest(config, args.download_dir, read_only=True),
+                 folder_index=None if root_ids else load_folder_index(config),
+                 result_cache=open_result_cache(config, recheck_missing=args.recheck_missing, read_only=True))
+        return
+    
     drive_service = get_drive_service(creds)
+    # 並列で SKU を検索するワーカーには、プールからスレッドごとのクライアントを渡す
+    drive_pool = get_drive_client_pool(creds)
     
     # ダウンロード先ディレクトリを設定
     global DOWNLOAD_BASE_DIR
     DOWNLOAD_BASE_DIR = args.download_dir
     
+    # ルートフォルダが指定されていればその直下だけで、なければローカルのインデックスと Drive 全体で SKU を解決
+    roots = open_root_folders(config, drive_service, execute_drive_request, roots=args.root_folder)
+    folder_index = None
+    if roots is None:
+        folder_index = open_folder_index(config, drive_service, execute_drive_request, rebuild=args.rebuild_index)
+    
+    # SKU → フォルダ → 先頭画像 の永続キャッシュ
+    result_cache = open_result_cache(config, recheck_missing=args.recheck_missing)
+    
+    # ダウンロード先の台帳（保存名ごとの取得元のファイルID・サイズ）
+    manifest = open_download_manifest(config, args.download_dir)
+    # 保存名・ダウンロード先をまたいで同じ画像を共有するストア（config.json の blob_store）
+    blob_store = open_blob_store(config)
+    
+    if args.engine == 'async':
+        # シートの読み込みからA列の記載・ダウンロードまでを1つの asyncio パイプラインで行う
+        logging.info("=== asyncio パイプラインで実行します ===")
+        counts = run_pipeline(creds, spreadsheet_id, args.sheet, args.start_row, args.download_dir,
+                              folder_index=folder_index, roots=roots, result_cache=result_cache, manifest=manifest,
+                              blob_store=blob_store, concurrency=config.get('async_concurrency'))
+        logging.info(f"処理が完了しました: {format_pipeline_counts(counts)}")
+        return
+    
     # ステップ1: D列のSKUからフォルダURLを検索してA列に記載
     logging.info("=== ステップ1: SKUからフォルダURLを検索してA列に記載 ===")
-    update_sheet_with_urls(sheets_service, drive_service, spreadsheet_id, args.sheet, args.start_row)
+    update_sheet_with_urls(sheets_service, drive_pool, spreadsheet_id, args.sheet, args.start_row,
+                           folder_index=folder_index, roots=roots, result_cache=result_cache)
     
     # ステップ2: 通常通りダウンロードを実行
     logging.info("=== ステップ2: 画像ダウンロードを開始 ===")
-    process_all_rows(sheets_service, creds, spreadsheet_id, args.sheet, args.start_row)
+    process_all_rows(sheets_service, creds, spreadsheet_id, args.sheet, args.start_row, result_cache=result_cache,
+                     download_workers=args.download_workers, manifest=manifest, blob_store=blob_store)
+    
+    transport_stats = format_transport_stats()
+    if transport_stats:
+        logging.info(transport_stats)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SKU → フォルダ → 先頭画像 の検索結果を保存する永続キャッシュ
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from googleapiclient.errors import HttpError
+
+from drive_lookup import get_image_order, known_folder_modified
+from rate_limiter import drive_rate_limiter, execute_batch_with_backoff
+from sqlite_readonly import connect_read_only
+
+DEFAULT_RESULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".gdrive_image_downloader", "result_cache.sqlite3")
+# 再検証なしで使える期間（秒）と、再検証しても使い続ける最長期間（秒）
+DEFAULT_RESULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_RESULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# 保存する最大件数（超えた分は最後に使われた時刻が古いものから削除）
+DEFAULT_RESULT_CACHE_MAX_ENTRIES = 100000
+# 先頭画像の選び方の記録に付ける印（全取得方法で Drive の orderBy を使うようになる前の記録と区別する）
+IMAGE_SELECTION_VERSION = 'orderBy'
+# フォルダ・画像が見つからなかったSKUを再検索するまでの間隔（秒）。見つからない回数ごとに延ばし、最後の値で止める
+DEFAULT_MISS_SCHEDULE = (60 * 60, 6 * 60 * 60, 24 * 60 * 60)
+
+
+class ResultCache:
+    """
+    SKU ごとにフォルダID・先頭画像（ファイルID・md5Checksum・size）・フォルダの modifiedTime を SQLite に保存するキャッシュ。
+
+    ・ttl 以内に確認したエントリーは Drive API を呼び出さずにそのまま使います。
+    ・ttl を過ぎたエントリーは、フォルダのメタデータを BatchHttpRequest でまとめて取得し、
+      modifiedTime が変わっていなければ使い続けます（1回のバッチで最大100件）。
+      フォルダ検索・インデックスで modifiedTime が分かっているフォルダ（known_folder_modified）は取得しません。
+    ・max_age を過ぎたエントリーは再検証せずに破棄し、max_entries を超えた分は LRU で削除します。
+    ・フォルダや画像が見つからなかったSKUは misses に記録し、miss_schedule の間隔（1時間・6時間・24時間…）が
+      過ぎるまで再検索しません。recheck_missing=True の場合は記録を無視して再検索します。
+    ・read_only=True の場合は保存済みのファイルを変更せずに開きます（peek と missing だけが使えます）。
+    ・clock は保存・比較に使う現在時刻（既定は time.time）を返す関数です。
+    """
+
+    def __init__(self, path: str = DEFAULT_RESULT_CACHE_PATH, ttl: float = DEFAULT_RESULT_CACHE_TTL,
+                 max_age: float = DEFAULT_RESULT_CACHE_MAX_AGE, max_entries: int = DEFAULT_RESULT_CACHE_MAX_ENTRIES,
+                 miss_schedule=DEFAULT_MISS_SCHEDULE, recheck_missing: bool = False, read_only: bool = False,
+                 clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.miss_schedule = tuple(miss_schedule) or DEFAULT_MISS_SCHEDULE
+        self.recheck_missing = recheck_missing
+        self._lock = threading.Lock()
+        # 並び順が変わっていて、保存済みの画像IDが実行時に破棄される（read_only のみ）
+        self._images_outdated = False
+        if read_only:
+            self._conn = connect_read_only(path)
+            if self._conn is None:
+                raise FileNotFoundError(path)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(entries)")}
+            if not {'image_md5', 'image_size'} <= columns:
+                raise sqlite3.DatabaseError("以前の形式のキャッシュは読み取り専用では開けません")
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'image_order'").fetchone()
+            self._images_outdated = bool(row and row[0] != _image_selection())
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                sku TEXT PRIMARY KEY,
+                folder_id TEXT NOT NULL,
+                image_id TEXT,
+                image_md5 TEXT,
+                image_size INTEGER,
+                folder_modified TEXT,
+                created_at REAL NOT NULL,
+                checked_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+            CREATE TABLE IF NOT EXISTS misses (
+                sku TEXT PRIMARY KEY,
+                folder_id TEXT,
+                miss_count INTEGER NOT NULL,
+                next_check REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        # 先頭画像の md5・サイズの列がない以前のキャッシュには列を追加する
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(entries)")}
+        with self._conn:
+            for column, column_type in (('image_md5', 'TEXT'), ('image_size', 'INTEGER')):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE entries ADD COLUMN {column} {column_type}")
+        self._check_image_order()
+
+    def _check_image_order(self):
+        # 先頭画像の選び方が変わった場合は、保存済みの画像IDを使わない
+        image_order = _image_selection()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'image_order'").fetchone()
+            if row and row[0] != image_order:
+                self._conn.execute("UPDATE entries SET image_id = NULL, image_md5 = NULL, image_size = NULL")
+                logging.info("先頭画像の並び順が変わったため、キャッシュ済みの画像IDを破棄しました。")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('image_order', ?)", (image_order,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _select(self, skus):
+        rows = {}
+        skus = list(skus)
+        for i in range(0, len(skus), 500):
+            chunk = skus[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self._conn.execute(
+                f"SELECT sku, folder_id, image_id, image_md5, image_size, folder_modified, created_at, checked_at "
+                f"FROM entries WHERE sku IN ({placeholders})", chunk
+            ):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def peek(self, skus) -> dict:
+        """
+        max_age 以内のエントリーを Drive API を呼び出さずに {SKU: エントリー} で返します（--plan の見積もり用）。
+        エントリーの 'stale' は、lookup で再検証が必要（ttl を過ぎている）かどうかです。最終使用時刻は更新しません。
+        """
+        now = self.clock()
+        with self._lock:
+            rows = self._select(dict.fromkeys(sku for sku in skus if sku))
+        return {
+            sku: {'folder_id': folder_id, 'image_id': None if self._images_outdated else image_id,
+                  'stale': now - checked_at > self.ttl}
+            for sku, (folder_id, image_id, _, _, _, created_at, checked_at) in rows.items()
+            if now - created_at <= self.max_age
+        }
+
+    def lookup(self, drive_service, skus, acquire=None) -> dict:
+        """
+        キャッシュ済みのSKUを {SKU: {'folder_id': ..., 'image_id': ... または None, 'image_md5': ..., 'image_size': ...}}
+        で返します（先頭画像の dict は cached_image で作れます）。
+        ttl を過ぎたエントリーはフォルダの modifiedTime でまとめて再検証し、変わっていたものは破棄します。
+        """
+        unique_skus = list(dict.fromkeys(sku for sku in skus if sku))
+        now = self.clock()
+        with self._lock:
+            rows = self._select(unique_skus)
+
+        hits = {}
+        stale = {}
+        expired = []
+        for sku, (folder_id, image_id, image_md5, image_size, folder_modified, created_at, checked_at) in rows.items():
+            entry = {'folder_id': folder_id, 'image_id': image_id, 'image_md5': image_md5, 'image_size': image_size}
+            if now - created_at > self.max_age:
+                expired.append(sku)
+            elif now - checked_at <= self.ttl:
+                hits[sku] = entry
+            else:
+                stale[sku] = (entry, folder_modified)
+
+        revalidated = []
+        if stale:
+            # 実行中の検索で modifiedTime が分かっているフォルダは取得し直さない
+            folder_ids = {entry['folder_id'] for entry, _ in stale.values()}
+            metadata = {
+                folder_id: {'modifiedTime': modified}
+                for folder_id, modified in known_folder_modified(folder_ids).items()
+            }
+            errors = {}
+            if len(metadata) < len(folder_ids):
+                fetched, errors = fetch_folder_metadata(drive_service, folder_ids - metadata.keys(), acquire)
+                metadata.update(fetched)
+            for sku, (entry, folder_modified) in stale.items():
+                folder_id = entry['folder_id']
+                meta = metadata.get(folder_id)
+                if folder_id in errors and not _is_not_found(errors[folder_id]):
+                    # スロットリングなどで確認できなかったエントリーは使わずに残し、次回に再検証する
+                    continue
+                if meta and not meta.get('trashed') and meta.get('modifiedTime') == folder_modified:
+                    hits[sku] = entry
+                    revalidated.append(sku)
+                else:
+                    expired.append(sku)
+            logging.info("キャッシュを再検証しました: %d件有効, %d件破棄", len(revalidated), len(expired))
+
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM entries WHERE sku = ?", [(sku,) for sku in expired])
+            self._conn.executemany("UPDATE entries SET checked_at = ? WHERE sku = ?",
+                                   [(now, sku) for sku in revalidated])
+            self._conn.executemany("UPDATE entries SET accessed_at = ? WHERE sku = ?",
+                                   [(now, sku) for sku in hits])
+        return hits
+
+    def store(self, drive_service, results: dict, acquire=None):
+        """
+        {SKU: (フォルダID, 先頭画像の {id, md5Checksum, size} または None)} を保存します。
+        再検証に使うフォルダの modifiedTime は、フォルダ検索・インデックスで分かっているもの（known_folder_modified）と
+        ttl 以内に確認済みのものを使い、それ以外のフォルダだけをまとめて取得します。取得できなかったフォルダは保存しません。
+        先頭画像が None の場合、同じフォルダで保存済みの先頭画像は残します。
+        見つかったSKUの「見つからなかった」記録（record_misses）は削除します。
+        """
+        results = {sku: (folder_id, image) for sku, (folder_id, image) in results.items() if sku and folder_id}
+        if not results:
+            return
+        now = self.clock()
+        # 同じフォルダで ttl 以内に確認済みのエントリーは、保存済みの modifiedTime をそのまま使う
+        with self._lock:
+            existing = self._select(results)
+        folder_ids = {folder_id for folder_id, _ in results.values()}
+        metadata = {
+            folder_id: {'modifiedTime': modified}
+            for folder_id, modified in known_folder_modified(folder_ids).items()
+        }
+        for row in existing.values():
+            folder_id, folder_modified, checked_at = row[0], row[4], row[6]
+            if folder_modified and now - checked_at <= self.ttl:
+                metadata.setdefault(folder_id, {'modifiedTime': folder_modified})
+        unknown = folder_ids - metadata.keys()
+        if unknown:
+            fetched, _ = fetch_folder_metadata(drive_service, unknown, acquire)
+            metadata.update(fetched)
+        rows = []
+        for sku, (folder_id, image) in results.items():
+            if folder_id not in metadata or metadata[folder_id].get('trashed'):
+                continue
+            image = image or {}
+            size = image.get('size')
+            rows.append((sku, folder_id, image.get('id'), image.get('md5Checksum'), int(size) if size else None,
+                         metadata[folder_id].get('modifiedTime'), now, now, now))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                """
+                INSERT INTO entries (sku, folder_id, image_id, image_md5, image_size, folder_modified,
+                                     created_at, checked_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(sku) DO UPDATE SET
+                    image_id = CASE
+                        WHEN excluded.image_id IS NULL AND entries.folder_id = excluded.folder_id
+                        THEN entries.image_id ELSE excluded.image_id END,
+                    image_md5 = CASE
+                        WHEN excluded.image_id IS NULL AND entries.folder_id = excluded.folder_id
+                        THEN entries.image_md5 ELSE excluded.image_md5 END,
+                    image_size = CASE
+                        WHEN excluded.image_id IS NULL AND entries.folder_id = excluded.folder_id
+                        THEN entries.image_size ELSE excluded.image_size END,
+                    folder_id = excluded.folder_id,
+                    folder_modified = excluded.folder_modified,
+                    created_at = excluded.created_at,
+                    checked_at = excluded.checked_at,
+                    accessed_at = excluded.accessed_at
+                """,
+                rows
+            )
+            # フォルダが見つかったSKUは「フォルダなし」の記録を、画像も見つかったSKUは「画像なし」の記録も消す
+            self._conn.executemany(
+                "DELETE FROM misses WHERE sku = ? AND (folder_id IS NULL OR ? IS NOT NULL)",
+                [(sku, (image or {}).get('id')) for sku, (_, image) in results.items()]
+            )
+            self._evict()
+
+    def missing(self, skus) -> dict:
+        """
+        再検索の時期が来ていない「見つからなかった」SKUを {SKU: フォルダID または None} で返します。
+        フォルダID が None ならフォルダが、値があればそのフォルダ内の画像が見つからなかったことを表します。
+        """
+        if self.recheck_missing:
+            return {}
+        unique_skus = list(dict.fromkeys(sku for sku in skus if sku))
+        now = self.clock()
+        results = {}
+        with self._lock:
+            for i in range(0, len(unique_skus), 500):
+                chunk = unique_skus[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for sku, folder_id in self._conn.execute(
+                    f"SELECT sku, folder_id FROM misses WHERE sku IN ({placeholders}) AND next_check > ?",
+                    chunk + [now]
+                ):
+                    results[sku] = folder_id
+        return results
+
+    def record_misses(self, misses: dict, roots=None):
+        """
+        見つからなかったSKUを {SKU: フォルダID または None} で記録します。
+        同じ内容で続けて見つからなかった場合は、次の再検索までの間隔を miss_schedule に従って延ばします。
+        roots（ルートフォルダ直下だけで解決した結果）を渡した場合、フォルダが見つからなかったSKUは
+        ルートの外にあるだけかもしれないため記録しません（ルートなし・別のルートでの実行で検索されるように）。
+        """
+        misses = {sku: folder_id for sku, folder_id in misses.items()
+                  if sku and (folder_id is not None or roots is None)}
+        if not misses:
+            return
+        now = self.clock()
+        with self._lock, self._conn:
+            previous = {}
+            for sku in misses:
+                row = self._conn.execute("SELECT folder_id, miss_count FROM misses WHERE sku = ?", (sku,)).fetchone()
+                if row:
+                    previous[sku] = row
+            rows = []
+            for sku, folder_id in misses.items():
+                prev = previous.get(sku)
+                miss_count = prev[1] + 1 if prev and prev[0] == folder_id else 1
+                delay = self.miss_schedule[min(miss_count, len(self.miss_schedule)) - 1]
+                rows.append((sku, folder_id, miss_count, now + delay))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO misses (sku, folder_id, miss_count, next_check) VALUES (?, ?, ?, ?)", rows
+            )
+        logging.info("見つからなかったSKU %d件を記録しました。", len(misses))
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self._conn.execute(
+            "DELETE FROM entries WHERE sku IN (SELECT sku FROM entries ORDER BY accessed_at LIMIT ?)",
+            (count - self.max_entries,)
+        )
+        logging.info("キャッシュの上限を超えたため、古いエントリー %d件を削除しました。", count - self.max_entries)
+
+
+def _image_selection() -> str:
+    """meta の image_order に保存する、先頭画像の選び方（並び順と選び方の版）を返します。"""
+    return f"{get_image_order()}:{IMAGE_SELECTION_VERSION}"
+
+
+def cached_image(entry: dict):
+    """lookup のエントリーから先頭画像の {id, md5Checksum, size} を作ります。画像IDがなければ None。"""
+    if not entry or not entry.get('image_id'):
+        return None
+    image = {'id': entry['image_id']}
+    if entry.get('image_md5'):
+        image['md5Checksum'] = entry['image_md5']
+    if entry.get('image_size') is not None:
+        image['size'] = str(entry['image_size'])
+    return image
+
+
+def _is_not_found(error: Exception) -> bool:
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+
+def fetch_folder_metadata(drive_service, folder_ids, acquire=None) -> tuple:
+    """
+    フォルダの modifiedTime と trashed を BatchHttpRequest でまとめて取得します。
+    戻り値は ({フォルダID: メタデータ}, {フォルダID: 例外}) です。
+    """
+    service = drive_service() if callable(drive_service) else drive_service
+    requests = {
+        folder_id: service.files().get(fileId=folder_id, fields="id,modifiedTime,trashed")
+        for folder_id in folder_ids
+    }
+    return execute_batch_with_backoff(service, requests, drive_rate_limiter, acquire=acquire)
+
+
+def open_result_cache(config: dict, recheck_missing: bool = False, read_only: bool = False):
+    """
+    config.json の result_cache 設定に従ってキャッシュを開きます。false ならキャッシュを使いません。
+    recheck_missing=True なら、見つからなかったSKUも記録を無視して再検索します（--recheck-missing）。
+    read_only=True なら保存済みのキャッシュを変更せずに開き、まだなければ None を返します（--plan）。
+
+    例: {"path": "...", "ttl": 86400, "max_age": 2592000, "max_entries": 100000,
+         "miss_schedule": [3600, 21600, 86400]}
+    """
+    settings = config.get('result_cache', {})
+    if settings is False:
+        return None
+    if isinstance(settings, str):
+        settings = {'path': settings}
+    path = settings.get('path') or DEFAULT_RESULT_CACHE_PATH
+    if read_only and not os.path.exists(path):
+        return None
+    try:
+        return ResultCache(
+            path,
+            ttl=float(settings.get('ttl', DEFAULT_RESULT_CACHE_TTL)),
+            max_age=float(settings.get('max_age', DEFAULT_RESULT_CACHE_MAX_AGE)),
+            max_entries=int(settings.get('max_entries', DEFAULT_RESULT_CACHE_MAX_ENTRIES)),
+            miss_schedule=[float(delay) for delay in settings.get('miss_schedule', DEFAULT_MISS_SCHEDULE)],
+            recheck_missing=recheck_missing,
+            read_only=read_only,
+        )
+    except (sqlite3.Error, OSError) as e:
+        logging.warning("検索結果キャッシュを開けませんでした。キャッシュなしで実行します: %s", e)
+        return None
@@ -12,16 +12,36 @@ import urllib.parse
 import time
 import re
 import logging
-import requests
 import gc
+import functools
 from typing import Union
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from google.auth.exceptions import RefreshError
 
+from drive_lookup import (
+    resolve_folders_by_skus, folder_url_from_id, image_url_from_id, open_root_folders, MAX_QUERY_TERMS,
+    fetch_first_image, fetch_first_images, configure_image_order, configure_image_listing,
+)
+from folder_index import open_folder_index
+from result_cache import open_result_cache
+from drive_clients import build_service, get_drive_client, get_drive_client_pool
+from http_transport import setup_http_transport, format_transport_stats
+from drive_download import download_drive_file
+from download_engine import DownloadEngine, DEFAULT_DOWNLOAD_WORKERS, DOWNLOADED, SKIPPED, FAILED
+from download_manifest import open_download_manifest
+from blob_store import open_blob_store
+from async_pipeline import DEFAULT_ENGINE, run_pipeline, format_pipeline_counts
+from rate_limiter import (
+    drive_rate_limiter, sheets_read_rate_limiter, sheets_write_rate_limiter,
+    execute_with_backoff, setup_rate_limits, QuotaExceededError, MAX_BATCH_SIZE,
+)
+
+# 画像ダウンロードの進捗をログに出す間隔（件）
+PROGRESS_LOG_INTERVAL = 50
+
 class SimpleGUIHandler(BaseHTTPRequestHandler):
     def __init__(self, *args, app_instance=None, **kwargs):
         self.app_instance = app_instance
@@ -171,11 +191,21 @@ class SimpleGUI:
             'https://www.googleapis.com/auth/drive'
         ]
         
-        # レート制御用
-        self.RATE_LIMIT_MAX_DRIVE = 2000
-        self.token_bucket = self.RATE_LIMIT_MAX_DRIVE
-        self.last_refill = time.time()
-        self.rate_limit_lock = threading.Lock()
+        # レート制御用（CLI・image.py と共有のリミッター）
+        setup_rate_limits(self.config)
+        self.rate_limiter = drive_rate_limiter
+        # Google API の HTTP 実装（config.json の http_transport / http_pool_size、未指定ならダウンロードのワーカー数）
+        setup_http_transport(self.config, self.config.get('download_workers', DEFAULT_DOWNLOAD_WORKERS))
+        
+        # フォルダ内のどの画像を先頭とするか（config.json の image_order）
+        try:
+            configure_image_order(self.config.get('image_order'))
+        except ValueError as e:
+            self.add_log(f"⚠️ {e}（名前順を使用します）")
+        try:
+            configure_image_listing(self.config.get('image_listing'))
+        except ValueError as e:
+            self.add_log(f"⚠️ {e}（bulk を使用します）")
         
         # 進捗管理用
         self.progress = 0
@@ -184,34 +214,16 @@ class SimpleGUI:
         self.processing_done = False
     
     def check_drive_api_rate_limit(self):
-        """Drive APIのレート制御（image.pyと同じ方式）"""
-        with self.rate_limit_lock:
-            now = time.time()
-            if now - self.last_refill >= 60:
-                self.add_log("1分経過のため、10秒待機してレート使用率をリセットします。")
-                time.sleep(10)
-                self.token_bucket = self.RATE_LIMIT_MAX_DRIVE
-                self.last_refill = time.time()
-                now = self.last_refill
-
-            # 補充：1分間にRATE_LIMIT_MAX_DRIVE個補充される（1秒あたり RATE_LIMIT_MAX_DRIVE/60 個）
-            elapsed = now - self.last_refill
-            refill = elapsed * (self.RATE_LIMIT_MAX_DRIVE / 60)
-            self.token_bucket = min(self.RATE_LIMIT_MAX_DRIVE, self.token_bucket + refill)
-            self.last_refill = now
-
-            while self.token_bucket < 1:
-                wait_time = (1 - self.token_bucket) * (60 / self.RATE_LIMIT_MAX_DRIVE)
-                self.add_log(f"トークン不足のため、{wait_time:.2f}秒待機します。")
-                time.sleep(wait_time)
-                now = time.time()
-                elapsed = now - self.last_refill
-                self.token_bucket = min(self.RATE_LIMIT_MAX_DRIVE, self.token_bucket + elapsed * (self.RATE_LIMIT_MAX_DRIVE / 60))
-                self.last_refill = now
-
-            self.token_bucket -= 1
-            usage_percentage = (1 - self.token_bucket / self.RATE_LIMIT_MAX_DRIVE) * 100
-            self.add_log(f"ドライブAPI使用率: {usage_percentage:.2f}% (残トークン: {self.token_bucket:.2f})")
+        """Drive APIのレート制御（共有のスライディングウィンドウ方式）"""
+        wait_time = self.rate_limiter.acquire()
+        if wait_time > 0:
+            usage = self.rate_limiter.usage_percentage()
+            self.add_log(f"レート上限に達したため、{wait_time:.2f}秒待機しました。"
+                         f"ドライブAPI使用率: {usage:.2f}% (残リクエスト: {self.rate_limiter.remaining(usage):.0f})")
+    
+    def execute_drive_request(self, request):
+        """Drive APIリクエストをレート制御・スロットリング時の再試行付きで実行"""
+        return execute_with_backoff(request, self.rate_limiter, acquire=self.check_drive_api_rate_limit)
     
     def authenticate(self):
         """Google API認証（image.pyと同じ方式）"""
@@ -281,7 +293,7 @@ class SimpleGUI:
                     self.add_log(f"認証エラー: {e}")
                     return None, None
         
-        sheets_service = build('sheets', 'v4', credentials=creds)
+        sheets_service = build_service('sheets', 'v4', creds)
         self.add_log("Google Sheets および Drive API の認証が完了しました。")
         return sheets_service, creds
     
@@ -291,34 +303,14 @@ class SimpleGUI:
         match = re.search(pattern, url)
         return match.group(1) if match else None
     
-    def search_folder_by_sku(self, drive_service, sku: str) -> Union[str, None]:
-        """SKU名でフォルダを検索"""
-        self.check_drive_api_rate_limit()
-        query = f"name='{sku}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-        try:
-            resp = drive_service.files().list(
-                q=query,
-                fields="files(id,name)",
-                pageSize=1
-            ).execute()
-            files = resp.get('files', [])
-            if not files:
-                return None
-            folder_id = files[0]['id']
-            folder_url = f"https://drive.google.com/drive/folders/{folder_id}"
-            return folder_url
-        except Exception as e:
-            self.add_log(f"SKU '{sku}' の検索でエラー: {e}")
-            return None
-    
-    def update_sheet_with_urls(self, sheets_service, drive_service, spreadsheet_id: str, sheet_name: str, start_row: int = 2):
-        """A列にURLを記載"""
+    def update_sheet_with_urls(self, sheets_service, drive_service, spreadsheet_id: str, sheet_name: str, start_row: int = 2, folder_index=None, roots=None, result_cache=None):
+        """A列にURLを記載（result_cache があれば解決済み・見つからなかったSKUは再検索しない）"""
         self.add_log("=" * 60)
         self.add_log("🚀 A列URL記載を高速化モードで開始します...")
         self.add_log("=" * 60)
         
         RANGE = f"{sheet_name}!A{start_row}:E"
-        resp = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=RANGE).execute()
+        resp = execute_with_backoff(sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=RANGE), sheets_read_rate_limiter)
         values = resp.get('values', [])
         
         target_rows = []
@@ -336,11 +328,23 @@ class SimpleGUI:
         
         self.add_log(f"📊 処理対象: {len(target_rows)}行")
         
-        # キャッシュを使用した高速処理
+        # 複数SKUを OR クエリでまとめて検索（1バッチ≒1回のDrive API呼び出し）
         sku_cache = {}
+        if result_cache is not None:
+            try:
+                cached = result_cache.lookup(drive_service, [sku for _, sku in target_rows], self.check_drive_api_rate_limit)
+                sku_cache.update({sku: entry['folder_id'] for sku, entry in cached.items()})
+                self.add_log(f"📦 キャッシュから解決: {len(cached)}件")
+                missing = result_cache.missing(sku for _, sku in target_rows if sku not in sku_cache)
+                no_folder = {sku for sku, folder_id in missing.items() if folder_id is None}
+                if no_folder:
+                    target_rows = [(idx, sku) for idx, sku in target_rows if sku not in no_folder]
+                    self.add_log(f"⏭️ 前回フォルダが見つからなかったSKU: {len(no_folder)}件（再検索の時期まで検索しません）")
+            except Exception as e:
+                self.add_log(f"⚠️ 検索結果キャッシュの読み込みでエラー: {e}")
         updates = []
         processed_count = 0
-        BATCH_SIZE = 50
+        BATCH_SIZE = 100
         
         for i in range(0, len(target_rows), BATCH_SIZE):
             # 停止要求チェック
@@ -350,12 +354,25 @@ class SimpleGUI:
             
             batch = target_rows[i:i + BATCH_SIZE]
             
+            pending_skus = [sku for _, sku in batch if sku not in sku_cache]
+            try:
+                resolved = resolve_folders_by_skus(drive_service, pending_skus, execute=self.execute_drive_request, index=folder_index, roots=roots)
+                sku_cache.update(resolved)
+            except Exception as e:
+                self.add_log(f"❌ 行{batch[0][0]}～{batch[-1][0]}のSKU検索でエラー: {e}")
+                continue
+            if result_cache is not None:
+                try:
+                    result_cache.store(drive_service, {
+                        sku: (folder_id, None) for sku, folder_id in resolved.items() if folder_id
+                    }, self.check_drive_api_rate_limit)
+                    result_cache.record_misses({sku: None for sku, folder_id in resolved.items() if not folder_id}, roots=roots)
+                except Exception as e:
+                    self.add_log(f"⚠️ 検索結果キャッシュの保存でエラー: {e}")
+            
             for idx, sku in batch:
-                if sku in sku_cache:
-                    folder_url = sku_cache[sku]
-                else:
-                    folder_url = self.search_folder_by_sku(drive_service, sku)
-                    sku_cache[sku] = folder_url
+                folder_id = sku_cache.get(sku)
+                folder_url = folder_url_from_id(folder_id) if folder_id else None
                 
                 if folder_url:
                     updates.append({'range': f"{sheet_name}!A{idx}", 'values': [[folder_url]]})
@@ -366,7 +383,7 @@ class SimpleGUI:
             if updates:
                 try:
                     body = {'valueInputOption': 'RAW', 'data': updates}
-                    sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+                    execute_with_backoff(sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body), sheets_write_rate_limiter)
                     self.add_log(f"✅ バッチ更新完了: {len(updates)}行")
                     updates = []
                 except Exception as e:
@@ -385,29 +402,12 @@ class SimpleGUI:
                 return m.group(1)
         return None
     
-    def fetch_first_image_url(self, drive_service, folder_id: str) -> Union[str, None]:
-        """フォルダ内の最初の画像URLを取得"""
-        self.check_drive_api_rate_limit()
-        resp = drive_service.files().list(
-            q=f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false",
-            fields="files(id,name)"
-        ).execute()
-        files = resp.get('files', [])
-        if not files:
-            return None
-        files.sort(key=lambda f: f['name'])
-        file_id = files[0]['id']
-        return f"https://drive.google.com/uc?export=view&id={file_id}"
-    
-    def download_image(self, url: str, save_path: str):
-        """画像をダウンロード"""
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        resp = requests.get(url, stream=True)
-        resp.raise_for_status()
-        with open(save_path, 'wb') as f:
-            for chunk in resp.iter_content(8192):
-                f.write(chunk)
+    def download_image(self, drive_service, file_id: str, save_path: str, md5_checksum: str = None):
+        """画像をダウンロード（認証済みの files.get_media でチャンクごとに取得）"""
+        result = download_drive_file(drive_service, file_id, save_path, acquire=self.check_drive_api_rate_limit,
+                                     md5_checksum=md5_checksum)
         self.add_log(f"✅ ダウンロード完了: {save_path}")
+        return result
     
     def process_all_rows(self, sheets_service, drive_service, spreadsheet_id: str, sheet_name: str, start_row: int = 2, download_dir: str = None):
         """全行を処理して画像をダウンロード"""
@@ -416,21 +416,25 @@ class SimpleGUI:
         self.add_log("=" * 60)
         
         RANGE = f"{sheet_name}!A{start_row}:E"
-        resp = sheets_service.spreadsheets().values().get(
+        resp = execute_with_backoff(sheets_service.spreadsheets().values().get(
             spreadsheetId=spreadsheet_id,
             range=RANGE
-        ).execute()
+        ), sheets_read_rate_limiter)
         values = resp.get('values', [])
         
         if not download_dir:
             download_dir = os.path.abspath("downloaded_images")
         
         self.add_log(f"📁 ダウンロード先: {download_dir}")
+        # ダウンロード台帳（config.json の download_manifest が false なら使わない）
+        manifest = open_download_manifest(self.config, download_dir)
         
         processed_count = 0
         skipped_count = 0
         error_count = 0
         
+        # ダウンロード対象の行を特定
+        targets = []
         for idx, row in enumerate(values, start=start_row):
             # 停止要求チェック
             if self.stop_requested:
@@ -452,7 +456,8 @@ class SimpleGUI:
                 continue
 
             save_path = os.path.join(download_dir, f"{save_name}.jpg")
-            if os.path.exists(save_path):
+            # 台帳がある場合は、既存のファイルも先頭画像を調べてからエンジン側で判定する
+            if manifest is None and os.path.exists(save_path):
                 self.add_log(f"⏭️ Row {idx}: {save_name}.jpg は既に存在します。スキップします。")
                 skipped_count += 1
                 continue
@@ -463,35 +468,94 @@ class SimpleGUI:
                 error_count += 1
                 continue
 
-            image_url = self.fetch_first_image_url(drive_service, folder_id)
-            if not image_url:
-                self.add_log(f"❌ Row {idx}: フォルダ {folder_id} に画像が見つかりません")
-                error_count += 1
-                continue
-
-            try:
-                self.download_image(image_url, save_path)
-                processed_count += 1
+            targets.append((idx, save_name, save_path, folder_id))
+        
+        # ダウンロードは最大 download_workers 件（config.json）を並列に行い、その間に次のバッチの画像を検索する
+        with self.progress_lock:
+            self.progress = 0
+            self.total_rows = max(len(targets), 1)
+        
+        def on_result(idx, save_name, status, error):
+            if status == DOWNLOADED:
                 self.add_log(f"✅ Row {idx}: {save_name}.jpg をダウンロードしました")
-            except Exception as e:
-                self.add_log(f"❌ Row {idx}: ダウンロード失敗: {e}")
-                error_count += 1
+            elif status == SKIPPED:
+                self.add_log(f"⏭️ Row {idx}: {save_name}.jpg は既に存在します。スキップします。")
+            elif status == FAILED:
+                self.add_log(f"❌ Row {idx}: ダウンロード失敗: {error}")
+            self.advance_progress()
+        
+        # drive_service はダウンロードのワーカーからも使うため、スレッドごとのクライアントを返す関数（DriveClientPool）を渡す
+        engine = DownloadEngine(functools.partial(self.download_image, drive_service),
+                                self.config.get('download_workers', DEFAULT_DOWNLOAD_WORKERS),
+                                should_stop=lambda: self.stop_requested, on_result=on_result, manifest=manifest,
+                                blob_store=open_blob_store(self.config))
+        with engine:
+            # 先頭画像の検索は最大100フォルダずつまとめて行う（親フォルダの OR 検索または BatchHttpRequest）
+            for i in range(0, len(targets), MAX_BATCH_SIZE):
+                if self.stop_requested:
+                    break
+                
+                batch = targets[i:i + MAX_BATCH_SIZE]
+                try:
+                    images, errors = fetch_first_images(
+                        drive_service, [folder_id for _, _, _, folder_id in batch], acquire=self.check_drive_api_rate_limit
+                    )
+                except Exception as e:
+                    self.add_log(f"❌ Row {batch[0][0]}～{batch[-1][0]}: 画像検索のバッチでエラー: {e}")
+                    error_count += len(batch)
+                    self.advance_progress(len(batch))
+                    continue
+                
+                for idx, save_name, save_path, folder_id in batch:
+                    if folder_id in errors:
+                        self.add_log(f"❌ Row {idx}: {errors[folder_id]}")
+                        error_count += 1
+                        self.advance_progress()
+                        continue
+                    first_file = images.get(folder_id)
+                    if not first_file:
+                        self.add_log(f"❌ Row {idx}: フォルダ {folder_id} に画像が見つかりません")
+                        error_count += 1
+                        self.advance_progress()
+                        continue
+                    # 既に存在する保存先と、同じ保存名の2行目以降はエンジン側でスキップする
+                    if not engine.submit(idx, save_name, save_path, first_file['id'],
+                                         first_file.get('md5Checksum'), first_file.get('size')):
+                        break
+        
+        processed_count += engine.counts[DOWNLOADED]
+        skipped_count += engine.counts[SKIPPED]
+        error_count += engine.counts[FAILED]
+        if self.stop_requested:
+            self.add_log("🛑 画像ダウンロードが停止されました")
+            self.add_log(f"📈 停止までの処理結果: {processed_count}個ダウンロード, {skipped_count}個スキップ, {error_count}個エラー")
+            return
         
         self.add_log("=" * 60)
         self.add_log(f"🎉 画像ダウンロードが完了しました！")
         self.add_log(f"📈 処理結果: {processed_count}個ダウンロード, {skipped_count}個スキップ, {error_count}個エラー")
         self.add_log("=" * 60)
     
+    def advance_progress(self, count: int = 1):
+        """ダウンロード対象の処理済み件数を進め、一定件数ごとに進捗をログに出す"""
+        with self.progress_lock:
+            before = self.progress
+            self.progress += count
+            done, total = self.progress, self.total_rows
+        if done // PROGRESS_LOG_INTERVAL > before // PROGRESS_LOG_INTERVAL or done >= total:
+            self.add_log(f"📈 進捗: {min(done, total)}/{total} ({min(done, total) / total * 100:.1f}%)")
+    
     def get_folder_link_by_sku(self, drive_service, sku):
         """SKUに対応するGoogle Driveフォルダを検索し、フォルダリンクを返す"""
-        self.check_drive_api_rate_limit()
         query = f"name = '{sku}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
         self.add_log(f"🔍 SKU '{sku}' の検索を開始...")
         try:
-            response = drive_service.files().list(
+            response = self.execute_drive_request(drive_service.files().list(
                 q=query,
                 fields="files(id, name)"
-            ).execute()
+            ))
+        except QuotaExceededError:
+            raise
         except Exception as e:
             self.add_log(f"❌ SKU '{sku}' の検索でエラー: {e}")
             return None
@@ -508,35 +572,25 @@ class SimpleGUI:
     
     def get_first_image_url_from_folder(self, drive_service, folder_id):
         """フォルダ内の最初の画像URLを取得"""
-        self.check_drive_api_rate_limit()
-        query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed = false"
         try:
-            response = drive_service.files().list(
-                q=query,
-                fields="files(id, name)"
-            ).execute()
+            first_file = fetch_first_image(drive_service, folder_id, execute=self.execute_drive_request)
+        except QuotaExceededError:
+            raise
         except Exception as e:
             self.add_log(f"❌ フォルダ {folder_id} の画像検索でエラー: {e}")
             return None
         
-        files = response.get('files', [])
-        if not files:
+        if not first_file:
             self.add_log(f"⚠️ フォルダ {folder_id} 内に画像が見つかりませんでした")
             return None
         
-        files.sort(key=lambda f: f.get('name', ''))
-        first_file = files[0]
-        file_id = first_file.get('id')
-        image_url = f"https://drive.google.com/uc?export=view&id={file_id}"
+        image_url = image_url_from_id(first_file.get('id'))
         self.add_log(f"✅ フォルダ {folder_id} の最初の画像URLを取得: {image_url}")
         return image_url
     
     def process_single_row_image_formula(self, row_index, sku, drive_service):
         """1行分のIMAGE関数処理（image.pyと同じ方式）"""
         try:
-            # レート制御
-            self.check_drive_api_rate_limit()
-            
             # SKUに対応するフォルダを検索
             folder_link = self.get_folder_link_by_sku(drive_service, sku)
             
@@ -564,16 +618,16 @@ class SimpleGUI:
             self.add_log(f"❌ 行{row_index}の処理でエラー: {e}")
             return "", "", sku
     
-    def process_sheet_image_formula(self, sheets_service, drive_service, spreadsheet_id, sheet_name, start_row=2):
+    def process_sheet_image_formula(self, sheets_service, drive_service, spreadsheet_id, sheet_name, start_row=2, folder_index=None, roots=None):
         """IMAGE関数生成モードのメイン処理（image.pyと同じ方式）"""
         try:
             self.add_log("🖼️ IMAGE関数生成モードで実行します")
             
             # シートのデータを取得
             range_name = f"{sheet_name}!A:Z"
-            result = sheets_service.spreadsheets().values().get(
+            result = execute_with_backoff(sheets_service.spreadsheets().values().get(
                 spreadsheetId=spreadsheet_id, range=range_name
-            ).execute()
+            ), sheets_read_rate_limiter)
             
             values = result.get('values', [])
             if not values:
@@ -600,8 +654,11 @@ class SimpleGUI:
             # 順次処理でIMAGE関数とフォルダリンクを生成（image.pyと同じ方式）
             batch_size = 10  # メモリ使用量を削減するため小さなバッチサイズ
             current_batch = []
+            # SKUのフォルダIDは後続の行のSKUと OR クエリで、先頭画像もまとめて検索する
+            folder_ids = {}
+            first_images = {}
             
-            for row_index, sku in target_rows:
+            for position, (row_index, sku) in enumerate(target_rows):
                 if self.stop_requested:
                     self.add_log("🛑 IMAGE関数生成が停止されました")
                     return
@@ -609,17 +666,28 @@ class SimpleGUI:
                 try:
                     self.add_log(f"📝 行{row_index} (SKU: {sku}) を処理中...")
                     
-                    # レート制御
-                    self.check_drive_api_rate_limit()
-                    
-                    # SKUに対応するフォルダを検索
-                    folder_link = self.get_folder_link_by_sku(drive_service, sku)
+                    # SKUに対応するフォルダを検索（未検索なら後続の行の分もまとめて検索）
+                    if sku not in folder_ids:
+                        upcoming_skus = [s for _, s in target_rows[position:position + MAX_QUERY_TERMS] if s not in folder_ids]
+                        folder_ids.update(resolve_folders_by_skus(drive_service, upcoming_skus, execute=self.execute_drive_request, index=folder_index, roots=roots))
+                    folder_link = folder_url_from_id(folder_ids[sku]) if folder_ids[sku] else None
                     
                     if folder_link:
                         # フォルダから最初の画像URLを取得
                         folder_id = self.extract_folder_id(folder_link)
                         if folder_id:
-                            image_url = self.get_first_image_url_from_folder(drive_service, folder_id)
+                            if folder_id not in first_images:
+                                upcoming_ids = list(dict.fromkeys(
+                                    folder_ids[s] for _, s in target_rows[position:position + MAX_QUERY_TERMS]
+                                    if folder_ids.get(s) and folder_ids[s] not in first_images
+                                ))[:MAX_BATCH_SIZE]
+                                images, errors = fetch_first_images(drive_service, upcoming_ids, acquire=self.check_drive_api_rate_limit)
+                                first_images.update(images)
+                            if folder_id in first_images:
+                                first_file = first_images[folder_id]
+                                image_url = image_url_from_id(first_file['id']) if first_file else None
+                            else:
+                                image_url = self.get_first_image_url_from_folder(drive_service, folder_id)
                             
                             if image_url:
                                 # IMAGE関数を生成
@@ -653,10 +721,10 @@ class SimpleGUI:
                         }
                         
                         try:
-                            sheets_service.spreadsheets().values().batchUpdate(
+                            execute_with_backoff(sheets_service.spreadsheets().values().batchUpdate(
                                 spreadsheetId=spreadsheet_id,
                                 body=batch_update_body
-                            ).execute()
+                            ), sheets_write_rate_limiter)
                             self.add_log(f"✅ バッチ更新完了: {len(current_batch)}個のセル")
                         except Exception as e:
                             self.add_log(f"❌ バッチ更新でエラー: {e}")
@@ -680,10 +748,10 @@ class SimpleGUI:
                 }
                 
                 try:
-                    sheets_service.spreadsheets().values().batchUpdate(
+                    execute_with_backoff(sheets_service.spreadsheets().values().batchUpdate(
                         spreadsheetId=spreadsheet_id,
                         body=batch_update_body
-                    ).execute()
+                    ), sheets_write_rate_limiter)
                     self.add_log(f"✅ 最終バッチ更新完了: {len(current_batch)}個のセル")
                 except Exception as e:
                     self.add_log(f"❌ 最終バッチ更新でエラー: {e}")
@@ -715,6 +783,9 @@ class SimpleGUI:
     
     def save_config(self, config):
         """設定を保存する"""
+        # 画面から送られない項目（rate_limits など）を消さないよう既存の設定にマージする
+        config = {**self.config, **config}
+        self.config = config
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=2, ensure_ascii=False)
@@ -856,13 +927,28 @@ class SimpleGUI:
             self.add_log(f"📁 ダウンロード先: {config['download_dir']}")
             
             # Driveサービスを構築
-            drive_service = build('drive', 'v3', credentials=creds)
+            drive_service = get_drive_client(creds)
+            
+            # ルートフォルダ（config.json の sku_root_folders）が指定されていればその直下だけで SKU を解決
+            roots = open_root_folders(self.config, drive_service, self.execute_drive_request)
+            folder_index = None
+            if roots is not None:
+                self.add_log(f"✅ ルートフォルダ直下のフォルダ: {len(roots)}件")
+            else:
+                # フォルダ名 → フォルダID のローカルインデックス（未構築なら全フォルダを列挙して構築）
+                self.add_log("🗂️ フォルダインデックスを準備しています...")
+                folder_index = open_folder_index(self.config, drive_service, self.execute_drive_request)
+                if folder_index is not None:
+                    self.add_log(f"✅ フォルダインデックス: {len(folder_index)}件")
             
             # 停止要求チェック
             if self.stop_requested:
                 self.add_log("🛑 処理が停止されました")
                 return
             
+            # SKU → フォルダ → 先頭画像 の永続キャッシュ（config.json の result_cache）
+            result_cache = open_result_cache(self.config)
+            
             # モードに応じて処理を実行
             mode = config.get('mode', 'download')
             self.add_log(f"🎯 実行モード: {mode}")
@@ -870,12 +956,22 @@ class SimpleGUI:
             if mode == 'image_formula':
                 # IMAGE関数生成モード
                 self.add_log("🖼️ IMAGE関数生成モードで実行します")
-                self.process_sheet_image_formula(sheets_service, drive_service, spreadsheet_id, config['sheet_name'], config['start_row'])
+                self.process_sheet_image_formula(sheets_service, drive_service, spreadsheet_id, config['sheet_name'], config['start_row'], folder_index=folder_index, roots=roots)
+            elif self.config.get('engine', DEFAULT_ENGINE) == 'async':
+                # A列の記載とダウンロードを1つの asyncio パイプラインで行う（config.json の engine）
+                self.add_log("⚡ 画像ダウンロードモードを asyncio パイプラインで実行します")
+                counts = run_pipeline(creds, spreadsheet_id, config['sheet_name'], config['start_row'], config['download_dir'],
+                                      folder_index=folder_index, roots=roots, result_cache=result_cache,
+                                      manifest=open_download_manifest(self.config, config['download_dir'] or os.path.abspath("downloaded_images")),
+                                      blob_store=open_blob_store(self.config),
+                                      concurrency=self.config.get('async_concurrency'),
+                                      should_stop=lambda: self.stop_requested, log=self.add_log)
+                self.add_log(f"📈 処理結果: {format_pipeline_counts(counts)}")
             else:
                 # 画像ダウンロードモード（デフォルト）
                 self.add_log("📥 画像ダウンロードモードで実行します")
                 # A列にURLを記載
-                self.update_sheet_with_urls(sheets_service, drive_service, spreadsheet_id, config['sheet_name'], config['start_row'])
+                self.update_sheet_with_urls(sheets_service, drive_service, spreadsheet_id, config['sheet_name'], config['start_row'], folder_index=folder_index, roots=roots, result_cache=result_cache)
                 
                 # 停止要求チェック
                 if self.stop_requested:
@@ -883,10 +979,13 @@ class SimpleGUI:
                     return
                 
                 # 画像ダウンロードを実行
-                self.process_all_rows(sheets_service, drive_service, spreadsheet_id, config['sheet_name'], config['start_row'], config['download_dir'])
+                self.process_all_rows(sheets_service, get_drive_client_pool(creds), spreadsheet_id, config['sheet_name'], config['start_row'], config['download_dir'])
             
             if not self.stop_requested:
                 self.add_log("🎉 処理が正常に完了しました！")
+            transport_stats = format_transport_stats()
+            if transport_stats:
+                self.add_log(f"🔌 {transport_stats}")
                 
         except Exception as e:
             self.add_log(f"❌ 実行エラー: {e}")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同じキーの検索を並列実行中のスレッド間で1回にまとめるヘルパー
+"""
+
+import threading
+import concurrent.futures
+
+
+class SingleFlight:
+    """
+    キーごとに検索を1回だけ実行し、同時に同じキーを要求したスレッドは実行中の Future の結果を待ちます。
+
+    ・成功した結果は clear() するまで保持し、同じ実行中の2回目以降の要求は検索せずに返します。
+    ・例外は待っていたスレッドすべてに送出しますが保持はしないため、後の要求で再試行されます。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def do(self, key, func):
+        """key の結果を返します。未実行なら func() を実行し、実行中ならその完了を待ちます。"""
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._futures[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            with self._lock:
+                self._futures.pop(key, None)
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def forget(self, key):
+        """完了した key の結果を破棄します（次の要求では func() を実行し直します）。"""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and future.done():
+                del self._futures[key]
+
+    def clear(self):
+        """保持している結果を破棄します（実行ごとに呼び出します）。"""
+        with self._lock:
+            self._futures = {key: future for key, future in self._futures.items() if not future.done()}
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+保存済みの SQLite ファイルを、ファイルを作成・変更せずに開くヘルパー（--plan 用）
+"""
+
+import os
+import pathlib
+import sqlite3
+
+
+def connect_read_only(path: str):
+    """
+    path の SQLite ファイルを読み取り専用で開きます。ファイルがなければ None を返します。
+    -wal がない（他のプロセスが書き込み中でない）場合は immutable で開き、-wal・-shm も作りません。
+    """
+    if not os.path.exists(path):
+        return None
+    uri = pathlib.Path(os.path.abspath(path)).as_uri()
+    mode = 'mode=ro' if os.path.exists(path + '-wal') else 'immutable=1'
+    return sqlite3.connect(f"{uri}?{mode}", uri=True, check_same_thread=False)
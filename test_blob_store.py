@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BlobStore のテスト（tmp ディレクトリのストアを使います）
+"""
+
+import os
+import hashlib
+
+from blob_store import BlobStore
+
+CONTENT = b"image-bytes"
+CONTENT_MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+def add_blob(tmp_path):
+    """ダウンロード済みの画像をストアに登録し、(ストア, blob のパス) を返します。"""
+    store = BlobStore(str(tmp_path / "store"))
+    downloaded = tmp_path / "downloaded.jpg"
+    downloaded.write_bytes(CONTENT)
+    store.add(str(downloaded), 'f1', CONTENT_MD5)
+    return store, store.find('f1')[0]
+
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if name.endswith('.tmp')]
+
+
+def test_find_by_file_id_or_md5(tmp_path):
+    store, blob_path = add_blob(tmp_path)
+
+    assert store.find('f1') == (blob_path, CONTENT_MD5)
+    assert store.find('f2', CONTENT_MD5) == (blob_path, CONTENT_MD5)
+    assert store.find('f2') is None
+
+
+def test_link_hardlinks_and_replaces_existing_file(tmp_path):
+    store, blob_path = add_blob(tmp_path)
+    save_path = tmp_path / "out" / "SKU-1.jpg"
+    save_path.parent.mkdir()
+    save_path.write_bytes(b"old")
+
+    store.link(blob_path, str(save_path))
+
+    assert save_path.read_bytes() == CONTENT
+    assert os.path.samefile(blob_path, save_path)
+    assert leftovers(save_path.parent) == []
+
+
+def test_link_copies_when_hardlink_fails(tmp_path, monkeypatch):
+    store, blob_path = add_blob(tmp_path)
+    save_path = tmp_path / "out" / "SKU-1.jpg"
+
+    def cross_device_link(src, dst):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, 'link', cross_device_link)
+    store.link(blob_path, str(save_path))
+
+    assert save_path.read_bytes() == CONTENT
+    assert not os.path.samefile(blob_path, save_path)
+    assert leftovers(save_path.parent) == []
+
+
+def test_fetch_downloads_once_and_links_afterwards(tmp_path):
+    store = BlobStore(str(tmp_path / "store"))
+    downloads = []
+
+    def download(file_id, save_path, md5_checksum):
+        downloads.append(save_path)
+        with open(save_path, 'wb') as f:
+            f.write(CONTENT)
+        return len(CONTENT), CONTENT_MD5
+
+    first = str(tmp_path / "a" / "SKU-1.jpg")
+    second = str(tmp_path / "b" / "SKU-1-copy.jpg")
+    os.makedirs(os.path.dirname(first))
+
+    assert store.fetch(download, 'f1', first, CONTENT_MD5) == (len(CONTENT), CONTENT_MD5)
+    assert store.fetch(download, 'f1', second) == (len(CONTENT), CONTENT_MD5)
+
+    assert downloads == [first]
+    assert os.path.samefile(first, second)
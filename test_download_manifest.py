@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DownloadManifest.check のテスト（tmp ディレクトリに保存したファイルと台帳を使います）
+"""
+
+import hashlib
+
+from download_manifest import DownloadManifest, CURRENT, CHANGED, MISSING
+
+CONTENT = b"image-bytes"
+CONTENT_MD5 = hashlib.md5(CONTENT).hexdigest()
+OTHER_MD5 = hashlib.md5(b"other").hexdigest()
+
+
+def open_manifest(tmp_path, files=None, records=None):
+    """files の {保存名: 内容} を書き込み、records の {保存名: (ファイルID, サイズ, md5)} を記録した台帳を開きます。"""
+    for name, content in (files or {}).items():
+        (tmp_path / name).write_bytes(content)
+    manifest = DownloadManifest(str(tmp_path))
+    for name, (file_id, size, md5) in (records or {}).items():
+        manifest.record(str(tmp_path / name), file_id, size, md5)
+    return manifest
+
+
+def test_missing_when_file_is_not_in_directory(tmp_path):
+    manifest = open_manifest(tmp_path)
+
+    assert manifest.check(str(tmp_path / "SKU-1.jpg"), 'f1', CONTENT_MD5, len(CONTENT)) == MISSING
+
+
+def test_recorded_file_is_compared_by_md5(tmp_path):
+    manifest = open_manifest(tmp_path, {'SKU-1.jpg': CONTENT}, {'SKU-1.jpg': ('f1', len(CONTENT), CONTENT_MD5)})
+    save_path = str(tmp_path / "SKU-1.jpg")
+
+    assert manifest.check(save_path, 'f1', CONTENT_MD5) == CURRENT
+    assert manifest.check(save_path, 'f1', OTHER_MD5) == CHANGED
+    # 内容が同じ別のファイルに置き換わった場合は、ファイルIDだけ記録し直す
+    assert manifest.check(save_path, 'f2', CONTENT_MD5) == CURRENT
+    assert manifest.get(save_path)['file_id'] == 'f2'
+
+
+def test_recorded_file_without_md5_is_compared_by_size_and_file_id(tmp_path):
+    manifest = open_manifest(tmp_path, {'SKU-1.jpg': CONTENT}, {'SKU-1.jpg': ('f1', len(CONTENT), None)})
+    save_path = str(tmp_path / "SKU-1.jpg")
+
+    assert manifest.check(save_path, 'f1') == CURRENT
+    assert manifest.check(save_path, 'f1', size=str(len(CONTENT))) == CURRENT
+    assert manifest.check(save_path, 'f1', size=len(CONTENT) + 1) == CHANGED
+    assert manifest.check(save_path, 'f2', size=len(CONTENT)) == CHANGED
+
+
+def test_recorded_file_without_md5_learns_md5_once(tmp_path):
+    manifest = open_manifest(tmp_path, {'SKU-1.jpg': CONTENT}, {'SKU-1.jpg': ('f1', len(CONTENT), None)})
+    save_path = str(tmp_path / "SKU-1.jpg")
+
+    assert manifest.check(save_path, 'f1', CONTENT_MD5) == CURRENT
+    assert manifest.get(save_path)['md5'] == CONTENT_MD5
+
+
+def test_unrecorded_file_without_md5_is_accepted_only_by_size(tmp_path):
+    manifest = open_manifest(tmp_path, {'SKU-1.jpg': CONTENT, 'SKU-2.jpg': CONTENT, 'SKU-3.jpg': CONTENT})
+
+    assert manifest.check(str(tmp_path / "SKU-1.jpg"), 'f1', size=str(len(CONTENT))) == CURRENT
+    assert manifest.get(str(tmp_path / "SKU-1.jpg"))['file_id'] == 'f1'
+    assert manifest.check(str(tmp_path / "SKU-2.jpg"), 'f2', size=len(CONTENT) + 1) == CHANGED
+    # サイズも分からなければ内容を確認できないため、取得し直す
+    assert manifest.check(str(tmp_path / "SKU-3.jpg"), 'f3') == CHANGED
+    assert manifest.get(str(tmp_path / "SKU-2.jpg")) is None
+    assert manifest.get(str(tmp_path / "SKU-3.jpg")) is None
+
+
+def test_unrecorded_file_is_compared_by_content_md5(tmp_path):
+    manifest = open_manifest(tmp_path, {'SKU-1.jpg': CONTENT, 'SKU-2.jpg': CONTENT})
+
+    assert manifest.check(str(tmp_path / "SKU-1.jpg"), 'f1', CONTENT_MD5) == CURRENT
+    assert manifest.get(str(tmp_path / "SKU-1.jpg"))['file_id'] == 'f1'
+    assert manifest.check(str(tmp_path / "SKU-2.jpg"), 'f2', OTHER_MD5) == CHANGED
+    # 内容が違うファイルは、ダウンロードし直すまで取得元のファイルIDを記録しない
+    assert manifest.get(str(tmp_path / "SKU-2.jpg"))['file_id'] is None
+
+
+def test_records_persist_across_reopen(tmp_path):
+    manifest = open_manifest(tmp_path, {'SKU-1.jpg': CONTENT}, {'SKU-1.jpg': ('f1', len(CONTENT), CONTENT_MD5)})
+
+    reopened = DownloadManifest(manifest.directory)
+
+    assert len(reopened) == 1
+    assert reopened.recorded(str(tmp_path / "SKU-1.jpg"))
+    assert reopened.check(str(tmp_path / "SKU-1.jpg"), 'f1', CONTENT_MD5) == CURRENT
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+download_drive_file / PartialDownload のテスト（Range に応じて応答する偽の files.get_media を使います）
+"""
+
+import json
+import hashlib
+
+import httplib2
+import pytest
+
+from drive_download import download_drive_file, part_path, PART_META_SUFFIX, ChecksumMismatchError
+
+CONTENT = b"0123456789abcdefghijklmnopqrstuvwxyz"
+CONTENT_MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+class FakeHttp:
+    """Range ヘッダーに応じて content の一部を 206 で返します。受け取った Range を ranges に記録します。"""
+
+    def __init__(self, content):
+        self.content = content
+        self.ranges = []
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        header = headers['range']
+        self.ranges.append(header)
+        start, end = (int(value) for value in header[len('bytes='):].split('-'))
+        total = len(self.content)
+        if start >= total:
+            return httplib2.Response({'status': 416, 'content-range': f"bytes */{total}"}), b''
+        body = self.content[start:end + 1]
+        resp = httplib2.Response({'status': 206, 'content-range': f"bytes {start}-{start + len(body) - 1}/{total}"})
+        return resp, body
+
+
+class FakeMediaRequest:
+    def __init__(self, http, file_id):
+        self.http = http
+        self.uri = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+        self.headers = {'accept': '*/*', 'user-agent': 'test'}
+
+
+class FakeFiles:
+    def __init__(self, http):
+        self.http = http
+
+    def get_media(self, fileId):
+        return FakeMediaRequest(self.http, fileId)
+
+
+class FakeDrive:
+    def __init__(self, content=CONTENT):
+        self.http = FakeHttp(content)
+        self._files = FakeFiles(self.http)
+
+    def files(self):
+        return self._files
+
+
+def download(drive, save_path, md5_checksum=CONTENT_MD5, size=len(CONTENT)):
+    return download_drive_file(drive, 'file-1', str(save_path), acquire=lambda: None,
+                               md5_checksum=md5_checksum, size=size, chunk_size=10)
+
+
+def write_part(save_path, data, **source):
+    with open(part_path(str(save_path)), 'wb') as f:
+        f.write(data)
+    with open(str(save_path) + PART_META_SUFFIX, 'w', encoding='utf-8') as f:
+        json.dump({'file_id': 'file-1', 'md5': CONTENT_MD5, 'size': len(CONTENT), **source}, f)
+
+
+def test_download_in_chunks(tmp_path):
+    save_path = tmp_path / "SKU-1.jpg"
+    drive = FakeDrive()
+
+    assert download(drive, save_path) == (len(CONTENT), CONTENT_MD5)
+    assert save_path.read_bytes() == CONTENT
+    assert drive.http.ranges == ['bytes=0-9', 'bytes=10-19', 'bytes=20-29', 'bytes=30-39']
+    assert not (tmp_path / "SKU-1.jpg.part").exists()
+    assert not (tmp_path / "SKU-1.jpg.part.json").exists()
+
+
+def test_resumes_from_part_of_the_same_source(tmp_path):
+    save_path = tmp_path / "SKU-1.jpg"
+    write_part(save_path, CONTENT[:15])
+    drive = FakeDrive()
+
+    assert download(drive, save_path) == (len(CONTENT), CONTENT_MD5)
+    # 取得済みの15バイトの続きから取得し、md5 は .part の内容も含めて計算する
+    assert drive.http.ranges[0] == 'bytes=15-24'
+    assert save_path.read_bytes() == CONTENT
+    assert not (tmp_path / "SKU-1.jpg.part").exists()
+    assert not (tmp_path / "SKU-1.jpg.part.json").exists()
+
+
+@pytest.mark.parametrize('source', [
+    {'file_id': 'file-2'},
+    {'md5': hashlib.md5(b"other").hexdigest()},
+    {'size': len(CONTENT) + 1},
+])
+def test_restarts_when_part_meta_does_not_match(tmp_path, source):
+    save_path = tmp_path / "SKU-1.jpg"
+    write_part(save_path, b"XXXXXXXXXXXXXXX", **source)
+    drive = FakeDrive()
+
+    assert download(drive, save_path) == (len(CONTENT), CONTENT_MD5)
+    assert drive.http.ranges[0] == 'bytes=0-9'
+    assert save_path.read_bytes() == CONTENT
+
+
+def test_restarts_when_part_has_no_meta(tmp_path):
+    save_path = tmp_path / "SKU-1.jpg"
+    with open(part_path(str(save_path)), 'wb') as f:
+        f.write(b"XXXXXXXXXXXXXXX")
+    drive = FakeDrive()
+
+    download(drive, save_path)
+
+    assert drive.http.ranges[0] == 'bytes=0-9'
+    assert save_path.read_bytes() == CONTENT
+
+
+def test_md5_mismatch_removes_the_download(tmp_path):
+    save_path = tmp_path / "SKU-1.jpg"
+    drive = FakeDrive()
+
+    with pytest.raises(ChecksumMismatchError):
+        download(drive, save_path, md5_checksum=hashlib.md5(b"other").hexdigest())
+
+    # 一致しない内容は保存名にも .part にも残さないため、次回は最初から取得し直す
+    assert not save_path.exists()
+    assert not (tmp_path / "SKU-1.jpg.part").exists()
+    assert not (tmp_path / "SKU-1.jpg.part.json").exists()
+
+
+def test_md5_mismatch_after_resume_does_not_keep_the_part(tmp_path):
+    save_path = tmp_path / "SKU-1.jpg"
+    # 取得元の記録は同じだが、途中データの内容が壊れている
+    write_part(save_path, b"XXXXXXXXXXXXXXX")
+    drive = FakeDrive()
+
+    with pytest.raises(ChecksumMismatchError):
+        download(drive, save_path)
+    assert not save_path.exists()
+    assert not (tmp_path / "SKU-1.jpg.part").exists()
+
+    download(drive, save_path)
+    assert save_path.read_bytes() == CONTENT
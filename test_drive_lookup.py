@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+drive_lookup のクエリ組み立て・結果の振り分けのテスト（Drive は呼び出しません）
+"""
+
+import urllib.parse
+
+from drive_lookup import (
+    IMAGE_ORDERS, MAX_QUERY_TERMS, MAX_QUERY_LENGTH, configure_image_order, parent_images_request,
+    first_image_request, pick_first_image, pick_first_images, chunk_folder_names, folder_search_request,
+    match_folder_names,
+)
+
+
+class FakeFiles:
+    def list(self, **kwargs):
+        return kwargs
+
+
+class FakeDrive:
+    def files(self):
+        return FakeFiles()
+
+
+def image(file_id, name, parent):
+    return {'id': file_id, 'name': name, 'md5Checksum': f"md5-{file_id}", 'size': '10', 'parents': [parent]}
+
+
+def test_bulk_and_single_folder_listings_use_the_same_order():
+    try:
+        for order, order_by in IMAGE_ORDERS.items():
+            configure_image_order(order)
+            assert parent_images_request(FakeDrive(), ['f1', 'f2'])['orderBy'] == order_by
+            assert first_image_request(FakeDrive(), 'f1')['orderBy'] == order_by
+    finally:
+        configure_image_order(None)
+
+
+def test_pick_first_images_keeps_drive_order_per_folder():
+    # Drive が orderBy で返した順（大文字小文字を区別しない名前順など）をそのまま使う
+    files = [image('a', 'b.jpg', 'f1'), image('b', 'B.jpg', 'f2'), image('c', 'a.jpg', 'f1'), image('d', 'C.jpg', 'f2')]
+
+    images = pick_first_images(['f1', 'f2', 'f3'], files)
+
+    assert images == {
+        'f1': {'id': 'a', 'name': 'b.jpg', 'md5Checksum': 'md5-a', 'size': '10'},
+        'f2': {'id': 'b', 'name': 'B.jpg', 'md5Checksum': 'md5-b', 'size': '10'},
+        'f3': None,
+    }
+    # 1フォルダずつの検索で同じ順に返った場合と同じ画像を選ぶ
+    assert images['f1']['id'] == pick_first_image([f for f in files if f['parents'] == ['f1']])['id']
+
+
+def folder_query(names):
+    return folder_search_request(FakeDrive(), names)['q']
+
+
+def test_chunk_folder_names_splits_at_max_terms():
+    names = [f"SKU-{i}" for i in range(250)]
+
+    chunks = chunk_folder_names(names)
+
+    assert [len(chunk) for chunk in chunks] == [MAX_QUERY_TERMS, MAX_QUERY_TERMS, 50]
+    assert sum(chunks, []) == names
+
+
+def test_chunk_folder_names_keeps_encoded_query_within_max_length():
+    # シングルクォート・空白・マルチバイト文字は URL エンコードで長くなるため、エンコード後の長さで分割する
+    names = [f"商品 '{i}' " + "あ" * 20 for i in range(100)]
+
+    chunks = chunk_folder_names(names)
+
+    assert len(chunks) > 1
+    assert sum(chunks, []) == names
+    for chunk in chunks:
+        assert len(urllib.parse.quote(folder_query(chunk))) <= MAX_QUERY_LENGTH
+    # 次の名前を加えると上限を超える位置で区切っている
+    assert len(urllib.parse.quote(folder_query(chunks[0] + chunks[1][:1]))) > MAX_QUERY_LENGTH
+
+
+def test_chunk_folder_names_keeps_an_overlong_name_in_its_own_chunk():
+    names = ["A", "B" * MAX_QUERY_LENGTH, "C"]
+
+    assert chunk_folder_names(names) == [["A"], ["B" * MAX_QUERY_LENGTH], ["C"]]
+
+
+def test_folder_query_escapes_quotes_and_backslashes():
+    query = folder_query(["it's", "a\\b"])
+
+    assert query.startswith("(name='it\\'s' or name='a\\\\b') and ")
+
+
+def test_match_folder_names_ignores_case():
+    files = [
+        {'id': '1', 'name': 'sku-a'},
+        {'id': '2', 'name': 'SKU-B'},
+        {'id': '3', 'name': 'SKU-A'},
+        {'id': '4', 'name': 'other'},
+    ]
+
+    found = match_folder_names(['SKU-A', 'sku-b', 'SKU-C'], files, {})
+
+    # 大文字小文字だけが異なる名前にも対応付け、同じ名前の2件目は使わない
+    assert found == {'SKU-A': '1', 'sku-b': '2'}
+
+
+def test_match_folder_names_prefers_exact_names_when_both_were_searched():
+    files = [{'id': '1', 'name': 'sku-a'}, {'id': '2', 'name': 'SKU-A'}]
+
+    assert match_folder_names(['SKU-A', 'sku-a'], files, {}) == {'sku-a': '1', 'SKU-A': '2'}
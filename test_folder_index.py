@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FolderIndex.build / refresh のテスト（changes・files を返す偽の Drive サービスを使います）
+"""
+
+from drive_lookup import FOLDER_MIME_TYPE
+from folder_index import FolderIndex
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeFiles:
+    def __init__(self, folders):
+        self.folders = folders
+
+    def list(self, **kwargs):
+        return FakeRequest({'files': self.folders})
+
+
+class FakeChanges:
+    """pageToken ごとの changes.list の応答を返します。受け取った pageToken を requested に記録します。"""
+
+    def __init__(self, start_page_token, pages):
+        self.start_page_token = start_page_token
+        self.pages = pages
+        self.requested = []
+
+    def getStartPageToken(self):
+        return FakeRequest({'startPageToken': self.start_page_token})
+
+    def list(self, pageToken, **kwargs):
+        self.requested.append(pageToken)
+        return FakeRequest(self.pages[pageToken])
+
+
+class FakeDrive:
+    def __init__(self, folders, start_page_token='1', pages=None):
+        self._files = FakeFiles(folders)
+        self._changes = FakeChanges(start_page_token, pages or {})
+
+    def files(self):
+        return self._files
+
+    def changes(self):
+        return self._changes
+
+
+def execute(request):
+    return request.execute()
+
+
+def folder(folder_id, name, parent='root', modified='2024-01-01T00:00:00.000Z', **extra):
+    return {'id': folder_id, 'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent],
+            'modifiedTime': modified, **extra}
+
+
+def build_index(tmp_path, folders):
+    index = FolderIndex(str(tmp_path / "folder_index.sqlite3"))
+    index.build(FakeDrive(folders), execute)
+    return index
+
+
+def test_refresh_follows_pages_and_applies_changes(tmp_path):
+    index = build_index(tmp_path, [folder('f1', 'SKU-1'), folder('f2', 'SKU-2'), folder('f3', 'SKU-3')])
+    drive = FakeDrive([], pages={
+        '1': {'nextPageToken': '2', 'changes': [
+            # 名前の変更
+            {'fileId': 'f1', 'file': folder('f1', 'SKU-1-new')},
+            # ゴミ箱への移動
+            {'fileId': 'f2', 'file': folder('f2', 'SKU-2', trashed=True)},
+        ]},
+        '2': {'newStartPageToken': '3', 'changes': [
+            # 削除
+            {'fileId': 'f3', 'removed': True},
+            # 新しいフォルダと、フォルダ以外のファイル
+            {'fileId': 'f4', 'file': folder('f4', 'SKU-4')},
+            {'fileId': 'img', 'file': {'id': 'img', 'name': 'SKU-5', 'mimeType': 'image/jpeg', 'parents': ['f4']}},
+        ]},
+    })
+    index.refresh(drive, execute)
+
+    assert drive.changes().requested == ['1', '2']
+    assert index.lookup_many(['SKU-1', 'SKU-1-new', 'SKU-2', 'SKU-3', 'SKU-4', 'SKU-5']) == {
+        'SKU-1-new': 'f1',
+        'SKU-4': 'f4',
+    }
+
+
+def test_refresh_persists_new_start_page_token(tmp_path):
+    index = build_index(tmp_path, [folder('f1', 'SKU-1')])
+    index.refresh(FakeDrive([], pages={'1': {'newStartPageToken': '7', 'changes': []}}), execute)
+
+    # 開き直しても、次回は保存した newStartPageToken から取得する
+    reopened = FolderIndex(index.path)
+    drive = FakeDrive([], pages={'7': {'newStartPageToken': '8', 'changes': [
+        {'fileId': 'f2', 'file': folder('f2', 'SKU-2')},
+    ]}})
+    reopened.refresh(drive, execute)
+
+    assert drive.changes().requested == ['7']
+    assert reopened.lookup('SKU-2') == 'f2'
+    assert reopened.lookup('SKU-1') == 'f1'
+
+
+def test_lookup_ignores_case_like_match_folder_names(tmp_path):
+    index = build_index(tmp_path, [folder('f1', 'Sku-ABC')])
+    index.add({'sku-def': 'f2'})
+
+    assert index.lookup('SKU-abc') == 'f1'
+    assert index.lookup_many(['sku-abc', 'SKU-DEF', 'SKU-GHI']) == {'sku-abc': 'f1', 'SKU-DEF': 'f2'}
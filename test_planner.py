@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+known_lookups と、インデックス・キャッシュで解決できるSKUを除いた見積もりのテスト
+"""
+
+import os
+
+from download_manifest import DownloadManifest, open_download_manifest
+from drive_lookup import remember_folder_modified, image_listing_calls
+from folder_index import FolderIndex, load_folder_index
+from planner import known_lookups, plan_download_run, plan_image_formula_run
+from result_cache import ResultCache, open_result_cache
+
+
+def open_stores(tmp_path, ttl=60):
+    """SKU-1 はインデックスに、SKU-2 は先頭画像までキャッシュに、SKU-3 は「フォルダなし」として記録します。"""
+    index = FolderIndex(str(tmp_path / "folder_index.sqlite3"))
+    index.add({'SKU-1': 'f1'})
+    cache = ResultCache(str(tmp_path / "result_cache.sqlite3"), ttl=ttl)
+    remember_folder_modified([{'id': 'f2', 'modifiedTime': '2024-01-01T00:00:00.000Z'}])
+    cache.store(None, {'SKU-2': ('f2', {'id': 'img2'})})
+    cache.record_misses({'SKU-3': None})
+    return index, cache
+
+
+def test_known_lookups_reads_index_and_caches(tmp_path):
+    index, cache = open_stores(tmp_path)
+
+    known = known_lookups(['SKU-1', 'SKU-2', 'SKU-3', 'SKU-4', ''], folder_index=index, result_cache=cache)
+
+    assert known == {'folders': {'SKU-1': 'f1', 'SKU-2': 'f2'}, 'images': {'SKU-2'}, 'missing': {'SKU-3': None},
+                     'revalidations': 0}
+
+
+def test_known_lookups_counts_stale_entries_as_revalidations(tmp_path):
+    _, cache = open_stores(tmp_path, ttl=-1)
+
+    assert known_lookups(['SKU-2'], result_cache=cache)['revalidations'] == 1
+
+
+def test_image_formula_plan_excludes_known_skus(tmp_path):
+    index, cache = open_stores(tmp_path, ttl=-1)
+    sku_list = ['SKU-1', 'SKU-2', 'SKU-3', 'SKU-4', 'SKU-5']
+
+    plan = plan_image_formula_run(sku_list, known=known_lookups(sku_list, index, cache))
+
+    assert plan['drive_lookups'] == 2
+    assert plan['cached_lookups'] == 2
+    assert plan['image_listings'] == image_listing_calls(3)
+    assert plan['cache_revalidations'] == 1
+    assert plan['drive_calls'] == plan['lookup_queries'] + plan['image_listings'] + 1
+    assert plan['skipped_missing'] == 1
+
+
+def test_download_plan_excludes_known_skus(tmp_path):
+    index, cache = open_stores(tmp_path)
+    values = [['', '', '', sku, f"name-{sku}"] for sku in ('SKU-1', 'SKU-2', 'SKU-3', 'SKU-4')]
+    download_dir = str(tmp_path / "downloads")
+
+    without_caches = plan_download_run(values, download_dir)
+    plan = plan_download_run(values, download_dir,
+                             known=known_lookups([row[3] for row in values], index, cache))
+
+    assert without_caches['drive_lookups'] == 4
+    assert without_caches['downloads'] == 4
+    assert plan['drive_lookups'] == 1
+    assert plan['cached_lookups'] == 2
+    assert plan['image_listings'] == image_listing_calls(2)
+    assert plan['downloads'] == 3
+    assert plan['skipped_missing'] == 1
+
+
+def test_download_plan_applies_misses_like_the_run(tmp_path):
+    index, cache = open_stores(tmp_path)
+    cache.record_misses({'SKU-5': 'f5'})
+    values = [
+        # フォルダなしの記録があってもA列が記入済みならダウンロードする
+        ['https://drive.google.com/drive/folders/f3', '', '', 'SKU-3', 'filled-3'],
+        # 画像なしの記録と同じフォルダならスキップ、別のフォルダならダウンロードする
+        ['https://drive.google.com/drive/folders/f5', '', '', 'SKU-5', 'same-5'],
+        ['https://drive.google.com/drive/folders/f6', '', '', 'SKU-5', 'other-5'],
+    ]
+
+    plan = plan_download_run(values, str(tmp_path / "downloads"),
+                             known=known_lookups([row[3] for row in values], index, cache))
+
+    assert plan['skipped_missing'] == 1
+    assert plan['skipped_filled'] == 3
+    assert plan['downloads'] == 2
+    assert plan['image_listings'] == image_listing_calls(2)
+
+
+def list_files(tmp_path):
+    return sorted(os.path.relpath(os.path.join(root, name), tmp_path)
+                  for root, _, names in os.walk(tmp_path) for name in names)
+
+
+def test_plan_stores_open_read_only_without_creating_files(tmp_path):
+    config = {'folder_index': str(tmp_path / "folder_index.sqlite3"),
+              'result_cache': {'path': str(tmp_path / "result_cache.sqlite3")}}
+    download_dir = str(tmp_path / "downloads")
+
+    # まだ保存されていなければ、何も作らずに None を返す
+    assert load_folder_index(config) is None
+    assert open_result_cache(config, read_only=True) is None
+    assert open_download_manifest(config, download_dir, read_only=True) is None
+    assert list_files(tmp_path) == []
+
+    index, cache = open_stores(tmp_path)
+    index._set_meta('built_at', '1')
+    index._conn.commit()
+    manifest = DownloadManifest(download_dir)
+    (tmp_path / "downloads" / "name-1.jpg").write_bytes(b"image")
+    manifest.record(str(tmp_path / "downloads" / "name-1.jpg"), 'img1')
+    for store in (index, cache, manifest):
+        store._conn.close()
+    before = list_files(tmp_path)
+
+    known = known_lookups(['SKU-1', 'SKU-2', 'SKU-3'], load_folder_index(config),
+                          open_result_cache(config, read_only=True))
+    read_only_manifest = open_download_manifest(config, download_dir, read_only=True)
+
+    assert known['folders'] == {'SKU-1': 'f1', 'SKU-2': 'f2'}
+    assert known['missing'] == {'SKU-3': None}
+    assert read_only_manifest.recorded(str(tmp_path / "downloads" / "name-1.jpg"))
+    assert list_files(tmp_path) == before
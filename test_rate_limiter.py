@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RateLimiter の AIMD 制御と SharedRateStore の取り分のテスト（時刻は偽の時計で進めます）
+"""
+
+import pytest
+
+from rate_limiter import RateLimiter, SharedRateStore
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def adaptive_limiter(clock, max_calls=100, **kwargs):
+    return RateLimiter(max_calls, period=60.0, adaptive=True, clock=clock, **kwargs)
+
+
+def test_throttle_halves_limit_once_per_cooldown():
+    clock = FakeClock()
+    limiter = adaptive_limiter(clock)
+
+    limiter.on_throttle()
+    assert limiter.limit == 50
+    # 連続したスロットリング応答では下げすぎない（decrease_cooldown は period / 6）
+    clock.advance(1)
+    limiter.on_throttle()
+    assert limiter.limit == 50
+    clock.advance(10)
+    limiter.on_throttle()
+    assert limiter.limit == 25
+
+
+def test_throttle_stops_at_min_calls():
+    clock = FakeClock()
+    limiter = adaptive_limiter(clock)
+
+    for _ in range(10):
+        limiter.on_throttle()
+        clock.advance(11)
+
+    assert limiter.limit == limiter.min_calls == 5
+
+
+def test_success_recovers_about_one_step_per_window_up_to_ceiling():
+    clock = FakeClock()
+    limiter = adaptive_limiter(clock, ceiling=120)
+    limiter.on_throttle()
+
+    # 上限分（1ウィンドウ分）成功すると、およそ increase_step だけ上がる
+    for _ in range(50):
+        limiter.on_success()
+    assert 54 < limiter.limit <= 55
+
+    for _ in range(10000):
+        limiter.on_success()
+    assert limiter.limit == 120
+
+
+def test_reserve_waits_for_the_window_after_throttle():
+    clock = FakeClock()
+    limiter = adaptive_limiter(clock, max_calls=4)
+    limiter.on_throttle()
+
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 60]
+    clock.advance(60)
+    # 1件目・2件目の予約がウィンドウから外れ、3件目の予約はまだ残っている
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 60
+
+
+def test_remaining_reuses_the_given_usage():
+    clock = FakeClock()
+    limiter = RateLimiter(10, period=60.0, clock=clock)
+    for _ in range(4):
+        limiter.reserve()
+
+    usage = limiter.usage_percentage()
+    assert usage == 40
+    assert limiter.remaining() == limiter.remaining(usage) == 6
+    # 渡した使用率から計算し、数え直さない
+    assert limiter.remaining(100) == 0
+
+
+def shared_stores(tmp_path, clock):
+    path = str(tmp_path / "rate_limits.sqlite3")
+    return SharedRateStore(path, 'a', clock=clock), SharedRateStore(path, 'b', clock=clock)
+
+
+def reserve(store, count=1):
+    return [store.reserve('drive', 60.0, 10, 10)[0] for _ in range(count)]
+
+
+def test_single_client_uses_the_whole_window(tmp_path):
+    clock = FakeClock()
+    a, _ = shared_stores(tmp_path, clock)
+
+    assert reserve(a, 10) == [0] * 10
+    assert reserve(a) == [60]
+
+
+def test_two_clients_split_the_window(tmp_path):
+    clock = FakeClock()
+    a, b = shared_stores(tmp_path, clock)
+
+    assert reserve(a, 4) == [0] * 4
+    assert reserve(b, 4) == [0] * 4
+    # 2プロセスで予約しているため、各プロセスの取り分は上限の半分
+    assert reserve(a) == [0]
+    assert reserve(b) == [0]
+    assert b.used('drive', 60.0) == 10
+    assert reserve(a) == [60]
+    assert reserve(b) == [60]
+
+
+def test_client_waits_for_its_share_while_the_window_has_room(tmp_path):
+    clock = FakeClock()
+    a, b = shared_stores(tmp_path, clock)
+
+    reserve(b)
+    # 全体ではまだ余裕があっても、a の取り分（10 // 2）を超えた分は待つ
+    assert reserve(a, 6) == [0] * 5 + [60]
+
+
+def test_idle_client_no_longer_takes_a_share(tmp_path):
+    clock = FakeClock()
+    a, b = shared_stores(tmp_path, clock)
+    reserve(b)
+    clock.advance(61)
+
+    # b の予約がウィンドウから外れると、a が上限をすべて使える
+    assert reserve(a, 10) == [0] * 10
+
+
+@pytest.fixture
+def shared_limiters(tmp_path):
+    clock = FakeClock()
+    limiters = []
+    for store in shared_stores(tmp_path, clock):
+        limiter = RateLimiter(10, period=60.0, adaptive=True, clock=clock)
+        limiter.store = store
+        limiters.append(limiter)
+    return clock, limiters
+
+
+def test_throttle_lowers_the_shared_limit_for_every_client(shared_limiters):
+    clock, (a, b) = shared_limiters
+    a.reserve()
+    b.reserve()
+
+    a.on_throttle()
+    assert a.limit == 5
+    # 他プロセスが直前に下げたばかりなら下げない
+    b.on_throttle()
+    assert b.limit == 10
+    b.reserve()
+    assert b.limit == 5
+
+    clock.advance(11)
+    b.on_throttle()
+    assert b.limit == 2.5
+
+
+def test_success_raises_the_shared_limit_on_next_reserve(shared_limiters):
+    clock, (a, b) = shared_limiters
+    a.reserve()
+    a.on_throttle()
+
+    a.on_success()
+    assert a.limit == pytest.approx(5.2)
+    b.reserve()
+    # 引き上げ分は a の次の予約で共有ストアに反映される
+    assert b.limit == 5
+    a.reserve()
+    b.reserve()
+    assert b.limit == pytest.approx(5.2)
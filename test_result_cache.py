@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ResultCache のテスト（時計を差し替え、フォルダのメタデータは偽の files().get のバッチで返します）
+"""
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import drive_lookup
+from drive_lookup import configure_image_order
+from result_cache import ResultCache
+
+TTL = 100
+MAX_AGE = 1000
+HOUR = 60 * 60
+IMAGE = {'id': 'img-1', 'md5Checksum': 'abc', 'size': '10'}
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeGet:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeFiles:
+    def get(self, fileId, fields):
+        return FakeGet(fileId)
+
+
+class FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            self.drive.fetched.append(request.file_id)
+            folder = self.drive.folders.get(request.file_id)
+            if isinstance(folder, int):
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': folder}), b''))
+            else:
+                self.callback(request_id, folder, None)
+
+
+class FakeDrive:
+    """folders は {フォルダID: メタデータ または HTTP ステータス}。取得したフォルダID を fetched に記録します。"""
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.fetched = []
+
+    def files(self):
+        return FakeFiles()
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+@pytest.fixture(autouse=True)
+def isolated_lookup_state(monkeypatch):
+    # 実行中に分かった modifiedTime・並び順の設定を他のテストと共有しない
+    monkeypatch.setattr(drive_lookup, '_folder_modified', {})
+    monkeypatch.setattr(drive_lookup, '_image_order', drive_lookup.DEFAULT_IMAGE_ORDER)
+
+
+def open_cache(tmp_path, clock, **kwargs):
+    return ResultCache(str(tmp_path / "cache.sqlite3"), ttl=TTL, max_age=MAX_AGE, clock=clock, **kwargs)
+
+
+def lookup(cache, drive, skus=('SKU-1',)):
+    return cache.lookup(drive, list(skus), acquire=lambda: None)
+
+
+def test_store_and_lookup_within_ttl(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+    drive.fetched.clear()
+
+    clock.advance(TTL)
+    assert lookup(cache, drive) == {
+        'SKU-1': {'folder_id': 'folder-1', 'image_id': 'img-1', 'image_md5': 'abc', 'image_size': 10}
+    }
+    # ttl ちょうどまでは再検証しない
+    assert drive.fetched == []
+
+
+def test_revalidates_after_ttl_when_folder_is_unchanged(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+    drive.fetched.clear()
+
+    clock.advance(TTL + 1)
+    assert 'SKU-1' in lookup(cache, drive)
+    assert drive.fetched == ['folder-1']
+
+    # 再検証した時刻から ttl の間は取得し直さない
+    drive.fetched.clear()
+    clock.advance(TTL)
+    assert 'SKU-1' in lookup(cache, drive)
+    assert drive.fetched == []
+
+
+@pytest.mark.parametrize('folder', [
+    {'id': 'folder-1', 'modifiedTime': 't2'},
+    {'id': 'folder-1', 'modifiedTime': 't1', 'trashed': True},
+    404,
+])
+def test_revalidation_expires_changed_or_missing_folders(tmp_path, folder):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+
+    drive.folders['folder-1'] = folder
+    clock.advance(TTL + 1)
+    assert lookup(cache, drive) == {}
+    assert len(cache) == 0
+
+
+def test_revalidation_error_keeps_the_entry_for_next_time(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+
+    drive.folders['folder-1'] = 500
+    clock.advance(TTL + 1)
+    assert lookup(cache, drive) == {}
+    assert len(cache) == 1
+
+    drive.folders['folder-1'] = {'id': 'folder-1', 'modifiedTime': 't1'}
+    assert 'SKU-1' in lookup(cache, drive)
+
+
+def test_known_folder_modified_skips_the_fetch(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive_lookup.remember_folder_modified([{'id': 'folder-1', 'modifiedTime': 't1'}])
+    drive = FakeDrive({})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+
+    clock.advance(TTL + 1)
+    assert 'SKU-1' in lookup(cache, drive)
+    assert drive.fetched == []
+
+
+def test_max_age_expires_without_revalidation(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+
+    clock.advance(MAX_AGE)
+    assert 'SKU-1' in lookup(cache, drive)
+
+    drive.fetched.clear()
+    clock.advance(1)
+    assert lookup(cache, drive) == {}
+    assert drive.fetched == []
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock, max_entries=2)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    for sku in ('SKU-1', 'SKU-2'):
+        cache.store(drive, {sku: ('folder-1', IMAGE)}, acquire=lambda: None)
+        clock.advance(1)
+    # SKU-1 を使ったので、最後に使われた時刻が古いのは SKU-2 になる
+    lookup(cache, drive, ['SKU-1'])
+    clock.advance(1)
+
+    cache.store(drive, {'SKU-3': ('folder-1', IMAGE)}, acquire=lambda: None)
+    assert len(cache) == 2
+    assert set(lookup(cache, drive, ['SKU-1', 'SKU-2', 'SKU-3'])) == {'SKU-1', 'SKU-3'}
+
+
+def test_image_order_change_clears_cached_images(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+
+    configure_image_order('largest')
+    # 読み取り専用（--plan）では破棄せず、画像が分からないものとして扱う
+    assert open_cache(tmp_path, clock, read_only=True).peek(['SKU-1'])['SKU-1']['image_id'] is None
+    reopened = open_cache(tmp_path, clock)
+    assert lookup(reopened, drive) == {
+        'SKU-1': {'folder_id': 'folder-1', 'image_id': None, 'image_md5': None, 'image_size': None}
+    }
+
+    # 同じ並び順で開き直しても、新しく保存した画像IDは残る
+    reopened.store(drive, {'SKU-1': ('folder-1', IMAGE)}, acquire=lambda: None)
+    assert lookup(open_cache(tmp_path, clock), drive)['SKU-1']['image_id'] == 'img-1'
+
+def test_miss_schedule_escalates_and_stops_at_the_last_delay(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    for delay in (HOUR, 6 * HOUR, 24 * HOUR, 24 * HOUR):
+        cache.record_misses({'SKU-1': None})
+        clock.advance(delay - 1)
+        assert cache.missing(['SKU-1']) == {'SKU-1': None}
+        clock.advance(1)
+        assert cache.missing(['SKU-1']) == {}
+
+
+def test_miss_count_resets_when_the_result_changes(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    cache.record_misses({'SKU-1': None})
+    clock.advance(HOUR)
+    cache.record_misses({'SKU-1': None})
+    clock.advance(6 * HOUR)
+
+    # フォルダは見つかったが画像がなかった場合は、別の記録として1時間から数え直す
+    cache.record_misses({'SKU-1': 'folder-1'})
+    assert cache.missing(['SKU-1']) == {'SKU-1': 'folder-1'}
+    clock.advance(HOUR)
+    assert cache.missing(['SKU-1']) == {}
+
+
+def test_found_sku_resets_the_miss(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    drive = FakeDrive({'folder-1': {'id': 'folder-1', 'modifiedTime': 't1'}})
+    cache.record_misses({'SKU-1': None, 'SKU-2': None})
+    clock.advance(HOUR)
+    cache.record_misses({'SKU-1': None, 'SKU-2': None})
+
+    # フォルダだけ見つかったSKUは「フォルダなし」の記録だけ消え、画像も見つかったSKUはすべて消える
+    cache.store(drive, {'SKU-1': ('folder-1', None), 'SKU-2': ('folder-1', IMAGE)}, acquire=lambda: None)
+    assert cache.missing(['SKU-1', 'SKU-2']) == {}
+    cache.record_misses({'SKU-1': 'folder-1'})
+    cache.store(drive, {'SKU-1': ('folder-1', None)}, acquire=lambda: None)
+    assert cache.missing(['SKU-1']) == {'SKU-1': 'folder-1'}
+
+    # 見つかった後にまた見つからなくなった場合は1時間から数え直す
+    cache.record_misses({'SKU-2': None})
+    clock.advance(HOUR)
+    assert cache.missing(['SKU-2']) == {}
+
+
+def test_recheck_missing_ignores_recorded_misses(tmp_path):
+    clock = FakeClock()
+    open_cache(tmp_path, clock).record_misses({'SKU-1': None})
+
+    assert open_cache(tmp_path, clock).missing(['SKU-1']) == {'SKU-1': None}
+    assert open_cache(tmp_path, clock, recheck_missing=True).missing(['SKU-1']) == {}
+
+
+def test_roots_do_not_record_missing_folders(tmp_path):
+    clock = FakeClock()
+    cache = open_cache(tmp_path, clock)
+    cache.record_misses({'SKU-1': None, 'SKU-2': 'folder-2'}, roots=['root-1'])
+
+    assert cache.missing(['SKU-1', 'SKU-2']) == {'SKU-2': 'folder-2'}